@@ -1,36 +1,145 @@
+import os
+import sys
 import time
+import json
+import zlib
+import lzma
+import threading
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import ctypes as C
 import numpy as np
+import pco_dll
+from pco_dll import PCO_OpenStruct, WAIT_OBJECT_0
+
+class _CameraSetting:
+    """
+    An Edge attribute backed by a camera setting. Reading it calls the
+    Edge's 'getter' method if we've never read it (or if it's older
+    than 'ttl' seconds); the getter stores the answer by assigning to
+    the attribute. ttl=None means it never goes stale, which is right
+    for settings that only change when we change them.
+    """
+    def __init__(self, getter, ttl=None):
+        self.getter = getter
+        self.ttl = ttl
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, camera, owner=None):
+        if camera is None:
+            return self
+        entry = camera._setting_cache.get(self.name)
+        if entry is None or (self.ttl is not None and
+                             time.perf_counter() - entry[1] > self.ttl):
+            getattr(camera, self.getter)()
+            entry = camera._setting_cache[self.name]
+        return entry[0]
+
+    def __set__(self, camera, value):
+        camera._setting_cache[self.name] = (value, time.perf_counter())
+
+def _prints_events(method):
+    """
+    For Edge's public methods: with 'verbose' (or 'very_verbose'),
+    print the events the call logged, once it's done, instead of
+    printing as we go. When one of these calls another, the outermost
+    does the printing.
+    """
+    @functools.wraps(method)
+    def call(self, *args, **kwargs):
+        if self._printing_events or not (self.verbose or self.very_verbose):
+            return method(self, *args, **kwargs)
+        self._printing_events = True
+        since = self.events.num_recorded
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._printing_events = False
+            self.events.print(since, 2 if self.very_verbose else 1)
+    return call
 
 class Edge:
-    def __init__(self, pco_edge_type='4.2', verbose=True, very_verbose=False):
+    def __init__(
+        self,
+        pco_edge_type='4.2',
+        verbose=True,
+        very_verbose=False,
+        buffer_memory_budget=None,
+        camera_number=None,
+        ):
+        """
+        * Everything we do goes in self.events, an EventLog, for
+          printing or dumping after the run. 'verbose' prints what
+          each call logged once it's done (never from inside the
+          recording loops). 'very_verbose' prints more, including a
+          line per frame once each record_to_memory() is done.
+        * 'buffer_memory_budget': bytes of driver buffers we're allowed
+          to keep between arms; None means no limit. See _get_buffers().
+        * 'camera_number' picks which camera to open, counting from 0,
+          if you have more than one. None opens the next one the driver
+          finds.
+        """
         assert pco_edge_type in ('4.2', '5.5')
+        _load_dll()
         self.pco_edge_type = pco_edge_type
         self.verbose = verbose
         self.very_verbose = very_verbose
+        self.buffer_memory_budget = buffer_memory_budget
+        self.buffer_pointers = [] #Our pool of driver buffers...
+        self.buffer_events = [] #...the events the driver signals...
+        self._buffer_capacities = [] #...their sizes in bytes...
+        self._driver_buffer_addresses = [] #...and where the driver put them
+        self.num_buffers = 0 #How many of them arm() is using
+        self.armed = False
+        self._num_arms = 0 #So stop_preview() can tell if we re-armed
+        self.camera_number = camera_number
         self.camera_handle = C.c_void_p(0)
-        if verbose: print("Opening pco.edge camera...")
+        self.events = EventLog()
+        self._printing_events = True #We print once we're open
         try:
             assert self.camera_handle.value is None
-            dll.open_camera(self.camera_handle, 0)
+            if camera_number is None:
+                dll.open_camera(self.camera_handle, 0)
+            else:
+                open_struct = PCO_OpenStruct()
+                open_struct.wSize = C.sizeof(PCO_OpenStruct)
+                open_struct.wInterfaceType = 0xFFFF #Any interface
+                open_struct.wCameraNumber = camera_number
+                dll.open_camera_ex(self.camera_handle, open_struct)
             assert self.camera_handle.value is not None
-        except (WindowsError, AssertionError):
+        except (OSError, AssertionError):
             print("Failed to open pco.edge camera.")
             print(" *Is the camera on, and plugged into the computer?")
             print(" *Is CamWare running?")
             print(" *Is sc2_cl_me4.dll in the same directory as SC2_Cam.dll?")
             raise
-        if self.verbose: print(" Camera open.")
+        self.events.record('open', -1 if camera_number is None else
+                           camera_number)
+        self._applied_settings = None #apply_settings() will do a full reset
+        self._setting_cache = {} #Settings are read when first needed
+        self.calibration_maps = {} #See record_dark() and record_flat()
+        self.requested_roi = None #See apply_settings(), frame_transform()
         self.disarm()
-        self._refresh_camera_setting_attributes()
-        return None                            
+        self._printing_events = False #See _prints_events()
+        if verbose or very_verbose:
+            self.events.print(verbosity=2 if very_verbose else 1)
+        return None
 
+    @_prints_events
     def close(self):
-        if self.verbose: print("Closing pco.edge camera...")
+        self._stop_threads()
+        if isinstance(getattr(self, 'ring', None), SharedFrameRing):
+            self.ring.close()
+        if self.armed: self.disarm()
+        self.free_buffers()
         dll.close_camera(self.camera_handle)
-        if self.verbose: print(" Camera closed.")
+        self.events.record('close')
         return None
 
+    @_prints_events
     def apply_settings(
         self,
         trigger='auto_trigger',
@@ -38,7 +147,9 @@ class Edge:
         region_of_interest={'left': 1,
                             'right': 2060,
                             'top': 1,
-                            'bottom': 2048}
+                            'bottom': 2048},
+        timestamp_mode='off',
+        full_reset=False,
         ):
         """
         * 'trigger' can be 'auto_trigger' or 'external_trigger' See the
@@ -48,86 +159,134 @@ class Edge:
         * 'region_of_interest' will be adjusted to match the nearest
           legal ROI that the camera supports. See _legalize_roi() for
           details.
-        """    
-        if self.armed: self.disarm()
-        if self.verbose: print("Applying settings to camera...")
+        * 'timestamp_mode' can be 'off', 'binary', 'binary+ascii' or
+          'ascii'. The binary modes write a BCD frame counter and
+          timestamp into the first 14 pixels of every frame; see
+          decode_timestamps().
+        * We remember what we last applied, and only send the settings
+          that changed, verifying them all in one pass at the end. If
+          nothing changed, we don't even disarm. 'full_reset=True' does
+          it the slow, paranoid way: reset the camera to its defaults,
+          then set and verify everything one at a time. The first call
+          (and any call after a failure) always does a full reset.
+          self.last_reconfiguration says what we did and how long it
+          took.
+        """
+        start_time = time.perf_counter()
         """
         These settings matter, but we don't expose their functionality
         through apply_settings():
         """
-        dll.reset_settings_to_default(self.camera_handle)        
-        self._set_sensor_format('standard')
-        self._set_acquire_mode('auto')
-        self._set_pixel_rate({'4.2': 272250000,
-                              '5.5': 286000000
-                              }[self.pco_edge_type])
+        settings = {'sensor_format': 'standard',
+                    'acquire_mode': 'auto',
+                    'pixel_rate': {'4.2': 272250000,
+                                   '5.5': 286000000
+                                   }[self.pco_edge_type]}
         """
         I think these settings don't matter for the pco.edge, but just
         in case...
         """
-        self._set_storage_mode('recorder')
-        self._set_recorder_submode('ring_buffer')
+        settings.update({'storage_mode': 'recorder',
+                         'recorder_submode': 'ring_buffer'})
         """
         These settings change all the time:
         """
-        self._set_trigger_mode(trigger)
-        self._set_exposure_time(exposure_time_microseconds)
-        self._set_roi(region_of_interest)
-        """
-        It's good to check the camera health periodically. Now's as good
-        a time as any, especially since the expected result is
-        predictable: it should all be zeros.
-        """
-        camera_health = self._get_camera_health()
-        for v in camera_health.values():
-            assert v == 0
+        settings.update({'trigger_mode': trigger,
+                         'exposure_time': int(exposure_time_microseconds),
+                         'roi': self._legalize_roi(region_of_interest),
+                         'timestamp_mode': timestamp_mode})
+        self.requested_roi = dict(region_of_interest) #See frame_transform()
+        if settings['roi'] != self.requested_roi:
+            self.events.record('roi_adjusted')
+        full_reset = full_reset or self._applied_settings is None
+        if full_reset:
+            changed = list(settings)
+        else:
+            changed = [k for k in settings
+                       if settings[k] != self._applied_settings[k]]
+        if changed:
+            if self.armed: self.disarm()
+            self._applied_settings = None #In case we fail halfway
+            setters = {'sensor_format': self._set_sensor_format,
+                       'acquire_mode': self._set_acquire_mode,
+                       'pixel_rate': self._set_pixel_rate,
+                       'storage_mode': self._set_storage_mode,
+                       'recorder_submode': self._set_recorder_submode,
+                       'trigger_mode': self._set_trigger_mode,
+                       'exposure_time': self._set_exposure_time,
+                       'roi': self._set_roi,
+                       'timestamp_mode': self._set_timestamp_mode}
+            if full_reset:
+                dll.reset_settings_to_default(self.camera_handle)
+                for k in changed:
+                    setters[k](settings[k])
+            else:
+                for k in changed:
+                    setters[k](settings[k], verify=False)
+                getters = {'sensor_format': self._get_sensor_format,
+                           'acquire_mode': self._get_acquire_mode,
+                           'pixel_rate': self._get_pixel_rate,
+                           'storage_mode': self._get_storage_mode,
+                           'recorder_submode': self._get_recorder_submode,
+                           'trigger_mode': self._get_trigger_mode,
+                           'exposure_time': self._get_exposure_time,
+                           'roi': self._get_roi,
+                           'timestamp_mode': self._get_timestamp_mode}
+                for k in changed:
+                    assert getters[k]() == settings[k]
+            """
+            It's good to check the camera health periodically. Now's as
+            good a time as any, especially since the expected result is
+            predictable: it should all be zeros.
+            """
+            camera_health = self._get_camera_health()
+            for v in camera_health.values():
+                assert v == 0
+            self._applied_settings = settings
+        self.last_reconfiguration = {
+            'seconds': time.perf_counter() - start_time,
+            'full_reset': full_reset,
+            'changed': changed}
+        microseconds = int(1e6 * self.last_reconfiguration['seconds'])
+        if full_reset:
+            self.events.record('settings_reset', microseconds)
+        else:
+            self.events.record('settings_changed', len(changed), microseconds)
         return None
 
+    @_prints_events
     def arm(self, num_buffers=2):
         assert 1 <= num_buffers <= 16
         if self.armed:
-            if self.verbose:
-                print('Arm requested, but the pco.edge camera'
-                      'is already armed. Disarming...')
-                self.disarm()
-        if self.verbose: print("Arming camera...") 
+            self.disarm()
         dll.arm_camera(self.camera_handle)
         wXRes, wYRes, wXResMax, wYResMax = (
             C.c_uint16(), C.c_uint16(), C.c_uint16(), C.c_uint16())
         dll.get_sizes(self.camera_handle, wXRes, wYRes, wXResMax, wYResMax)
         self.width, self.height = wXRes.value, wYRes.value
         self.bytes_per_image = self.width * self.height * 2 #16 bit images
-        if self.very_verbose:
-            print(" Camera ROI dimensions:",
-                  self.width, "(l/r) by", self.height, "(u/d)")
         """
-        Allocate buffers that the camera will use to hold images.
+        Get buffers that the camera will use to hold images. These
+        outlive disarm(), so this is usually free; see _get_buffers().
         """
-        self.buffer_pointers = []
-        for i in range(num_buffers):
-            buffer_number = C.c_int16(-1)
-            self.buffer_pointers.append(C.POINTER(C.c_uint16)()) #Woo!
-            buffer_event = C.c_void_p(0)
-            dll.allocate_buffer(
-                self.camera_handle,
-                buffer_number,
-                self.bytes_per_image,
-                self.buffer_pointers[-1],
-                buffer_event)
-            assert buffer_number.value == i
-            if self.very_verbose:
-                print(" Buffer number ", i, " allocated, pointing to ",
-                      self.buffer_pointers[-1].contents,
-                      ", linked to event ", buffer_event.value, sep='')
+        self._get_buffers(num_buffers)
+        """
+        The buffers don't move until the next arm() (or _point_buffer()),
+        so build a numpy view of each one now, instead of once per frame.
+        """
+        self._image_datatype = C.c_uint16 * self.width * self.height
+        self._buffer_arrays = [
+            self._buffer_as_array(b) for b in range(num_buffers)]
         dll.set_image_parameters(self.camera_handle, self.width, self.height)
         dll.set_recording_state(self.camera_handle, 1)
         self.armed = True
-        if self.verbose: print(" Camera armed.")
+        self._num_arms += 1
+        self.events.record('arm', self.width, self.height)
         """
         Add our allocated buffers to the camera's 'driver queue'
         """
         self.added_buffers = []
-        for buf_num in range(len(self.buffer_pointers)):
+        for buf_num in range(self.num_buffers):
             dll.add_buffer(
                 self.camera_handle,
                 0,
@@ -139,21 +298,103 @@ class Edge:
             self.added_buffers.append(buf_num)
         self._dll_status = C.c_uint32()
         self._driver_status = C.c_uint32()
-        self._image_datatype = C.c_uint16 * self.width * self.height
         return None
 
+    @_prints_events
     def disarm(self):
-        if self.verbose: print("Disarming camera...")
+        """
+        Stop recording and empty the driver queue. We hang on to the
+        buffers themselves for the next arm(); free_buffers() (or
+        close()) actually frees them.
+        """
+        self._stop_threads() #Or they'd requeue buffers after we're done
         dll.set_recording_state(self.camera_handle, 0)
         dll.remove_buffer(self.camera_handle)
-        if hasattr(self, 'buffer_pointers'): #free allocated buffers
-            for buf in range(len(self.buffer_pointers)):
-                dll.free_buffer(self.camera_handle, buf)
-            self.buffer_pointers = []
+        self.added_buffers = []
+        self._buffer_arrays = [] #The next arm() might change the size
         self.armed = False
-        if self.verbose: print(" Camera disarmed.")
+        self.events.record('disarm')
+        return None
+
+    def _stop_threads(self):
+        """
+        Stop the background acquisition or preview thread, if there is
+        one. Anything that touches the driver queue does this first;
+        the thread takes buffers off the queue and puts them back.
+        """
+        self.stop_acquisition()
+        self.stop_preview()
+        return None
+
+    @_prints_events
+    def free_buffers(self, keep=0):
+        """
+        Free pooled driver buffers, all but the first 'keep' of them.
+        Only call this while disarmed.
+        """
+        assert not self.armed
+        while len(self.buffer_pointers) > keep:
+            buf = len(self.buffer_pointers) - 1 #Free from the top down
+            dll.free_buffer(self.camera_handle, buf)
+            self.buffer_pointers.pop()
+            self.buffer_events.pop()
+            self._buffer_capacities.pop()
+            self._driver_buffer_addresses.pop()
+            self.events.record('buffer_freed', buf)
+        return None
+
+    def _get_buffers(self, num_buffers):
+        """
+        Allocating buffers costs real time (up to 16 full frames), and
+        protocols that alternate settings arm and disarm a lot, so we
+        keep a pool of buffers between arms. Buffers are numbered from
+        zero, and arm() uses the first 'num_buffers' of them. Any buffer
+        big enough for the current frame size gets reused as-is; we only
+        allocate when the pool is too small, when a buffer needs to grow,
+        or when zero-copy recording left it on our memory. If the pool
+        is bigger than self.buffer_memory_budget bytes, we free the
+        buffers this arm() doesn't need, and then shrink the ones it
+        does need (that are bigger than the current frame) until we're
+        back under budget.
+        """
+        def over_budget():
+            return (self.buffer_memory_budget is not None and
+                    sum(self._buffer_capacities) > self.buffer_memory_budget)
+        if over_budget():
+            self.free_buffers(keep=num_buffers)
+        for i in range(num_buffers):
+            if i < len(self.buffer_pointers):
+                if (self._driver_buffer_addresses[i] is not None and
+                    self._buffer_capacities[i] >= self.bytes_per_image and
+                    not (self._buffer_capacities[i] > self.bytes_per_image
+                         and over_budget())):
+                    continue #Reuse it
+                buffer_number = C.c_int16(i) #Reallocate it
+                self._buffer_capacities[i] = 0
+                self.buffer_pointers[i] = C.POINTER(C.c_uint16)()
+            else:
+                buffer_number = C.c_int16(-1) #Allocate a new one
+                self.buffer_pointers.append(C.POINTER(C.c_uint16)()) #Woo!
+                self.buffer_events.append(C.c_void_p(0))
+                self._buffer_capacities.append(0)
+                self._driver_buffer_addresses.append(None)
+            dll.allocate_buffer(
+                self.camera_handle,
+                buffer_number,
+                self.bytes_per_image,
+                self.buffer_pointers[i],
+                self.buffer_events[i])
+            assert buffer_number.value == i
+            self._buffer_capacities[i] = self.bytes_per_image
+            self._driver_buffer_addresses[i] = C.addressof(
+                self.buffer_pointers[i].contents)
+            self.events.record('buffer_allocated', i, self.bytes_per_image)
+        self.num_buffers = num_buffers
+        if over_budget(): #Growing the ones we need can push us over
+            self.free_buffers(keep=num_buffers)
         return None
 
+    @_prints_events
     def record_to_memory(
         self,
         num_images,
@@ -162,118 +403,939 @@ class Edge:
         first_frame=0,
         poll_timeout=5e5,
         sleep_timeout=20,
+        wait_strategy='busy_poll',
+        zero_copy=False,
+        transform=None,
+        cancel=None,
         ):
+        """
+        * 'cancel' is an optional threading.Event; once it's set, we
+          stop after the frame we're waiting for, and raise
+          AcquisitionCancelled. See arecord().
+        * 'transform' crops and/or bins each frame as we copy it out of
+          the driver buffer, so 'out' only has to hold what's left; see
+          frame_transform(). Can't be combined with 'zero_copy'.
+        * 'zero_copy' makes the driver write each frame straight into
+          its slice of 'out', instead of into its own buffers that we
+          then copy from. 'out' must be a C-contiguous uint16 array;
+          page-aligned (see aligned_zeros()) is best for DMA. The
+          camera is briefly restarted to re-point its buffers, and if
+          anything goes wrong we disarm and free the buffers, so the
+          driver never writes into memory we've handed back to you.
+          It isn't free: every frame re-points its buffer with
+          PCO_AllocateBuffer, which on a real grabber registers
+          (page-locks) the memory. That pays off for big frames, where
+          the copy dominates, but for small ROIs at high frame rates
+          the copy is cheaper; bench_zero_copy() in pco_benchmark.py
+          measures both.
+        * 'wait_strategy' decides how we wait for each buffer. It can be
+          'busy_poll', 'adaptive_backoff' or 'event', or an instance of
+          BusyPoll, AdaptiveBackoff or EventWait if you want to tune it.
+          'poll_timeout' and 'sleep_timeout' only apply to 'busy_poll'.
+          After recording, self.telemetry holds a FrameTelemetry with
+          the waiting, CPU and copy time of every frame.
+        """
+        self._stop_threads()
         if not self.armed: self.arm()
+        assert transform is None or not zero_copy
+        frame_shape, frame_dtype = (self.height, self.width), np.uint16
+        if transform is not None:
+            frame_shape, frame_dtype = transform.shape, transform.dtype
         """
         We'll store our images in a numpy array. Did the user provide
         one, or should we allocate one ourselves?
         """
         if out is None:
             first_frame = 0
-            out = np.ones((num_images - preframes, self.height, self.width),
-                          dtype=np.uint16)
+            if zero_copy:
+                out = aligned_zeros((num_images - preframes,) + frame_shape)
+            else:
+                out = np.ones((num_images - preframes,) + frame_shape,
+                              dtype=frame_dtype)
         try:
             assert len(out.shape) == 3
             assert (out.shape[0] - first_frame) >= (num_images - preframes)
-            assert (out.shape[1], out.shape[2]) == (self.height, self.width)
+            assert (out.shape[1], out.shape[2]) == frame_shape
+            if zero_copy:
+                assert out.dtype == np.uint16
+                assert out.flags['C_CONTIGUOUS'] and out.flags['WRITEABLE']
         except AssertionError:
             print("\nInput argument 'out' must have dimensions:")
             print("(>=num_images - preframes, y-resolution, x-resolution)")
+            if transform is not None:
+                print("...where the resolution is after 'transform':",
+                      transform.shape)
+            if zero_copy:
+                print("...and for zero_copy, be a writeable, C-contiguous",
+                      "uint16 array")
             raise
         except AttributeError:
             print("\nInput argument 'out' must be a numpy array",
                   "(to hold our images)")
             raise
+        if wait_strategy in wait_strategies:
+            if wait_strategy == 'busy_poll':
+                wait_strategy = BusyPoll(poll_timeout, sleep_timeout)
+            else:
+                wait_strategy = wait_strategies[wait_strategy]()
+        wait_strategy.start(self, num_images)
+        self.telemetry = wait_strategy.telemetry
+        if zero_copy:
+            """
+            Frame 'i' goes to out[first_frame + i - preframes]. Preframes
+            (and frames past the end) land in scratch memory of our own;
+            we can't count on the driver's memory surviving a re-point.
+            The buffers stay on the scratch memory after we're done,
+            until the next arm() gives them driver memory again.
+            """
+            scratch_shape = (self.num_buffers, self.height, self.width)
+            if getattr(self, '_scratch_frames', np.zeros(0)
+                       ).shape != scratch_shape:
+                self._scratch_frames = aligned_zeros(scratch_shape)
+            scratch = self._scratch_frames
+            def frame_address(which_im, buffer_number):
+                if preframes <= which_im < num_images:
+                    return out[first_frame + which_im - preframes].ctypes.data
+                return scratch[buffer_number].ctypes.data
+            self._requeue_buffers_at([
+                frame_address(i, i) for i in range(self.num_buffers)])
         """
         Try to record some images, and try to tolerate the many possible
         ways this can fail.
         """
-        if self.verbose: print("Acquiring", num_images, "images...")
+        self.events.record('record', num_images, preframes)
+        start_time = time.perf_counter()
+        try:
+            num_acquired = self._record_loop(
+                num_images, preframes, out, first_frame, wait_strategy,
+                frame_address if zero_copy else None, transform, cancel)
+        except:
+            if zero_copy: #Buffers might point into 'out'
+                self.disarm()
+                self.free_buffers()
+            raise
+        finally:
+            if self.very_verbose: self._print_frames()
+        self.events.record('recorded', num_acquired,
+                           1e6 * (time.perf_counter() - start_time))
+        return out
+
+    def _print_frames(self):
+        """
+        What very_verbose used to print from inside the recording loop,
+        now printed from self.telemetry once we're done, so the console
+        can't make us miss frames.
+        """
+        t = self.telemetry.timeline()
+        for i, polls, sleeps, status in zip(
+            t['frame_index'], t['num_polls'], t['num_sleeps'],
+            t['driver_status']):
+            print(" Image %i: after %i polls and %i sleeps, driver status"
+                  " 0x%08x"%(i, polls, sleeps, status))
+        return None
+
+    def _record_loop(self, num_images, preframes, out, first_frame,
+                     wait_strategy, frame_address=None, transform=None,
+                     cancel=None):
         num_acquired = 0
         for which_im in range(num_images):
+            if cancel is not None and cancel.is_set():
+                self.events.record('cancelled', num_acquired)
+                raise AcquisitionCancelled(
+                    'record_to_memory cancelled', num_acquired)
             """
-            Hassle the camera until it gives us a buffer. The only ways
-            we exit this 'while' loop are by getting a buffer or running
-            out of patience.
+            Wait until the camera gives us a buffer. The wait strategy
+            either hands back a buffer number or runs out of patience
+            and raises TimeoutError.
             """
-            num_polls = 0
-            num_sleeps = 0
-            start_time = time.clock()
-            while True:
-                """
-                Check if a buffer is ready
-                """
-                num_polls += 1
-                dll.get_buffer_status(
-                    self.camera_handle,
-                    self.added_buffers[0],
-                    self._dll_status,
-                    self._driver_status)
-                if self._dll_status.value == 0xc0008000:
-                    buffer_number = self.added_buffers.pop(0)#Removed from queue
-                    if self.very_verbose:
-                        print(" After", num_polls, "polls and", num_sleeps,
-                              "sleeps, buffer", buffer_number, "is ready.")
-                    break
-                """
-                The buffer isn't ready. How long should we wait to try
-                again? For short exposures, we'd like to poll super
-                frequently. For long exposures, we'll use time.sleep()
-                to save CPU.
-                """
-                if self.exposure_time_microseconds > 30e3:
-                    time.sleep(self.exposure_time_microseconds * 5e-8)
-                    num_sleeps += 1
-                """
-                At some point we have to admit we probably missed a
-                trigger, and give up. Give up after too many polls
-                (likely triggered by short exposures) or too many sleeps
-                (likely triggered by long exposures)
-                """
-                if num_polls > poll_timeout or num_sleeps > sleep_timeout:
-                    elapsed_time = time.clock() - start_time
-                    raise TimeoutError(
-                        "After %i polls and %0.3f seconds, no buffer."%(
-                            poll_timeout, elapsed_time),
-                        num_acquired=num_acquired)
+            buffer_number = wait_strategy.wait(which_im, num_acquired)
             try:
-                if self._driver_status.value == 0x0:
-                    pass
-                elif self._driver_status.value == 0x80332028:
-                    raise DMAError('DMA error during record_to_memory')
-                else:
-                    print("Driver status:", self._driver_status.value)
-                    raise UserWarning("Buffer status error")
-                if self.very_verbose:
-                    print(" Record to memory result:",
-                          hex(self._dll_status.value),
-                          hex(self._driver_status.value))
+                self._check_driver_status()
                 if which_im >= preframes:
-                    image = np.ctypeslib.as_array( #Temporary!
-                        self._image_datatype.from_address(
-                            C.addressof(
-                                self.buffer_pointers[buffer_number].contents)))
-                    out[first_frame + (which_im - preframes), :, :] = image
+                    if transform is not None:
+                        transform(self._buffer_arrays[buffer_number],
+                                  out[first_frame + (which_im - preframes)])
+                    elif frame_address is None:
+                        out[first_frame + (which_im - preframes), :, :] = (
+                            self._buffer_arrays[buffer_number])
                     num_acquired += 1
             finally:
-                dll.add_buffer(#Put the buffer back in the driver queue
-                    self.camera_handle,
-                    0,
-                    0,
-                    buffer_number,
-                    self.width,
-                    self.height,
-                    16)
-                self.added_buffers.append(buffer_number)
-        if self.verbose: print("Done acquiring.")
+                self.telemetry.record_handling(
+                    which_im, self._driver_status.value)
+                if frame_address is not None: #Point at its next frame
+                    self._point_buffer(
+                        buffer_number,
+                        frame_address(which_im + self.num_buffers,
+                                      buffer_number))
+                self._requeue_buffer(buffer_number)
+        return num_acquired
+
+    @_prints_events
+    def record_reduced(
+        self,
+        num_images,
+        reductions=('mean',),
+        preframes=0,
+        wait_strategy='busy_poll',
+        ):
+        """
+        Like record_to_memory(), but instead of keeping every frame,
+        fold each one into running 'reductions' ('sum', 'mean', 'max',
+        'min', 'var' and/or 'std') straight out of the driver buffer.
+        Memory use is a few frames' worth no matter how many images we
+        take. Returns a dict of (height, width) arrays, one per
+        reduction; see FrameReducer.
+        """
+        self._stop_threads()
+        if not self.armed: self.arm()
+        reducer = FrameReducer(self.height, self.width, reductions)
+        if wait_strategy in wait_strategies:
+            wait_strategy = wait_strategies[wait_strategy]()
+        wait_strategy.start(self, num_images)
+        self.telemetry = wait_strategy.telemetry
+        self.events.record('record', num_images, preframes)
+        start_time = time.perf_counter()
+        for which_im in range(num_images):
+            buffer_number = wait_strategy.wait(which_im, reducer.num_frames)
+            try:
+                self._check_driver_status()
+                if which_im >= preframes:
+                    reducer.add(self._buffer_arrays[buffer_number])
+            finally:
+                self.telemetry.record_handling(
+                    which_im, self._driver_status.value)
+                self._requeue_buffer(buffer_number)
+        self.events.record('recorded', reducer.num_frames,
+                           1e6 * (time.perf_counter() - start_time))
+        return reducer.result()
+
+    def _calibration_key(self, exposure_time_microseconds=None):
+        roi = self.roi
+        if exposure_time_microseconds is None:
+            exposure_time_microseconds = self.exposure_time_microseconds
+        return ((roi['left'], roi['top'], roi['right'], roi['bottom']),
+                exposure_time_microseconds, self.pixel_rate)
+
+    @_prints_events
+    def record_dark(self, num_images=100, preframes=2):
+        """
+        Average 'num_images' frames with no light on the sensor (it's
+        up to you to cover it), and keep the result as the dark map
+        for the current ROI, exposure and pixel rate, in
+        self.calibration_maps. Returns the map, in float32.
+        """
+        dark = self.record_reduced(num_images, ('mean',), preframes)['mean']
+        maps = self.calibration_maps.setdefault(self._calibration_key(), {})
+        maps['dark'] = dark.astype(np.float32)
+        maps.pop('correction', None) #Out of date
+        return maps['dark']
+
+    @_prints_events
+    def record_flat(self, num_images=100, preframes=2):
+        """
+        Average 'num_images' frames of even illumination, and keep the
+        result, minus the dark map, as the flat map for the current ROI,
+        exposure and pixel rate. Call record_dark() for these settings
+        first.
+        """
+        key = self._calibration_key()
+        assert 'dark' in self.calibration_maps.get(key, {}), (
+            "Call record_dark() for these settings first")
+        flat = self.record_reduced(num_images, ('mean',), preframes)['mean']
+        maps = self.calibration_maps[key]
+        maps['flat'] = (flat - maps['dark']).astype(np.float32)
+        maps.pop('correction', None)
+        return maps['flat']
+
+    def flat_field_correction(self, flat_exposure_time_microseconds=None):
+        """
+        A FlatFieldCorrection for the current ROI, exposure and pixel
+        rate, from the maps record_dark() and record_flat() cached. The
+        gain map doesn't depend on exposure, so you can use a flat from
+        another exposure ('flat_exposure_time_microseconds'). Without
+        a flat, it only subtracts the dark. Built once, then cached.
+        """
+        key = self._calibration_key()
+        maps = self.calibration_maps.get(key, {})
+        assert 'dark' in maps, "Call record_dark() for these settings first"
+        flat_key = self._calibration_key(flat_exposure_time_microseconds)
+        flat = self.calibration_maps.get(flat_key, {}).get('flat')
+        if 'correction' not in maps or maps['correction'].flat is not flat:
+            maps['correction'] = FlatFieldCorrection(maps['dark'], flat)
+        return maps['correction']
+
+    @_prints_events
+    def auto_expose(
+        self,
+        target_level=30000,
+        percentile=99,
+        tolerance=0.05,
+        dark_level=100,
+        saturation_level=65535,
+        min_exposure_microseconds=100,
+        max_exposure_microseconds=1000000,
+        max_iterations=10,
+        max_samples=65536,
+        ):
+        """
+        Find the exposure time that puts the 'percentile'th percentile
+        pixel at 'target_level' counts, to within 'tolerance' (a
+        fraction of the signal above 'dark_level'), and leave the
+        camera set to it. Call apply_settings() first; we keep its
+        other settings.
+
+        Each iteration records one frame, estimates the percentile from
+        a strided subsample of at most 'max_samples' pixels (see
+        subsampled_percentile()), and scales the exposure by how far
+        off it was: the signal above dark is proportional to the
+        exposure, so that usually converges in two or three frames. A
+        saturated frame (percentile at 'saturation_level') tells us
+        nothing about how much too bright it is, so then we just
+        quarter the exposure (we count anything within 2% of
+        'saturation_level' as saturated, since the response flattens
+        out there), and likewise multiply it by 8 if we see no signal
+        at all.
+
+        Changing the exposure goes through apply_settings(), which only
+        sends what changed, so each step costs a disarm, two exposure
+        calls, a health check and an arm, not a full reset.
+
+        Returns (and keeps, as self.last_auto_exposure) the final
+        exposure, whether we converged, and the level, exposure and
+        cost in ms (recording the frame, the histogram, and applying
+        the new exposure) of every iteration.
+        """
+        applied = self._applied_settings
+        assert applied is not None, "Call apply_settings() first"
+        start_time = time.perf_counter()
+        exposure = applied['exposure_time']
+        target_signal = target_level - dark_level
+        assert target_signal > 0
+        iterations = []
+        converged = False
+        frame = None
+        for i in range(max_iterations):
+            iteration_start = time.perf_counter()
+            if not self.armed: self.arm()
+            if frame is None or frame.shape[1:] != (self.height, self.width):
+                frame = np.zeros((1, self.height, self.width), np.uint16)
+            self.record_to_memory(1, out=frame,
+                                  wait_strategy='adaptive_backoff')
+            recorded = time.perf_counter()
+            level = float(subsampled_percentile(
+                frame[0], percentile, max_samples))
+            histogrammed = time.perf_counter()
+            iteration = {'exposure_time_microseconds': exposure,
+                         'level': level,
+                         'frame_ms': 1e3 * (recorded - iteration_start),
+                         'histogram_ms': 1e3 * (histogrammed - recorded),
+                         'apply_ms': 0}
+            iterations.append(iteration)
+            signal = level - dark_level
+            if abs(signal - target_signal) <= tolerance * target_signal:
+                converged = True
+                break
+            if level >= 0.98 * saturation_level:
+                new_exposure = exposure / 4
+            elif signal <= 0:
+                new_exposure = exposure * 8
+            else:
+                new_exposure = exposure * target_signal / signal
+            new_exposure = int(round(min(max(
+                new_exposure, min_exposure_microseconds),
+                max_exposure_microseconds)))
+            if new_exposure == exposure: #Stuck at a limit
+                break
+            self.apply_settings(trigger=applied['trigger_mode'],
+                                exposure_time_microseconds=new_exposure,
+                                region_of_interest=self.requested_roi,
+                                timestamp_mode=applied['timestamp_mode'])
+            applied = self._applied_settings
+            exposure = new_exposure
+            iteration['apply_ms'] = 1e3 * (
+                time.perf_counter() - histogrammed)
+        self.last_auto_exposure = {
+            'exposure_time_microseconds': exposure,
+            'converged': converged,
+            'level': iterations[-1]['level'],
+            'num_iterations': len(iterations),
+            'seconds': time.perf_counter() - start_time,
+            'iterations': iterations}
+        self.events.record('auto_exposure' if converged else
+                           'auto_exposure_failed', exposure, len(iterations))
+        return self.last_auto_exposure
+
+    async def arecord(self, num_images, **record_kwargs):
+        """
+        record_to_memory() for asyncio code: 'await camera.arecord(n)'.
+        The recording runs in the loop's default executor, so other
+        coroutines (including other cameras' arecord()s) keep running.
+        If the task is cancelled, we stop the recording at the next
+        frame, with every buffer back in the driver queue, before
+        passing the cancellation on.
+        """
+        import asyncio #Slow to import, so only when we need it
+        loop = asyncio.get_running_loop()
+        cancel = threading.Event()
+        recording = loop.run_in_executor(
+            None, lambda: self.record_to_memory(
+                num_images, cancel=cancel, **record_kwargs))
+        try:
+            return await asyncio.shield(recording)
+        except asyncio.CancelledError:
+            cancel.set()
+            try:
+                await recording #Let the recording thread tidy up
+            except AcquisitionCancelled:
+                pass
+            raise
+
+    async def aframes(self, num_images=None, **acquisition_kwargs):
+        """
+        Background acquisition for asyncio code:
+
+            async for frame in camera.aframes():
+                ...
+
+        Arguments go to start_acquisition(). As with get(), each frame
+        is only valid until the next one; copy it if you need it for
+        longer. Cancelling the loop stops the acquisition. If you
+        'break' out early, Python doesn't close the generator until
+        it's garbage collected, so use contextlib.aclosing():
+
+            async with contextlib.aclosing(camera.aframes()) as frames:
+                async for frame in frames:
+                    ...
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        ring = self.start_acquisition(num_images, **acquisition_kwargs)
+        try:
+            while True:
+                if ring.depth() > 0: #No need to leave the event loop
+                    frame = ring.get()
+                else:
+                    frame = await loop.run_in_executor(None, ring.get)
+                if frame is None:
+                    return
+                yield frame
+        finally: #stop_acquisition() joins a thread; not on the loop
+            await loop.run_in_executor(None, self.stop_acquisition)
+
+    @_prints_events
+    def start_acquisition(
+        self,
+        num_images=None,
+        num_slots=16,
+        overflow='block',
+        wait_strategy='adaptive_backoff',
+        transform=None,
+        publish_as=None,
+        ):
+        """
+        Acquire in a background thread, into a preallocated ring of
+        'num_slots' frames. Pull frames out with get() or stream()
+        while the camera keeps going, then call stop_acquisition().
+
+        * 'num_images': stop after this many; None means run until
+          stop_acquisition().
+        * 'overflow': what to do when the consumer falls behind and the
+          ring is full. 'block' stops taking buffers from the driver
+          until a slot frees up (so the camera itself will drop frames
+          once the driver queue runs dry). 'drop' keeps the driver
+          queue moving and throws the new frame away. Either way,
+          self.ring.num_overflows counts the times we hit a full ring.
+        * 'wait_strategy' is as for record_to_memory(). The default
+          sleeps between polls, so the thread leaves the consumer
+          some CPU. One given by name keeps waiting for frames as long
+          as it takes (e.g. an external trigger), checking every
+          0.25 s if we're stopping.
+        * 'transform' is as for record_to_memory(); the ring holds
+          transformed frames.
+        * 'publish_as' puts the ring in shared memory under that name,
+          for other processes to read with SharedFrameReader instead of
+          us calling get(). A shared ring never waits for its readers
+          ('overflow' doesn't apply); slow readers find out they missed
+          frames. It stays up after stop_acquisition(), until the next
+          start_acquisition(), close(), or self.ring.close().
+        """
+        def make_ring():
+            if publish_as is None:
+                return self._frame_ring(num_slots, overflow, transform)
+            height, width = self.height, self.width
+            dtype = np.uint16
+            if transform is not None:
+                (height, width), dtype = transform.shape, transform.dtype
+            return SharedFrameRing(
+                publish_as, num_slots, height, width, dtype)
+        return self._start_ring_thread(
+            make_ring, num_images, wait_strategy, transform)
+
+    def _start_ring_thread(self, make_ring, num_images, wait_strategy,
+                           transform):
+        """
+        What start_acquisition() and start_history() share: stop
+        whatever else is using the driver queue, arm, replace the last
+        ring (closing it if it's shared) with make_ring(), and start the
+        acquisition thread filling it.
+        """
+        self._stop_threads()
+        if not self.armed: self.arm()
+        if isinstance(getattr(self, 'ring', None), SharedFrameRing):
+            self.ring.close()
+        wait_strategy = _stoppable(wait_strategy)
+        wait_strategy.start(self, num_images or 1000)
+        self.telemetry = wait_strategy.telemetry
+        self.ring = make_ring()
+        self._acquisition_thread = threading.Thread(
+            target=self._acquisition_thread_main,
+            args=(self.ring, num_images, wait_strategy, transform),
+            daemon=True)
+        self.events.record('acquisition_start', len(self.ring.slots))
+        self._acquisition_thread.start()
+        return self.ring
+
+    def get(self, timeout=None):
+        """
+        The oldest frame we haven't handed out yet, or None once the
+        acquisition is over and the ring is empty. The frame is a view
+        into the ring, and is only valid until the next get(); copy it
+        if you need it for longer.
+        """
+        return self.ring.get(timeout)
+
+    def stream(self, timeout=None):
+        """
+        Generator version of get(), for 'for frame in camera.stream():'
+        """
+        while True:
+            frame = self.ring.get(timeout)
+            if frame is None:
+                return
+            yield frame
+
+    @_prints_events
+    def stop_acquisition(self):
+        thread = getattr(self, '_acquisition_thread', None)
+        if thread is None:
+            return None
+        self.ring.stop()
+        thread.join()
+        self._acquisition_thread = None
+        self.events.record('acquisition_stop', self.ring.num_written,
+                           self.ring.num_overflows)
+        return None
+
+    @_prints_events
+    def start_preview(self, num_buffers=6, wait_strategy='adaptive_backoff'):
+        """
+        Live preview, for focusing and alignment: a background thread
+        keeps the newest frame on hand, and latest() gives it to you.
+        Unlike start_acquisition(), there's no queue of frames to fall
+        behind on, and nothing is copied; see LivePreview. Run until
+        stop_preview(), which leaves the camera armed.
+
+        The preview holds two driver buffers (the newest frame, and the
+        one you're looking at), so 'num_buffers' needs a few more than
+        that to keep the camera busy. A wait strategy given by name
+        gives up every 0.25 s without a frame (e.g. waiting on an
+        external trigger) to check if we're stopping. Stop the preview
+        before recording any other way; start_acquisition() does it
+        for you.
+        """
+        assert num_buffers >= 4
+        """
+        Stop anything else using the driver queue before we (maybe)
+        re-arm, or its buffers get queued twice.
+        """
+        self._stop_threads()
+        if not self.armed or self.num_buffers < num_buffers:
+            self.arm(num_buffers)
+        self._preview_num_arms = self._num_arms
+        wait_strategy = _stoppable(wait_strategy)
+        wait_strategy.start(self, 1000)
+        self.telemetry = wait_strategy.telemetry
+        self.preview = LivePreview(self._buffer_arrays)
+        self._preview_thread = threading.Thread(
+            target=self._preview_thread_main,
+            args=(self.preview, wait_strategy),
+            daemon=True)
+        self.events.record('preview_start', self.num_buffers)
+        self._preview_thread.start()
+        return self.preview
+
+    def latest(self, timeout=None, out=None):
+        """
+        The newest frame from start_preview(), waiting up to 'timeout'
+        seconds for one newer than the last we returned. It's a view of
+        a driver buffer, valid until the next latest() or
+        stop_preview(); pass 'out' to get a copy instead. Returns None
+        once the preview is over. self.preview.frame_number is the
+        frame's number, and self.preview.summary() has the lag.
+        """
+        frame = self.preview.latest(timeout)
+        if frame is None or out is None:
+            return frame
+        out[:, :] = frame
         return out
 
-    def _refresh_camera_setting_attributes(self):
+    @_prints_events
+    def stop_preview(self):
+        thread = getattr(self, '_preview_thread', None)
+        if thread is None:
+            return None
+        self.preview.stop()
+        thread.join()
+        self._preview_thread = None
+        self.events.record('preview_stop', self.preview.num_frames,
+                           self.preview.num_displayed)
+        """
+        Give the driver back the buffers we held, unless something
+        disarmed or re-armed the camera since we started; arm() already
+        queued every buffer.
+        """
+        held = self.preview.release_all()
+        if self.armed and self._num_arms == self._preview_num_arms:
+            for buffer_number in held:
+                self._requeue_buffer(buffer_number)
+        return None
+
+    @_prints_events
+    def start_history(
+        self,
+        seconds=None,
+        num_slots=None,
+        wait_strategy='adaptive_backoff',
+        transform=None,
+        ):
+        """
+        Keep a rolling history of the last 'seconds' of frames (or the
+        last 'num_slots' frames) in a background thread, for catching
+        rare events. When one happens, capture_event() saves the frames
+        around it; see HistoryRing. Run until stop_acquisition().
+
+        'seconds' is converted to frames with estimate_frame_rate(), so
+        with an external trigger, give 'num_slots' instead. The ring is
+        allocated up front, so mind the memory: a second of full
+        frames at 100 fps is 840 MB. 'wait_strategy' and 'transform'
+        are as for start_acquisition().
+        """
+        def make_ring():
+            slots = num_slots
+            if slots is None:
+                slots = int(np.ceil(seconds * self.estimate_frame_rate()))
+            height, width, dtype = self.height, self.width, np.uint16
+            if transform is not None:
+                (height, width), dtype = transform.shape, transform.dtype
+            return HistoryRing(slots, height, width, dtype)
+        return self._start_ring_thread(
+            make_ring, None, wait_strategy, transform)
+
+    @_prints_events
+    def capture_event(self, path, frames_before, frames_after=0,
+                      frame_number=None, timeout=None, resume=True):
+        """
+        Something happened: freeze the start_history() ring once
+        'frames_after' more frames are in, and save 'frames_before'
+        frames from before the event plus those 'frames_after' to
+        'path', in bulk. read_recording() opens the file.
+
+        The event is 'frame_number' if you know it (e.g. your analysis
+        spotted something in that frame), otherwise now: frames we
+        already have are 'before', and frames still to come are
+        'after'. With 'resume', the history starts rolling again once
+        the file is written. Returns the HistoryRing.save() stats.
+        """
+        self.ring.trigger(frames_before, frames_after, frame_number)
+        self.ring.wait(timeout)
+        stats = self.ring.save(path)
+        if resume:
+            self.ring.resume()
+        self.events.record('event_saved', stats['frames_written'],
+                           stats['event_frame_number'])
+        return stats
+
+    @_prints_events
+    def record_to_file(
+        self,
+        path,
+        num_images,
+        num_slots=32,
+        max_write_frames=8,
+        wait_strategy='busy_poll',
+        transform=None,
+        compression=None,
+        compression_level=None,
+        preprocess='delta+shuffle',
+        num_workers=None,
+        ):
+        """
+        Record straight to disk, for runs that don't fit in RAM. We
+        copy each frame into a small pool of 'num_slots' frames, and a
+        writer thread drains the pool in big sequential writes of up to
+        'max_write_frames' frames. If the disk can't keep up, the pool
+        fills and we stop taking buffers until it drains, so the pool
+        size sets how much of a hiccup we can ride out.
+
+        The file is a 4096-byte header, the raw uint16 frames, then a
+        frame-number index; read_recording() opens it. Returns a dict
+        of throughput and queue-depth counters, also kept as
+        self.file_stats. A 'transform' (see frame_transform()) shrinks
+        what we write, as well as what we copy.
+
+        'compression' can be 'zlib' or 'lzma', to compress each frame
+        in a pool of 'num_workers' threads before it hits the disk;
+        see CompressedFileWriter for the other options. The stats then
+        include the compression ratio and how far the workers fell
+        behind.
+        """
+        self._stop_threads()
+        if not self.armed: self.arm()
+        if wait_strategy in wait_strategies:
+            wait_strategy = wait_strategies[wait_strategy]()
+        wait_strategy.start(self, num_images)
+        self.telemetry = wait_strategy.telemetry
+        ring = self._frame_ring(num_slots, 'block', transform)
+        if compression is None:
+            writer = RawFileWriter(path, ring, max_write_frames)
+        else:
+            writer = CompressedFileWriter(
+                path, ring, max_write_frames, compression,
+                compression_level, preprocess, num_workers)
+        self.events.record('record', num_images)
+        writer.start()
+        try:
+            self._acquire_into_ring(ring, num_images, wait_strategy,
+                                    transform)
+        finally:
+            ring.finish()
+            writer.join()
+        self.file_stats = writer.stats()
+        self.events.record('recorded', self.file_stats['frames_written'],
+                           1e6 * self.file_stats['seconds'])
+        if writer.error is not None:
+            raise writer.error
+        self.events.record('file_written',
+                           1000 * self.file_stats['mb_per_second'],
+                           self.file_stats['max_queue_depth'])
+        if compression is not None:
+            self.events.record('compression',
+                               1000 * self.file_stats['compression_ratio'],
+                               self.file_stats['max_worker_backlog'])
+        return self.file_stats
+
+    def _acquisition_thread_main(self, ring, num_images, wait_strategy,
+                                 transform=None):
+        try:
+            self._acquire_into_ring(ring, num_images, wait_strategy,
+                                    transform)
+        except Exception as e:
+            ring.finish(error=e)
+        else:
+            ring.finish()
+        return None
+
+    def _preview_thread_main(self, preview, wait_strategy):
+        which_im, frame_number = 0, 0
+        telemetry = wait_strategy.telemetry
+        try:
+            while not preview.stopping:
+                try:
+                    buffer_number = wait_strategy.wait(which_im, which_im)
+                except TimeoutError: #No frame yet; are we stopping?
+                    for b in preview.take_released():
+                        self._requeue_buffer(b)
+                    continue
+                i = which_im % telemetry.length
+                ready_time = telemetry.ready_time[i] - telemetry.wake_latency[i]
+                published, requeue = False, []
+                try:
+                    self._check_driver_status()
+                    """
+                    If newer buffers filled while we weren't looking,
+                    this one is stale: recycle it without a look.
+                    """
+                    while self.added_buffers and self._buffer_is_ready():
+                        stale = buffer_number
+                        buffer_number = self.added_buffers.pop(0)
+                        ready_time = time.perf_counter()
+                        frame_number += 1
+                        preview.num_recycled += 1
+                        self._requeue_buffer(stale)
+                        self._check_driver_status()
+                    requeue = preview.publish(
+                        buffer_number, frame_number, ready_time)
+                    published = True
+                finally:
+                    telemetry.record_handling(
+                        which_im, self._driver_status.value)
+                    if not published:
+                        self._requeue_buffer(buffer_number)
+                for b in requeue:
+                    self._requeue_buffer(b)
+                which_im += 1
+                frame_number += 1
+        except Exception as e:
+            preview.finish(error=e)
+        else:
+            preview.finish()
+        return None
+
+    def frame_transform(self, crop=None, binning=1, bin_mode='mean'):
+        """
+        A FrameTransform for the current ROI, to pass as 'transform' to
+        record_to_memory(), start_acquisition() or record_to_file().
+        The camera only does ROIs in coarse steps (see _legalize_roi()),
+        so this lets us keep just the pixels we want, and bin them,
+        during the copy we have to do anyway.
+
+        * 'crop' is a region in sensor pixels, like 'region_of_interest'
+          in apply_settings(). None keeps the whole frame; 'requested'
+          keeps the region_of_interest we last asked apply_settings()
+          for (the whole ROI, if we haven't asked yet). Either way, we
+          can only keep what's inside the camera's ROI.
+        * 'binning' sums 'binning' x 'binning' blocks of pixels.
+          'bin_mode' is 'mean' (uint16 output) or 'sum' (uint32).
+        """
+        if crop == 'requested':
+            crop = self.requested_roi #None keeps all of self.roi
+        return FrameTransform(self.roi, crop, binning, bin_mode)
+
+    def _frame_ring(self, num_slots, overflow, transform=None):
+        if transform is None:
+            return FrameRing(num_slots, self.height, self.width, overflow)
+        return FrameRing(num_slots, *transform.shape, overflow=overflow,
+                         dtype=transform.dtype)
+
+    def _acquire_into_ring(self, ring, num_images, wait_strategy,
+                           transform=None):
+        which_im = 0
+        while not ring.stopping:
+            if num_images is not None and which_im >= num_images:
+                break
+            try:
+                buffer_number = wait_strategy.wait(which_im, which_im)
+            except TimeoutError: #No frame yet; are we stopping?
+                continue
+            try:
+                self._check_driver_status()
+                slot = ring.claim()
+                if slot is not None:
+                    if transform is not None:
+                        transform(self._buffer_arrays[buffer_number], slot)
+                    else:
+                        slot[:, :] = self._buffer_arrays[buffer_number]
+                    ring.commit(which_im)
+            finally:
+                wait_strategy.telemetry.record_handling(
+                    which_im, self._driver_status.value)
+                self._requeue_buffer(buffer_number)
+            which_im += 1
+        return None
+
+    def _check_driver_status(self):
+        status = self._driver_status.value
+        if status == 0x0:
+            return None
+        if status == 0x80332028:
+            self.events.record('dma_error', status)
+            raise DMAError('DMA error during record_to_memory')
+        self.events.record('driver_error', status)
+        raise UserWarning("Buffer status error: driver status 0x%08x"%status)
+
+    def _buffer_as_array(self, buffer_number):
+        """
+        A fresh numpy view of a driver buffer. The hot loops use the
+        views that arm() caches in self._buffer_arrays instead.
+        """
+        return np.ctypeslib.as_array(
+            self._image_datatype.from_address(
+                C.addressof(self.buffer_pointers[buffer_number].contents)))
+
+    def _requeue_buffer(self, buffer_number):
+        dll.add_buffer(#Put the buffer back in the driver queue
+            self.camera_handle,
+            0,
+            0,
+            buffer_number,
+            self.width,
+            self.height,
+            16)
+        self.added_buffers.append(buffer_number)
+        return None
+
+    def _point_buffer(self, buffer_number, address):
+        """
+        Re-allocate an existing buffer on memory we provide. The buffer
+        must not be in the driver queue when we do this.
+        """
+        if address == C.addressof(self.buffer_pointers[buffer_number].contents):
+            return None
+        if self._driver_buffer_addresses[buffer_number] is not None:
+            """
+            The driver may free its own memory behind this buffer, so
+            from now on the buffer is ours to look after. The next arm()
+            will give it fresh driver memory; see _get_buffers().
+            """
+            self._driver_buffer_addresses[buffer_number] = None
+            self._buffer_capacities[buffer_number] = 0
+        pointer = C.cast(C.c_void_p(address), C.POINTER(C.c_uint16))
+        dll.allocate_buffer(
+            self.camera_handle,
+            C.c_int16(buffer_number),
+            self.bytes_per_image,
+            pointer,
+            self.buffer_events[buffer_number])
+        self.buffer_pointers[buffer_number] = pointer
+        self._buffer_arrays[buffer_number] = self._buffer_as_array(
+            buffer_number)
+        return None
+
+    def _requeue_buffers_at(self, addresses):
+        """
+        Stop recording, empty the driver queue, point each buffer at a
+        new address, and start again with the buffers queued in order.
+        """
+        dll.set_recording_state(self.camera_handle, 0)
+        dll.remove_buffer(self.camera_handle)
+        for buf_num, address in enumerate(addresses):
+            self._point_buffer(buf_num, address)
+        dll.set_recording_state(self.camera_handle, 1)
+        self.added_buffers = []
+        for buf_num in range(len(addresses)):
+            dll.add_buffer(
+                self.camera_handle,
+                0,
+                0,
+                buf_num,
+                self.width,
+                self.height,
+                16)
+            self.added_buffers.append(buf_num)
+        return None
+
+    def _buffer_is_ready(self):
+        """
+        Ask the driver if the buffer at the front of the queue is full.
+        This only looks; taking the buffer off self.added_buffers is up
+        to the caller (the wait strategies, or the preview thread
+        skipping stale frames). Leaves the driver status in
+        self._driver_status.
+        """
+        dll.get_buffer_status(
+            self.camera_handle,
+            self.added_buffers[0],
+            self._dll_status,
+            self._driver_status)
+        return self._dll_status.value == 0xc0008000
+
+    @_prints_events
+    def refresh(self):
         """
-        There are two ways to access a camera setting:
-        
-         1. Ask the camera directly, using a self.get_*() - type method.
-        
+        There are three ways to access a camera setting:
+
+         1. Ask the camera directly, using a self._get_*() - type method.
+
           This interrogates the camera via a DLL call, updates the
           relevant attribute(s) of the Edge object, and returns the
           relevant value(s). This is slower, because you have to wait for
@@ -281,15 +1343,22 @@ class Edge:
 
          2. Access an attribute of the Edge object, e.g. self.roi
 
-          This ignores the camera, which is very fast, but the resulting
-          value could potentially be inconsistent with the camera's true
-          setting (although I hope it isn't!)
+          The first time you ask, this does (1) for you, and remembers
+          the answer. After that, settings we control (like the ROI)
+          come straight from memory, since they only change when we
+          change them. Things that drift on their own (temperature,
+          health) get re-read once they're more than a few seconds old.
+          See the _CameraSetting attributes below.
 
-        _refresh_camera_setting_attributes() is a convenience function
-        to update all the camera attributes at once. Call it if you're
-        nervous, I guess.
+         3. Call refresh()
+
+          This forgets everything we remember and re-reads all the
+          settings at once. Call it if you're nervous, I guess (or if
+          something like CamWare might have changed the camera behind
+          our back).
         """
-        if self.verbose: print("Retrieving settings from camera...")
+        self.events.record('refresh')
+        self._setting_cache.clear()
         self._get_sensor_format()
         self._get_trigger_mode()
         self._get_storage_mode()
@@ -298,45 +1367,47 @@ class Edge:
         self._get_pixel_rate()
         self._get_exposure_time()
         self._get_roi()
+        self._get_timestamp_mode()
         self._get_temperature()
         self._get_camera_health()
         return None
 
+    """
+    Camera settings, fetched lazily and cached; see refresh().
+    """
+    sensor_format = _CameraSetting('_get_sensor_format')
+    trigger_mode = _CameraSetting('_get_trigger_mode')
+    storage_mode = _CameraSetting('_get_storage_mode')
+    recorder_submode = _CameraSetting('_get_recorder_submode')
+    acquire_mode = _CameraSetting('_get_acquire_mode')
+    pixel_rate = _CameraSetting('_get_pixel_rate')
+    exposure_time_microseconds = _CameraSetting('_get_exposure_time')
+    delay_time = _CameraSetting('_get_exposure_time')
+    roi = _CameraSetting('_get_roi')
+    timestamp_mode = _CameraSetting('_get_timestamp_mode')
+    temperature = _CameraSetting('_get_temperature', ttl=10)
+    camera_health = _CameraSetting('_get_camera_health', ttl=2)
+
     def _get_sensor_format(self):
         wSensor = C.c_uint16(777) #777 is not an expected output
         dll.get_sensor_format(self.camera_handle, wSensor)
         assert wSensor.value in (0, 1) #wSensor.value should change
-        mode_names = {0: "standard", 1: "extended"}
-        if self.very_verbose:
-            print(" Sensor format:", mode_names[wSensor.value])
-        self.sensor_format = mode_names[wSensor.value]
+        self.events.record('sensor_format', wSensor.value)
+        self.sensor_format = setting_names['sensor_format'][wSensor.value]
         return self.sensor_format
 
-    def _set_sensor_format(self, mode='standard'):
+    def _set_sensor_format(self, mode='standard', verify=True):
         mode_numbers = {"standard": 0, "extended": 1}
-        if self.very_verbose:
-            print(" Setting sensor format to:", mode)
         dll.set_sensor_format(self.camera_handle, mode_numbers[mode])
-        assert self._get_sensor_format() == mode
+        if verify: assert self._get_sensor_format() == mode
         return self.sensor_format
     
     def _get_camera_health(self):
         dwWarn, dwErr, dwStatus = (
             C.c_uint32(), C.c_uint32(), C.c_uint32())
         dll.get_camera_health(self.camera_handle, dwWarn, dwErr, dwStatus)
-        if self.verbose:
-            print(" Camera health status:", end='')
-            print("  Warnings:", dwWarn.value, end='')
-            if dwWarn.value == 0:
-                print(" (good)", end='')
-            else:
-                print("***BAD***")
-            print(" / Errors:", dwErr.value, end='')
-            if dwErr.value == 0:
-                print(" (good)", end='')
-            else:
-                print("***BAD***")
-            print(" / Status:", dwStatus.value)
+        self.events.record('camera_health', dwWarn.value, dwErr.value)
+        self.events.record('camera_status', dwStatus.value)
         self.camera_health = {
             'warnings': dwWarn.value,
             'errors': dwErr.value,
@@ -347,11 +1418,8 @@ class Edge:
         ccdtemp, camtemp, powtemp = (
             C.c_int16(), C.c_int16(), C.c_int16())
         dll.get_temperature(self.camera_handle, ccdtemp, camtemp, powtemp)
-        if self.verbose:
-            print(" Temperatures:",
-                  "CCD", ccdtemp.value * 0.1, "C /",
-                  "camera", camtemp.value, "C /",
-                  "power supply", powtemp.value, "C ")
+        self.events.record('temperature', ccdtemp.value, camtemp.value)
+        self.events.record('power_supply_temperature', powtemp.value)
         self.temperature = {
             'ccd_temp': ccdtemp.value * 0.1,
             'camera_temp': camtemp.value,
@@ -380,97 +1448,77 @@ class Edge:
         mode; exposure time of the second image is given by the readout
         time of the first image.)
         """
-        trigger_mode_names = {0: "auto_trigger",
-                              1: "software_trigger",
-                              2: "external_trigger",
-                              3: "external_exposure"}
         wTriggerMode = C.c_uint16()
         dll.get_trigger_mode(self.camera_handle, wTriggerMode)
-        if self.verbose:
-            print(" Trigger mode:", trigger_mode_names[wTriggerMode.value])
-        self.trigger_mode = trigger_mode_names[wTriggerMode.value]
+        self.events.record('trigger_mode', wTriggerMode.value)
+        self.trigger_mode = setting_names['trigger_mode'][wTriggerMode.value]
         return self.trigger_mode
     
-    def _set_trigger_mode(self, mode="auto_trigger"):
+    def _set_trigger_mode(self, mode="auto_trigger", verify=True):
         trigger_mode_numbers = {
             "auto_trigger": 0,
             "external_trigger": 2}
-        if self.verbose: print(" Setting trigger mode to:", mode)
         dll.set_trigger_mode(self.camera_handle, trigger_mode_numbers[mode])
-        assert self._get_trigger_mode() == mode
+        if verify: assert self._get_trigger_mode() == mode
         return self.trigger_mode
 
     def _get_storage_mode(self):
         wStorageMode = C.c_uint16()
         dll.get_storage_mode(self.camera_handle, wStorageMode)
-        storage_mode_names = {0: "recorder",
-                              1: "FIFO_buffer"}
-        if self.very_verbose:
-            print(" Storage mode:", storage_mode_names[wStorageMode.value])
-        self.storage_mode = storage_mode_names[wStorageMode.value]
+        self.events.record('storage_mode', wStorageMode.value)
+        self.storage_mode = setting_names['storage_mode'][wStorageMode.value]
         return self.storage_mode
 
-    def _set_storage_mode(self, mode="recorder"):
+    def _set_storage_mode(self, mode="recorder", verify=True):
         storage_mode_numbers = {"recorder": 0,
                                 "FIFO_buffer": 1}
-        if self.very_verbose: print(" Setting storage mode to:", mode)
         dll.set_storage_mode(self.camera_handle, storage_mode_numbers[mode])
-        assert self._get_storage_mode() == mode
+        if verify: assert self._get_storage_mode() == mode
         return self.storage_mode
 
     def _get_recorder_submode(self):
         wRecSubmode = C.c_uint16(1)
         dll.get_recorder_submode(self.camera_handle, wRecSubmode)
-        recorder_submode_names = {0: "sequence",
-                                  1: "ring_buffer"}
-        if self.very_verbose:
-            print(" Recorder submode:",
-                  recorder_submode_names[wRecSubmode.value])
-        self.recorder_submode = recorder_submode_names[wRecSubmode.value]
+        self.events.record('recorder_submode', wRecSubmode.value)
+        self.recorder_submode = setting_names['recorder_submode'][
+            wRecSubmode.value]
         return self.recorder_submode
 
-    def _set_recorder_submode(self, mode="ring_buffer"):
+    def _set_recorder_submode(self, mode="ring_buffer", verify=True):
         recorder_mode_numbers = {
             "sequence": 0,
             "ring_buffer": 1}
-        if self.very_verbose: print(" Setting recorder submode to:", mode)
         dll.set_recorder_submode(
             self.camera_handle, recorder_mode_numbers[mode])
-        assert self._get_recorder_submode() == mode
+        if verify: assert self._get_recorder_submode() == mode
         return self.recorder_submode
 
     def _get_acquire_mode(self):
         wAcquMode = C.c_uint16(0)
         dll.get_acquire_mode(self.camera_handle, wAcquMode)
-        acquire_mode_names = {0: "auto",
-                              1: "external_static",
-                              2: "external_dynamic"}
-        if self.very_verbose:
-            print(" Acquire mode:", acquire_mode_names[wAcquMode.value])
-        self.acquire_mode = acquire_mode_names[wAcquMode.value]
+        self.events.record('acquire_mode', wAcquMode.value)
+        self.acquire_mode = setting_names['acquire_mode'][wAcquMode.value]
         return self.acquire_mode
 
-    def _set_acquire_mode(self, mode='auto'):
+    def _set_acquire_mode(self, mode='auto', verify=True):
         acquire_mode_numbers = {"auto": 0,
                                 "external_static": 1,
                                 "external_dynamic": 2}
-        if self.very_verbose: print(" Setting acquire mode to:", mode)
         dll.set_acquire_mode(self.camera_handle, acquire_mode_numbers[mode])
-        assert self._get_acquire_mode() == mode
+        if verify: assert self._get_acquire_mode() == mode
         return self.acquire_mode
 
     def _get_pixel_rate(self):
         dwPixelRate = C.c_uint32(0)
         dll.get_pixel_rate(self.camera_handle, dwPixelRate)
         assert dwPixelRate.value != 0
-        if self.very_verbose: print(" Pixel rate:", dwPixelRate.value)
+        self.events.record('pixel_rate', dwPixelRate.value)
         self.pixel_rate = dwPixelRate.value
         return self.pixel_rate
 
-    def _set_pixel_rate(self, rate=272250000):
-        if self.very_verbose: print(" Setting pixel rate to:", rate)
+    def _set_pixel_rate(self, rate=272250000, verify=True):
         dll.set_pixel_rate(self.camera_handle, rate)
-        assert self._get_pixel_rate() == rate
+        if verify: assert self._get_pixel_rate() == rate
         return self.pixel_rate
 
     def _get_exposure_time(self):
@@ -484,28 +1532,22 @@ class Edge:
             dwExposure,
             wTimeBaseDelay,
             wTimeBaseExposure)
-        time_base_mode_names = {0: "nanoseconds",
-                                1: "microseconds",
-                                2: "milliseconds"}
-        if self.verbose:
-            print(" Exposure:", dwExposure.value,
-                  time_base_mode_names[wTimeBaseExposure.value])
-        if self.very_verbose:
-            print(" Delay:", dwDelay.value,
-                  time_base_mode_names[wTimeBaseDelay.value])
+        self.events.record('exposure_time',
+                           dwExposure.value, wTimeBaseExposure.value)
+        self.events.record('delay_time', dwDelay.value, wTimeBaseDelay.value)
         self.exposure_time_microseconds = (
             dwExposure.value * 10.**(3*wTimeBaseExposure.value - 3))
         self.delay_time = dwDelay.value
         return self.exposure_time_microseconds
 
-    def _set_exposure_time(self, exposure_time_microseconds=2200):
+    def _set_exposure_time(
+        self, exposure_time_microseconds=2200, verify=True):
         exposure_time_microseconds = int(exposure_time_microseconds)
         assert 1e2 <= exposure_time_microseconds <= 1e7
-        if self.verbose:
-            print(" Setting exposure time to", exposure_time_microseconds, "us")
         dll.set_delay_exposure_time(
             self.camera_handle, 0, exposure_time_microseconds, 1, 1)
-        assert self._get_exposure_time() == exposure_time_microseconds
+        if verify:
+            assert self._get_exposure_time() == exposure_time_microseconds
         return self.exposure_time_microseconds
 
     
@@ -514,10 +1556,8 @@ class Edge:
             C.c_uint16(), C.c_uint16(),
             C.c_uint16(), C.c_uint16())
         dll.get_roi(self.camera_handle, wRoiX0, wRoiY0, wRoiX1, wRoiY1)
-        if self.verbose:
-            print(" Camera ROI:");
-            print("  From pixel", wRoiX0.value, "to pixel", wRoiX1.value, "(left/right)")
-            print("  From pixel", wRoiY0.value, "to pixel", wRoiY1.value, "(up/down)")
+        self.events.record('roi_left_right', wRoiX0.value, wRoiX1.value)
+        self.events.record('roi_top_bottom', wRoiY0.value, wRoiY1.value)
         self.roi = {
             'left': wRoiX0.value,
             'top': wRoiY0.value,
@@ -529,61 +1569,1925 @@ class Edge:
         """
         There are lots of ways a requested region of interest (ROI) can
         be illegal. This utility function returns a nearby legal ROI.
+        See legalize_roi(), which does the work (and doesn't need a
+        camera).
         """
-        left, right = roi['left'], roi['right']
-        bottom, top = roi['bottom'], roi['top']
-        if self.verbose:
-            print(" Requested camera ROI:")
-            print("  From pixel", left, "to pixel", right, "(left/right)")
-            print("  From pixel", top, "to pixel", bottom, "(up/down)")
-        min_lr, min_ud, min_height = 1, 1, 8
-        if self.pco_edge_type == '4.2':
-            max_lr, max_ud, min_width, step_lr = 2060, 2048, 40, 20
-        elif self.pco_edge_type == '5.5':
-            max_lr, max_ud, min_width, step_lr = 2560, 2160, 160, 160
-        """
-        Legalize left/right
-        """
-        if left < min_lr:
-            left = min_lr
-        elif left > max_lr - min_width + 1:
-            left = max_lr - min_width + 1
-        else:
-            left = 1 + step_lr*((left - 1) // step_lr)
-        if right < left + min_width - 1:
-            right = left + min_width - 1
-        elif right > max_lr:
-            right = max_lr
-        else:
-            right = left - 1 + step_lr*((right - (left - 1))//step_lr)
-        assert min_lr <= left < right <= max_lr
-        """
-        Legalize top/bottom
-        """
-        if top < min_ud:
-            top = min_ud
-        if top > (max_ud - min_height)//2 + 1:
-            top = (max_ud - min_height)//2 + 1
-        bottom = max_ud - top + 1
-        assert min_ud <= top < bottom <= max_ud
-        new_roi = {'left': left,
-                   'top': top,
-                   'right': right,
-                   'bottom': bottom}
-        if self.verbose and new_roi != roi:
-            print(" ***Requested ROI must be adjusted to match the camera***")
-        return new_roi
-
-    def _set_roi(self, region_of_interest):
-        roi = self._legalize_roi(region_of_interest)
-        dll.set_roi(self.camera_handle,
-                    roi['left'], roi['top'], roi['right'], roi['bottom'])
-        assert self._get_roi() == roi
-        return self.roi
+        return legalize_roi(roi, self.pco_edge_type)
+
+    def estimate_frame_rate(self, roi=None, exposure_time_microseconds=None):
+        """
+        Predicted frames per second for 'roi' and
+        'exposure_time_microseconds', at our current pixel rate. Either
+        defaults to what the camera is set to now, so
+        camera.estimate_frame_rate() is what you'll get if you record
+        right away. Accepts arrays; see estimate_frame_rate() below.
+        """
+        if roi is None:
+            roi = self.roi
+        if exposure_time_microseconds is None:
+            exposure_time_microseconds = self.exposure_time_microseconds
+        return estimate_frame_rate(roi, exposure_time_microseconds,
+                                   self.pco_edge_type, self.pixel_rate)
+
+    def plan_roi(self, required, target_fps=None,
+                 exposure_time_microseconds=0):
+        """
+        The smallest legal ROI containing 'required', and how fast it
+        can run, for this camera at its current pixel rate. See
+        plan_roi() below.
+        """
+        return plan_roi(required, target_fps, exposure_time_microseconds,
+                        self.pco_edge_type, self.pixel_rate)
+
+    def _set_roi(self, region_of_interest, verify=True):
+        roi = self._legalize_roi(region_of_interest)
+        if roi != region_of_interest:
+            self.events.record('roi_adjusted')
+        dll.set_roi(self.camera_handle,
+                    roi['left'], roi['top'], roi['right'], roi['bottom'])
+        if verify: assert self._get_roi() == roi
+        return self.roi
+
+    def _get_timestamp_mode(self):
+        wTimeStampMode = C.c_uint16()
+        dll.get_timestamp_mode(self.camera_handle, wTimeStampMode)
+        self.events.record('timestamp_mode', wTimeStampMode.value)
+        self.timestamp_mode = setting_names['timestamp_mode'][
+            wTimeStampMode.value]
+        return self.timestamp_mode
+
+    def _set_timestamp_mode(self, mode="off", verify=True):
+        timestamp_mode_numbers = {"off": 0,
+                                  "binary": 1,
+                                  "binary+ascii": 2,
+                                  "ascii": 3}
+        dll.set_timestamp_mode(
+            self.camera_handle, timestamp_mode_numbers[mode])
+        if verify: assert self._get_timestamp_mode() == mode
+        return self.timestamp_mode
+
+class CameraGroup:
+    """
+    Several Edges (e.g. two pco.edge heads on one microscope), driven
+    together. Each camera records in its own thread, so throughput
+    scales with the number of cameras; the DLL calls and big numpy
+    copies release the GIL.
+
+    'cameras' is a list of Edges, or of camera numbers to open.
+    """
+    def __init__(self, cameras, **edge_kwargs):
+        self.cameras = [
+            c if isinstance(c, Edge) else Edge(camera_number=c, **edge_kwargs)
+            for c in cameras]
+
+    def _in_parallel(self, method, per_camera={}, **kwargs):
+        """
+        Call 'method' on every camera at once, each in its own thread.
+        'per_camera' maps argument names to lists with one value per
+        camera; 'kwargs' go to every camera. Returns the results in
+        camera order, or raises the first exception (once all the
+        threads are done).
+        """
+        results = [None] * len(self.cameras)
+        errors = [None] * len(self.cameras)
+        def call(i):
+            try:
+                args = {k: v[i] for k, v in per_camera.items()}
+                results[i] = getattr(self.cameras[i], method)(
+                    **args, **kwargs)
+            except Exception as e:
+                errors[i] = e
+        threads = [threading.Thread(target=call, args=(i,))
+                   for i in range(len(self.cameras))]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        for e in errors:
+            if e is not None:
+                raise e
+        return results
+
+    def apply_settings(self, **settings):
+        return self._in_parallel('apply_settings', **settings)
+
+    def arm(self, num_buffers=2):
+        return self._in_parallel('arm', num_buffers=num_buffers)
+
+    def disarm(self):
+        return self._in_parallel('disarm')
+
+    def close(self):
+        return self._in_parallel('close')
+
+    def record_to_memory(
+        self, num_images, outs=None, transforms=None, **kwargs):
+        """
+        Record 'num_images' from every camera at once. 'outs' and
+        'transforms' are optional lists with one 'out' array and one
+        FrameTransform per camera (a transform has scratch space, so
+        cameras can't share one); other arguments go to each camera's
+        Edge.record_to_memory(). Returns the list of recorded arrays.
+        Afterwards, self.ready_times holds when each camera delivered
+        each frame, and self.timestamps the decode_timestamps() of each
+        untransformed recording (None for transformed ones, whose
+        stamp pixels got binned or cropped); see aligned_frames().
+        """
+        if outs is None:
+            outs = [None] * len(self.cameras)
+        if transforms is None:
+            transforms = [None] * len(self.cameras)
+        results = self._in_parallel(
+            'record_to_memory', {'out': outs, 'transform': transforms},
+            num_images=num_images, **kwargs)
+        preframes = kwargs.get('preframes', 0)
+        self.ready_times = np.stack([
+            c.telemetry.ready_time[preframes:num_images]
+            for c in self.cameras])
+        first_frame = kwargs.get('first_frame', 0)
+        recorded = slice(first_frame, first_frame + num_images - preframes)
+        self.timestamps = [ #Only touches 14 pixels per frame
+            decode_timestamps(r[recorded]) if t is None and r is not None
+            else None for r, t in zip(results, transforms)]
+        return results
+
+    def aligned_frames(self, tolerance=None, timestamps=None):
+        """
+        Match up frames across cameras after record_to_memory(). Each
+        frame matches at most one frame of each other camera. Returns a
+        (num_cameras, num_matches) array of frame indices, one column
+        per frame that every camera has, plus the arrival-time skew
+        between the earliest and latest camera for each match.
+
+        With synchronized triggers, this is just the identity; gaps
+        show you where a camera dropped a frame. We match on the best
+        clock we have, and self.aligned_by says which:
+         * 'frame_number': the camera's image counter, if every frame
+           has a valid stamp (see decode_timestamps()). Exact; the
+           counters of different cameras can be offset, so we get the
+           offset from the frames that arrived together.
+         * 'timestamp': the camera's own timestamp, if the counter
+           isn't increasing (e.g. a camera re-armed mid-recording).
+         * 'arrival': when we got each frame (self.ready_times), within
+           'tolerance' seconds (default: half the median frame interval
+           of camera 0). Only a good proxy for capture time while we're
+           keeping up; frames that sat in a full buffer queue arrive in
+           a burst, so this is the last resort.
+        'timestamps' defaults to self.timestamps from record_to_memory().
+        """
+        times = self.ready_times
+        if tolerance is None:
+            tolerance = 0.5 * np.median(np.diff(times[0]))
+        if timestamps is None:
+            timestamps = getattr(self, 'timestamps', None)
+        self.aligned_by = 'arrival'
+        keys, key_tolerance = times, tolerance
+        if timestamps is not None and all(
+            ts is not None and len(ts['valid']) == times.shape[1] and
+            ts['valid'].all() for ts in timestamps):
+            frame_numbers = [ts['frame_number'] for ts in timestamps]
+            if all((np.diff(f) > 0).all() for f in frame_numbers):
+                self.aligned_by = 'frame_number'
+                keys, key_tolerance = frame_numbers, 0.5
+            else:
+                self.aligned_by = 'timestamp'
+                keys = [(ts['time'] - ts['time'][0]) / np.timedelta64(1, 's')
+                        for ts in timestamps]
+                key_tolerance = 0.5 * np.median(np.diff(keys[0]))
+        indices = [np.arange(times.shape[1])]
+        matched = np.ones(times.shape[1], dtype=bool)
+        for c in range(1, len(times)):
+            key = keys[c]
+            if self.aligned_by != 'arrival':
+                """
+                Different cameras' clocks don't agree, but the frames
+                that arrived together mostly belong together, so the
+                median difference between them is the offset.
+                """
+                pairs = _match_nearest(times[0], times[c], tolerance)
+                together = pairs >= 0
+                offset = (np.median(key[pairs[together]] -
+                                    keys[0][together])
+                          if together.any() else key[0] - keys[0][0])
+                if self.aligned_by == 'frame_number':
+                    offset = np.round(offset)
+                key = key - offset
+            match = _match_nearest(keys[0], key, key_tolerance)
+            matched &= match >= 0
+            indices.append(match)
+        indices = np.stack(indices)[:, matched]
+        matched_times = np.take_along_axis(times, indices, axis=1)
+        skew = matched_times.max(axis=0) - matched_times.min(axis=0)
+        return indices, skew
+
+def _match_nearest(a, b, tolerance):
+    """
+    One-to-one matching between two sorted arrays: a[i] and b[j] match
+    if each is the other's nearest neighbour, and they're within
+    'tolerance' of each other. Returns the index into 'b' of each
+    element of 'a's match, or -1 where it has none.
+    """
+    if len(a) == 0 or len(b) == 0:
+        return np.full(len(a), -1)
+    def nearest(x, y): #Index of the element of 'y' closest to each 'x'
+        j = np.clip(np.searchsorted(y, x), 1, max(len(y) - 1, 1))
+        j = np.minimum(j, len(y) - 1)
+        j -= np.abs(y[j - 1] - x) < np.abs(y[j] - x)
+        return j
+    j = nearest(a, b)
+    mutual = nearest(b, a)[j] == np.arange(len(a))
+    return np.where(mutual & (np.abs(b[j] - a) <= tolerance), j, -1)
+
+"""
+Sensor geometry, and a model of how fast each ROI can run, for
+planning experiments without a camera. Everything here is vectorized:
+pass arrays as the ROI edges (or the exposure) to evaluate thousands
+of candidates at once.
+
+The edge reads out rolling-shutter style from the centre out, two rows
+at a time, so readout time is 'line_time' per row pair, and doesn't
+depend on the width at all. That's why the ROI is always vertically
+symmetric, and why a short, wide ROI is fast. 'line_time' is at the
+fast-scan 'pixel_rate' (100 fps full frame); it scales inversely with
+the pixel rate. Exposure and readout overlap, so a frame takes
+whichever is longer.
+"""
+sensor_geometry = {
+    '4.2': {'max_lr': 2060, 'max_ud': 2048,
+            'min_width': 40, 'step_lr': 20, 'min_height': 8,
+            'line_time': 9.76e-6, 'pixel_rate': 272250000},
+    '5.5': {'max_lr': 2560, 'max_ud': 2160,
+            'min_width': 160, 'step_lr': 160, 'min_height': 8,
+            'line_time': 9.26e-6, 'pixel_rate': 286000000},
+    }
+
+def _roi_arrays(roi):
+    return {k: np.asarray(roi[k], dtype=np.int64)
+            for k in ('left', 'top', 'right', 'bottom')}
+
+def _roi_result(roi, scalar):
+    if scalar: #Plain ints in, plain ints out
+        return {k: int(v) for k, v in roi.items()}
+    return roi
+
+def legalize_roi(roi, pco_edge_type='4.2'):
+    """
+    The nearby legal ROI that the camera would actually use for 'roi':
+    left snaps down to a multiple of the horizontal step (and right
+    snaps down to keep the width a multiple of it), the width is at
+    least the minimum, and top/bottom are made symmetric about the
+    centre of the sensor, keeping 'top'.
+    """
+    g = sensor_geometry[pco_edge_type]
+    step = g['step_lr']
+    scalar = all(np.ndim(roi[k]) == 0
+                 for k in ('left', 'top', 'right', 'bottom'))
+    r = _roi_arrays(roi)
+    """
+    Legalize left/right
+    """
+    left = np.clip(r['left'], 1, g['max_lr'] - g['min_width'] + 1)
+    left = 1 + step*((left - 1) // step)
+    right = np.where(
+        r['right'] < left + g['min_width'] - 1, left + g['min_width'] - 1,
+        np.where(r['right'] > g['max_lr'], g['max_lr'],
+                 left - 1 + step*((r['right'] - (left - 1)) // step)))
+    """
+    Legalize top/bottom
+    """
+    top = np.clip(r['top'], 1, (g['max_ud'] - g['min_height'])//2 + 1)
+    bottom = g['max_ud'] - top + 1
+    return _roi_result(
+        {'left': left, 'top': top, 'right': right, 'bottom': bottom},
+        scalar)
+
+def estimate_frame_rate(
+    roi, exposure_time_microseconds, pco_edge_type='4.2', pixel_rate=None,
+    legalize=True):
+    """
+    Predicted frames per second for 'roi' and
+    'exposure_time_microseconds' in auto-trigger mode. 'pixel_rate'
+    defaults to fast scan. The ROI is legalized first, since that's
+    what the camera will run, unless 'legalize=False'. Arrays in give
+    an array of rates out, broadcast together.
+    """
+    g = sensor_geometry[pco_edge_type]
+    if pixel_rate is None:
+        pixel_rate = g['pixel_rate']
+    if legalize:
+        roi = legalize_roi(roi, pco_edge_type)
+    height = np.asarray(roi['bottom']) - np.asarray(roi['top']) + 1
+    line_time = g['line_time'] * g['pixel_rate'] / pixel_rate
+    readout_time = line_time * ((height + 1) // 2)
+    frame_time = np.maximum(
+        1e-6 * np.asarray(exposure_time_microseconds), readout_time)
+    return 1 / frame_time
+
+def plan_roi(
+    required, target_fps=None, exposure_time_microseconds=0,
+    pco_edge_type='4.2', pixel_rate=None):
+    """
+    The smallest legal ROI that contains every pixel of 'required' (a
+    ROI dict; arrays for many candidates at once), and how fast it
+    runs. Unlike legalize_roi(), which snaps to the nearest legal ROI,
+    this always grows: left rounds down, right rounds up, and top and
+    bottom move out symmetrically to cover whichever is further from
+    the centre. Requests that run off the sensor are clipped to it.
+
+    Returns a dict with:
+    * 'roi': the planned ROI.
+    * 'frame_rate': frames per second at 'exposure_time_microseconds'.
+      The default of 0 gives the readout-limited maximum.
+    * 'max_exposure_microseconds': the longest exposure that still
+      keeps up with 'target_fps', or 0 if the readout alone is too
+      slow. Only if you give a 'target_fps'...
+    * 'meets_target': ...as is this, whether 'frame_rate' reaches it.
+    """
+    g = sensor_geometry[pco_edge_type]
+    step = g['step_lr']
+    scalar = all(np.ndim(required[k]) == 0
+                 for k in ('left', 'top', 'right', 'bottom'))
+    r = _roi_arrays(required)
+    left = np.clip(r['left'], 1, g['max_lr'] - g['min_width'] + 1)
+    left = 1 + step*((left - 1) // step)
+    right = left - 1 + step*(-((left - 1 - r['right']) // step)) #Ceiling
+    right = np.clip(right, left + g['min_width'] - 1, g['max_lr'])
+    top = np.minimum(r['top'], g['max_ud'] - r['bottom'] + 1)
+    top = np.clip(top, 1, (g['max_ud'] - g['min_height'])//2 + 1)
+    bottom = g['max_ud'] - top + 1
+    roi = {'left': left, 'top': top, 'right': right, 'bottom': bottom}
+    plan = {'roi': _roi_result(roi, scalar),
+            'frame_rate': estimate_frame_rate(
+                roi, exposure_time_microseconds, pco_edge_type, pixel_rate,
+                legalize=False)}
+    if target_fps is not None:
+        readout_time = 1 / estimate_frame_rate(
+            roi, 0, pco_edge_type, pixel_rate, legalize=False)
+        plan['max_exposure_microseconds'] = np.where(
+            readout_time <= 1 / np.asarray(target_fps),
+            np.floor(1e6 / np.asarray(target_fps)), 0).astype(np.int64)
+        plan['meets_target'] = plan['frame_rate'] >= target_fps
+    for k in ('frame_rate', 'max_exposure_microseconds', 'meets_target'):
+        if k in plan and np.ndim(plan[k]) == 0:
+            plan[k] = plan[k].item()
+    return plan
+
+"""
+Ways for record_to_memory() to wait for the camera to fill a buffer.
+Each strategy fills in a FrameTelemetry as it goes, so you can compare
+them on your own rig and pick one.
+"""
+class FrameTelemetry:
+    """
+    What happened to each frame of a recording, in preallocated arrays
+    (filling them in costs about a microsecond per frame). Long or
+    open-ended acquisitions wrap around, keeping the most recent
+    'length' frames. One entry per frame:
+     * 'frame_index': which frame of the recording this entry is
+     * 'ready_time': time.perf_counter() when we got the buffer, for
+       lining up frames from several cameras
+     * 'wait_time': seconds between starting to wait and getting a buffer
+     * 'cpu_time': CPU seconds our thread burned while waiting
+     * 'wake_latency': upper bound on how late we noticed the buffer;
+       the time since our last look that found it not ready (zero if
+       it was ready the first time we looked).
+     * 'num_polls', 'num_sleeps': how often we asked, and slept
+     * 'copy_time': seconds from getting the buffer to handing it back
+       to the driver (checking, copying and/or reducing the frame)
+     * 'driver_status': the driver status of the buffer (0 is good)
+
+    summary(), percentiles(), histogram() and timeline() boil these
+    down after the run.
+    """
+    def __init__(self, num_images, strategy):
+        self.strategy = strategy
+        self.length = num_images
+        self.frame_index = np.zeros(num_images, dtype=np.int64)
+        self.ready_time = np.zeros(num_images)
+        self.wait_time = np.zeros(num_images)
+        self.cpu_time = np.zeros(num_images)
+        self.wake_latency = np.zeros(num_images)
+        self.num_polls = np.zeros(num_images, dtype=np.uint32)
+        self.num_sleeps = np.zeros(num_images, dtype=np.uint32)
+        self.copy_time = np.zeros(num_images)
+        self.driver_status = np.zeros(num_images, dtype=np.uint32)
+        self.num_frames = 0
+
+    def record_handling(self, which_im, driver_status):
+        """
+        Called once we're done with a buffer, after the wait strategy
+        recorded how we waited for it.
+        """
+        i = which_im % self.length
+        self.copy_time[i] = time.perf_counter() - self.ready_time[i]
+        self.driver_status[i] = driver_status
+        return None
+
+    def summary(self):
+        n = self.num_frames
+        if n == 0:
+            return {'strategy': self.strategy, 'num_frames': 0}
+        summary = {
+            'strategy': self.strategy,
+            'num_frames': n,
+            'cpu_time_per_frame': self.cpu_time[:n].mean(),
+            'cpu_fraction': self.cpu_time[:n].sum() / max(
+                self.wait_time[:n].sum(), 1e-12),
+            'mean_wake_latency': self.wake_latency[:n].mean(),
+            'max_wake_latency': self.wake_latency[:n].max(),
+            'polls_per_frame': self.num_polls[:n].mean(),
+            'sleeps_per_frame': self.num_sleeps[:n].mean(),
+            'mean_copy_time': self.copy_time[:n].mean(),
+            'max_copy_time': self.copy_time[:n].max(),
+            'num_bad_driver_status': int(np.count_nonzero(
+                self.driver_status[:n]))}
+        for name in ('wait_time', 'wake_latency', 'copy_time'):
+            for p, v in zip((50, 99), self.percentiles(name, (50, 99))):
+                summary['p%i_%s'%(p, name)] = v
+        return summary
+
+    def percentiles(self, name='wake_latency', q=(50, 90, 99, 99.9)):
+        """
+        Percentiles of one of the per-frame arrays, e.g. 'copy_time'.
+        """
+        return np.percentile(getattr(self, name)[:self.num_frames], q)
+
+    def histogram(self, name='wake_latency', bins_per_decade=10,
+                  smallest=1e-6, largest=10):
+        """
+        Counts of one of the per-frame time arrays, in log-spaced bins
+        from 'smallest' to 'largest' seconds (values outside go in the
+        end bins). Returns (counts, bin_edges), like np.histogram().
+        """
+        num_decades = np.log10(largest / smallest)
+        edges = np.logspace(np.log10(smallest), np.log10(largest),
+                            int(round(bins_per_decade * num_decades)) + 1)
+        values = np.clip(getattr(self, name)[:self.num_frames],
+                         smallest, largest)
+        return np.histogram(values, edges)
+
+    def timeline(self):
+        """
+        The per-frame arrays in frame order (which matters once we've
+        wrapped around), with 'ready_time' in seconds since the first
+        frame we still have.
+        """
+        order = np.argsort(self.frame_index[:self.num_frames], kind='stable')
+        timeline = {name: getattr(self, name)[order] for name in (
+            'frame_index', 'ready_time', 'wait_time', 'cpu_time',
+            'wake_latency', 'num_polls', 'num_sleeps', 'copy_time',
+            'driver_status')}
+        if order.size:
+            timeline['ready_time'] -= timeline['ready_time'][0]
+        return timeline
+
+class BusyPoll:
+    """
+    Hassle the camera until it gives us a buffer. For short exposures,
+    we poll super frequently. For long exposures (over 30 ms), we use
+    time.sleep() between polls to save CPU. This is the original
+    record_to_memory() behavior; it has the lowest latency, but it
+    pins a whole core on short exposures.
+    """
+    name = 'busy_poll'
+
+    def __init__(self, poll_timeout=5e5, sleep_timeout=20):
+        self.poll_timeout = poll_timeout
+        self.sleep_timeout = sleep_timeout
+
+    def start(self, camera, num_images):
+        self.camera = camera
+        self.telemetry = FrameTelemetry(num_images, self.name)
+        self._sleep_time = None
+        if camera.exposure_time_microseconds > 30e3:
+            self._sleep_time = camera.exposure_time_microseconds * 5e-8
+        return None
+
+    def wait(self, which_im, num_acquired):
+        camera, telemetry = self.camera, self.telemetry
+        num_polls = 0
+        num_sleeps = 0
+        start_time = time.perf_counter()
+        start_cpu = time.thread_time()
+        last_look = start_time
+        while True:
+            """
+            Check if a buffer is ready
+            """
+            num_polls += 1
+            look = time.perf_counter()
+            if camera._buffer_is_ready():
+                break
+            last_look = look
+            if self._sleep_time is not None:
+                time.sleep(self._sleep_time)
+                num_sleeps += 1
+            """
+            At some point we have to admit we probably missed a
+            trigger, and give up. Give up after too many polls
+            (likely triggered by short exposures) or too many sleeps
+            (likely triggered by long exposures)
+            """
+            if num_polls > self.poll_timeout or num_sleeps > self.sleep_timeout:
+                elapsed_time = time.perf_counter() - start_time
+                camera.events.record('timeout', which_im, 1e3 * elapsed_time)
+                raise TimeoutError(
+                    "After %i polls and %0.3f seconds, no buffer."%(
+                        num_polls, elapsed_time),
+                    num_acquired=num_acquired)
+        _record_wait(telemetry, which_im, start_time, start_cpu,
+                     look - last_look, num_polls, num_sleeps)
+        return camera.added_buffers.pop(0) #Removed from queue
+
+class AdaptiveBackoff:
+    """
+    Sleep through most of the expected frame interval, then poll with
+    exponentially growing sleeps. The expected interval starts at
+    'frame_interval' (seconds; default is the exposure time) and tracks
+    the measured interval between buffers as we go, so it also works
+    for externally triggered or readout-limited acquisition.
+
+    Wake-up latency is at most one backoff step, which is capped at
+    'max_sleep_fraction' of the frame interval.
+    """
+    name = 'adaptive_backoff'
+
+    def __init__(
+        self,
+        frame_interval=None,
+        first_sleep_fraction=0.8,
+        min_sleep=50e-6,
+        max_sleep_fraction=0.05,
+        timeout=None,
+        ):
+        assert 0 <= first_sleep_fraction < 1
+        assert 0 < max_sleep_fraction < 1
+        self.frame_interval = frame_interval
+        self.first_sleep_fraction = first_sleep_fraction
+        self.min_sleep = min_sleep
+        self.max_sleep_fraction = max_sleep_fraction
+        self.timeout = timeout
+
+    def start(self, camera, num_images):
+        self.camera = camera
+        self.telemetry = FrameTelemetry(num_images, self.name)
+        self.interval = self.frame_interval
+        if self.interval is None:
+            self.interval = camera.exposure_time_microseconds * 1e-6
+        self._last_ready = None
+        return None
+
+    def wait(self, which_im, num_acquired):
+        camera, telemetry = self.camera, self.telemetry
+        num_polls, num_sleeps = 1, 0
+        start_time = time.perf_counter()
+        start_cpu = time.thread_time()
+        timeout = self.timeout
+        if timeout is None:
+            timeout = max(5, 20 * self.interval)
+        last_look = look = start_time
+        if not camera._buffer_is_ready():
+            """
+            Sleep through most of the frame interval in one go...
+            """
+            if self._last_ready is not None:
+                nap = (self._last_ready + self.first_sleep_fraction *
+                       self.interval - time.perf_counter())
+                if nap > 0:
+                    time.sleep(nap)
+                    num_sleeps += 1
+            """
+            ...then poll, backing off exponentially up to a cap.
+            """
+            sleep_time = self.min_sleep
+            max_sleep = max(self.min_sleep,
+                            self.max_sleep_fraction * self.interval)
+            while True:
+                num_polls += 1
+                look = time.perf_counter()
+                if camera._buffer_is_ready():
+                    break
+                last_look = look
+                if look - start_time > timeout:
+                    camera.events.record(
+                        'timeout', which_im, 1e3 * (look - start_time))
+                    raise TimeoutError(
+                        "After %i polls and %0.3f seconds, no buffer."%(
+                            num_polls, look - start_time),
+                        num_acquired=num_acquired)
+                time.sleep(sleep_time)
+                num_sleeps += 1
+                sleep_time = min(2 * sleep_time, max_sleep)
+        now = time.perf_counter()
+        if self._last_ready is not None: #Track the real frame interval
+            self.interval = 0.9 * self.interval + 0.1 * (now - self._last_ready)
+        self._last_ready = now
+        _record_wait(telemetry, which_im, start_time, start_cpu,
+                     look - last_look, num_polls, num_sleeps)
+        return camera.added_buffers.pop(0) #Removed from queue
+
+class EventWait:
+    """
+    Block on the Windows event that the driver signals when a buffer
+    fills (the 'buffer_event' handle that PCO_AllocateBuffer hands back
+    in arm()). Uses essentially no CPU while waiting; the OS wakes us
+    up. Wake-up latency here is the time between the event firing and
+    the driver confirming the buffer status.
+    """
+    name = 'event'
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+
+    def start(self, camera, num_images):
+        self.camera = camera
+        self.telemetry = FrameTelemetry(num_images, self.name)
+        timeout = self.timeout
+        if timeout is None:
+            timeout = max(5, 20e-6 * camera.exposure_time_microseconds)
+        self._timeout_ms = int(1000 * timeout)
+        return None
+
+    def wait(self, which_im, num_acquired):
+        camera, telemetry = self.camera, self.telemetry
+        num_polls, num_sleeps = 1, 0
+        start_time = time.perf_counter()
+        start_cpu = time.thread_time()
+        last_look = look = start_time
+        while not camera._buffer_is_ready():
+            result = dll.wait_for_event(
+                camera.buffer_events[camera.added_buffers[0]],
+                self._timeout_ms)
+            num_sleeps += 1
+            last_look = time.perf_counter()
+            if result != WAIT_OBJECT_0:
+                camera.events.record(
+                    'timeout', which_im, 1e3 * (last_look - start_time))
+                raise TimeoutError(
+                    "After waiting %0.3f seconds for event, no buffer."%(
+                        last_look - start_time),
+                    num_acquired=num_acquired)
+            num_polls += 1
+            look = time.perf_counter()
+        _record_wait(telemetry, which_im, start_time, start_cpu,
+                     look - last_look, num_polls, num_sleeps)
+        return camera.added_buffers.pop(0) #Removed from queue
+
+def _record_wait(telemetry, which_im, start_time, start_cpu,
+                 wake_latency, num_polls, num_sleeps):
+    i = which_im % telemetry.length
+    telemetry.frame_index[i] = which_im
+    telemetry.ready_time[i] = time.perf_counter()
+    telemetry.wait_time[i] = telemetry.ready_time[i] - start_time
+    telemetry.cpu_time[i] = time.thread_time() - start_cpu
+    telemetry.wake_latency[i] = wake_latency
+    telemetry.num_polls[i] = num_polls
+    telemetry.num_sleeps[i] = num_sleeps
+    telemetry.num_frames = min(which_im + 1, telemetry.length)
+    return None
+
+wait_strategies = {
+    'busy_poll': BusyPoll,
+    'adaptive_backoff': AdaptiveBackoff,
+    'event': EventWait}
+
+def _stoppable(wait_strategy):
+    """
+    Look up a wait strategy by name for one of Edge's background
+    threads. The ones that can time out give up every 0.25 s without a
+    frame (e.g. waiting on an external trigger), so the thread gets to
+    check if it's stopping, and stopping it never takes long.
+    """
+    if wait_strategy in ('adaptive_backoff', 'event'):
+        return wait_strategies[wait_strategy](timeout=0.25)
+    if wait_strategy in wait_strategies:
+        return wait_strategies[wait_strategy]()
+    return wait_strategy
+
+class _ThreadTarget:
+    """
+    What one of Edge's background threads fills: FrameRing, HistoryRing,
+    SharedFrameRing or LivePreview. The thread checks 'stopping'
+    between frames, and calls finish() when it's done (with the
+    exception that ended it, if any), which wakes anyone waiting on
+    the condition for a frame.
+    """
+    def __init__(self):
+        self.stopping = False
+        self.finished = False
+        self.error = None
+        self._condition = threading.Condition()
+
+    def stop(self):
+        with self._condition:
+            self.stopping = True
+            self._condition.notify_all()
+        return None
+
+    def finish(self, error=None):
+        with self._condition:
+            self.finished = True
+            self.error = error
+            self._condition.notify_all()
+        return None
+
+class FrameRing(_ThreadTarget):
+    """
+    A preallocated ring of frame slots, filled by Edge's acquisition
+    thread and emptied by one consumer. get() hands out a view of a
+    slot, and get_batch() a view of several consecutive slots; either
+    way, they're only reused after the consumer's next get.
+    """
+    def __init__(self, num_slots, height, width, overflow='block',
+                 dtype=np.uint16):
+        assert num_slots >= 2
+        assert overflow in ('block', 'drop')
+        self.slots = aligned_zeros((num_slots, height, width), dtype)
+        self.frame_numbers = np.zeros(num_slots, dtype=np.int64)
+        self.overflow = overflow
+        self.num_written = 0
+        self.num_read = 0
+        self.num_released = 0
+        self.num_overflows = 0
+        _ThreadTarget.__init__(self)
+
+    def depth(self):
+        """
+        How many frames are waiting for the consumer.
+        """
+        return self.num_written - self.num_read
+
+    def _has_room(self):
+        return self.num_written - self.num_released < len(self.slots)
+
+    def claim(self):
+        """
+        The next slot to write into, or None if the frame should be
+        dropped (ring full with overflow='drop', or we're stopping).
+        """
+        with self._condition:
+            if not self._has_room():
+                self.num_overflows += 1
+                if self.overflow == 'drop':
+                    return None
+                self._condition.wait_for(
+                    lambda: self._has_room() or self.stopping)
+                if self.stopping:
+                    return None
+            return self.slots[self.num_written % len(self.slots)]
+
+    def commit(self, frame_number):
+        with self._condition:
+            self.frame_numbers[self.num_written % len(self.slots)] = (
+                frame_number)
+            self.num_written += 1
+            self._condition.notify_all()
+        return None
+
+    def get(self, timeout=None):
+        batch = self.get_batch(1, timeout)
+        return None if batch is None else batch[0]
+
+    def get_batch(self, max_frames, timeout=None):
+        """
+        Up to 'max_frames' consecutive frames as one (n, height, width)
+        view, or None once we're finished and empty. Batches never wrap
+        around the end of the ring, so each is contiguous in memory.
+        """
+        with self._condition:
+            self.num_released = self.num_read #Done with the last batch
+            self._condition.notify_all()
+            if not self._condition.wait_for(
+                lambda: (self.num_read < self.num_written or
+                         self.finished or self.error is not None),
+                timeout):
+                raise TimeoutError(
+                    "No frame after %0.3f seconds."%(timeout),
+                    num_acquired=self.num_read)
+            if self.error is not None:
+                error, self.error = self.error, None
+                raise error
+            if self.num_read == self.num_written: #Finished and empty
+                return None
+            slot = self.num_read % len(self.slots)
+            count = min(max_frames,
+                        self.num_written - self.num_read,
+                        len(self.slots) - slot)
+            self.num_read += count
+            return self.slots[slot:slot + count]
+
+class HistoryRing(_ThreadTarget):
+    """
+    A preallocated ring that Edge's acquisition thread overwrites, oldest
+    frame first, so it always holds the latest frames. See
+    Edge.start_history() and Edge.capture_event().
+
+    trigger() marks an event; once the frames after it are in, the ring
+    freezes: the thread keeps the camera going but throws frames away,
+    so the window around the event can't be overwritten while we save()
+    it. resume() starts the history rolling again.
+    """
+    def __init__(self, num_slots, height, width, dtype=np.uint16):
+        assert num_slots >= 2
+        self.slots = aligned_zeros((num_slots, height, width), dtype)
+        self.frame_numbers = np.zeros(num_slots, dtype=np.int64)
+        self.ready_times = np.zeros(num_slots)
+        self.num_written = 0
+        self.num_overflows = 0 #Always 0; we overwrite instead
+        self.num_frozen_out = 0 #Frames thrown away while frozen
+        self.frozen = False
+        self._window = None #(start, event, end) positions, once triggered
+        _ThreadTarget.__init__(self)
+
+    def claim(self):
+        if self.frozen:
+            self.num_frozen_out += 1
+            return None
+        return self.slots[self.num_written % len(self.slots)]
+
+    def commit(self, frame_number):
+        with self._condition:
+            slot = self.num_written % len(self.slots)
+            self.frame_numbers[slot] = frame_number
+            self.ready_times[slot] = time.perf_counter()
+            self.num_written += 1
+            window = self._window
+            if window is not None and self.num_written >= window[2]:
+                self.frozen = True
+                self._condition.notify_all()
+        return None
+
+    def _position(self, frame_number):
+        """
+        Where 'frame_number' is (or will be) in the stream of frames
+        we've written. Freezing leaves gaps in the frame numbers, so we
+        look it up.
+        """
+        n = len(self.slots)
+        positions = np.arange(max(0, self.num_written - n + 1),
+                              self.num_written)
+        if positions.size == 0:
+            return self.num_written
+        numbers = self.frame_numbers[positions % n]
+        if frame_number > numbers[-1]: #Still to come
+            return self.num_written + int(frame_number - numbers[-1]) - 1
+        return int(positions[min(np.searchsorted(numbers, frame_number),
+                                 positions.size - 1)])
+
+    def trigger(self, frames_before, frames_after=0, frame_number=None):
+        """
+        Mark an event at 'frame_number' (default: the next frame), to
+        keep 'frames_before' frames before it and 'frames_after' frames
+        from it on. If the ring no longer holds all the frames before,
+        we keep what it has.
+        """
+        n = len(self.slots)
+        assert frames_before >= 0 and frames_after >= 0
+        assert frames_before + frames_after <= n - 1
+        with self._condition:
+            assert self._window is None, "Already triggered; resume() first"
+            event = self.num_written
+            if frame_number is not None:
+                event = self._position(frame_number)
+            """
+            The slot after the newest frame might be mid-overwrite, so
+            the oldest frame we can count on is one newer than that.
+            """
+            start = max(event - frames_before, self.num_written - n + 1, 0)
+            end = event + frames_after
+            self._window = (start, event, end)
+            if self.num_written >= end:
+                self.frozen = True
+                self._condition.notify_all()
+        return None
+
+    def wait(self, timeout=None):
+        """
+        Block until the frames after the event are in and we're frozen
+        (or the acquisition ended first, in which case we keep what we
+        got).
+        """
+        with self._condition:
+            if not self._condition.wait_for(
+                lambda: self.frozen or self.finished, timeout):
+                raise TimeoutError(
+                    "Not frozen after %0.3f seconds."%(timeout),
+                    num_acquired=self.num_written)
+            if self.error is not None:
+                raise self.error
+        return None
+
+    def window(self):
+        """
+        The frames around the event, in order, as a copy, and their
+        frame numbers. Only valid once frozen; see wait().
+        """
+        start, event, end = self._window
+        positions = np.arange(start, min(end, self.num_written))
+        slots = positions % len(self.slots)
+        return self.slots[slots], self.frame_numbers[slots]
+
+    def save(self, path):
+        """
+        Write the frames around the event to 'path', in the same format
+        as Edge.record_to_file(), with a couple of big writes straight
+        from the ring (two if the window wraps around its end). The
+        header also has 'event_index', the event's position in the
+        file. Returns throughput stats.
+        """
+        assert self.frozen or self.finished
+        start_time = time.perf_counter()
+        start, event, end = self._window
+        end = min(end, self.num_written)
+        n = len(self.slots)
+        chunks = [(start % n, min(end - start, n - start % n))]
+        if chunks[0][1] < end - start: #Wraps around
+            chunks.append((0, end - start - chunks[0][1]))
+        frame_numbers = np.concatenate(
+            [self.frame_numbers[i:i + count] for i, count in chunks])
+        with open(path, 'wb', buffering=0) as f:
+            _write_raw_header(f, self.slots, len(frame_numbers))
+            bytes_written = 0
+            for i, count in chunks:
+                f.write(memoryview(self.slots[i:i + count]).cast('B'))
+                bytes_written += self.slots[i:i + count].nbytes
+            index_offset = RawFileWriter.header_size + bytes_written
+            f.write(frame_numbers.tobytes())
+            _write_raw_header(f, self.slots, len(frame_numbers),
+                              index_offset, event_index=event - start)
+        elapsed = time.perf_counter() - start_time
+        return {'frames_written': len(frame_numbers),
+                'frames_before': event - start,
+                'frames_after': end - event,
+                'event_frame_number': int(
+                    frame_numbers[min(event - start, len(frame_numbers) - 1)]),
+                'bytes_written': bytes_written,
+                'seconds': elapsed,
+                'mb_per_second': bytes_written / max(elapsed, 1e-9) / 1e6,
+                'num_writes': len(chunks)}
+
+    def resume(self):
+        with self._condition:
+            self._window = None
+            self.frozen = False
+        return None
+
+class SharedFrameRing(_ThreadTarget):
+    """
+    A ring of frame slots in multiprocessing.shared_memory, that Edge's
+    acquisition thread fills (see Edge.start_acquisition(publish_as=))
+    and any number of SharedFrameReaders, in any process, read without
+    copying.
+
+    The writer never waits for readers. Each slot has a sequence
+    number: the writer sets it to -1 while it's writing the slot, then
+    to the slot's position in the stream of published frames. Readers
+    compare sequence numbers to spot frames that got overwritten
+    before (or while) they read them.
+
+    Layout: an int64 header (see the indices below), then the sequence
+    number and camera frame number of each slot, then the frames,
+    starting on a page boundary.
+    """
+    MAGIC = 0x70636f72696e6731 #'pcoring1'
+    _MAGIC, _NUM_SLOTS, _HEIGHT, _WIDTH, _ITEMSIZE, _NUM_WRITTEN, _FINISHED = (
+        range(7))
+    _header_length = 8
+    _created = set() #Names of the rings this process has up right now
+
+    def __init__(self, name, num_slots, height, width, dtype=np.uint16):
+        from multiprocessing import shared_memory
+        assert num_slots >= 2
+        itemsize = np.dtype(dtype).itemsize
+        frames_offset = self._frames_offset(num_slots)
+        self.shm = shared_memory.SharedMemory(
+            name=name, create=True,
+            size=frames_offset + num_slots * height * width * itemsize)
+        self.name = self.shm.name
+        SharedFrameRing._created.add(self.name)
+        (self.header, self.slot_sequence, self.frame_numbers, self.slots
+         ) = self._views(self.shm, num_slots, height, width, dtype)
+        self.slot_sequence[:] = -1
+        self.header[:] = 0
+        self.header[self._NUM_SLOTS] = num_slots
+        self.header[self._HEIGHT], self.header[self._WIDTH] = height, width
+        self.header[self._ITEMSIZE] = itemsize
+        self.header[self._MAGIC] = self.MAGIC #Last, so readers see it whole
+        self.num_written = 0
+        self.num_overflows = 0 #Always 0; we overwrite instead
+        _ThreadTarget.__init__(self)
+
+    @classmethod
+    def _frames_offset(cls, num_slots):
+        header_bytes = 8 * (cls._header_length + 2 * num_slots)
+        return -(-header_bytes // 4096) * 4096
+
+    @classmethod
+    def _views(cls, shm, num_slots, height, width, dtype):
+        buf, n = shm.buf, cls._header_length
+        return (np.ndarray((n,), np.int64, buf),
+                np.ndarray((num_slots,), np.int64, buf, 8 * n),
+                np.ndarray((num_slots,), np.int64, buf, 8 * (n + num_slots)),
+                np.ndarray((num_slots, height, width), dtype, buf,
+                           cls._frames_offset(num_slots)))
+
+    def depth(self):
+        return 0 #We don't know where our readers are
+
+    def claim(self):
+        if self.stopping:
+            return None
+        slot = self.num_written % len(self.slots)
+        self.slot_sequence[slot] = -1 #Readers: hands off
+        return self.slots[slot]
+
+    def commit(self, frame_number):
+        slot = self.num_written % len(self.slots)
+        self.frame_numbers[slot] = frame_number
+        self.slot_sequence[slot] = self.num_written
+        self.num_written += 1
+        self.header[self._NUM_WRITTEN] = self.num_written
+        return None
+
+    def finish(self, error=None):
+        _ThreadTarget.finish(self, error)
+        self.header[self._FINISHED] = 1 #For readers in other processes
+        return None
+
+    def close(self):
+        """
+        Take the ring out of shared memory. Readers that are still
+        attached keep their mapping until they close() too.
+        """
+        if self.shm is None:
+            return None
+        self.header = self.slot_sequence = self.frame_numbers = None
+        self.slots = None
+        self.shm.close()
+        self.shm.unlink()
+        self.shm = None
+        SharedFrameRing._created.discard(self.name)
+        return None
+
+class SharedFrameReader:
+    """
+    Reads frames from a SharedFrameRing by name, typically in another
+    process:
+
+        reader = pco.SharedFrameReader('camera0')
+        while True:
+            frame = reader.get(timeout=1)
+            if frame is None: break #The acquisition is over
+            ...use frame...
+            if not reader.still_valid(): ...it got overwritten...
+
+    get() returns a view of the shared slot, not a copy, so the writer
+    can overwrite it if we take longer than the ring is long. That's
+    what still_valid() is for; copy the frame if you need to keep it.
+
+    If we fall more than a ring's worth behind, get() skips ahead to the
+    oldest frame still in the ring, and adds the frames we skipped to
+    self.num_missed.
+    """
+    def __init__(self, name, start='oldest', poll_interval=1e-4):
+        from multiprocessing import shared_memory
+        assert start in ('oldest', 'latest')
+        self.shm = shared_memory.SharedMemory(name=name)
+        if (os.name == 'posix' and
+            self.shm.name not in SharedFrameRing._created):
+            """
+            Python < 3.13 thinks every process that attaches owns the
+            segment, and would unlink it when we exit. It's the
+            writer's to unlink. If the writer is in this process, the
+            registration is the writer's, and close() needs it.
+            """
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+        header = np.ndarray((SharedFrameRing._header_length,), np.int64,
+                            self.shm.buf)
+        assert header[SharedFrameRing._MAGIC] == SharedFrameRing.MAGIC
+        num_slots = int(header[SharedFrameRing._NUM_SLOTS])
+        dtype = {2: np.uint16, 4: np.uint32}[
+            int(header[SharedFrameRing._ITEMSIZE])]
+        (self.header, self.slot_sequence, self.frame_numbers, self.slots
+         ) = SharedFrameRing._views(
+             self.shm, num_slots,
+             int(header[SharedFrameRing._HEIGHT]),
+             int(header[SharedFrameRing._WIDTH]), dtype)
+        del header
+        self.poll_interval = poll_interval
+        self.num_read = 0
+        self.num_missed = 0
+        self.frame_number = None #Camera frame number of the last get()
+        written = int(self.header[SharedFrameRing._NUM_WRITTEN])
+        if start == 'latest':
+            self._next = written
+        else:
+            self._next = max(0, written - (num_slots - 1))
+        self._last = None
+
+    def get(self, timeout=None):
+        """
+        The next frame, as a view into shared memory; or None once the
+        acquisition has finished and we've read everything.
+        """
+        num_slots = len(self.slots)
+        give_up = None if timeout is None else time.perf_counter() + timeout
+        while True:
+            written = int(self.header[SharedFrameRing._NUM_WRITTEN])
+            if written - self._next > num_slots - 1: #Too slow; skip ahead
+                skip_to = written - (num_slots - 1)
+                self.num_missed += skip_to - self._next
+                self._next = skip_to
+            if self._next < written:
+                slot = self._next % num_slots
+                if self.slot_sequence[slot] == self._next:
+                    frame_number = int(self.frame_numbers[slot])
+                    if self.slot_sequence[slot] == self._next:
+                        break
+                self._next += 1 #Overwritten under our nose
+                self.num_missed += 1
+                continue
+            if self.header[SharedFrameRing._FINISHED]:
+                return None
+            if give_up is not None and time.perf_counter() > give_up:
+                raise TimeoutError(
+                    "No frame after %0.3f seconds."%(timeout),
+                    num_acquired=self.num_read)
+            time.sleep(self.poll_interval)
+        self._last = self._next
+        self._next += 1
+        self.num_read += 1
+        self.frame_number = frame_number
+        return self.slots[slot]
+
+    def still_valid(self):
+        """
+        Is the frame from the last get() still intact? Check this after
+        using the frame, not before.
+        """
+        if self._last is None:
+            return False
+        slot = self._last % len(self.slots)
+        return self.slot_sequence[slot] == self._last
+
+    def close(self):
+        self.header = self.slot_sequence = self.frame_numbers = None
+        self.slots = None
+        self.shm.close()
+        return None
+
+class LivePreview(_ThreadTarget):
+    """
+    The newest frame from Edge's preview thread (see
+    Edge.start_preview()), for when only the newest frame matters.
+
+    Nothing gets copied. The thread holds on to the newest full driver
+    buffer, and as soon as a newer one fills, puts the old one straight
+    back in the driver queue, unread. latest() takes the held buffer
+    and returns a view of it, which stays out of the driver queue (so
+    it's safe to read) until the next latest(). However slow the
+    consumer, it always gets the newest frame there is; it just sees
+    fewer of them.
+
+    For the last 'history' frames latest() handed out, we keep:
+    * 'lag': seconds from the buffer filling to latest() returning it.
+      It counts the wait strategy's wake latency, so it's an upper
+      bound; exposure end is a readout time earlier still.
+    * 'frames_skipped': frames recycled unseen since the one before.
+    summary() boils these down.
+    """
+    def __init__(self, buffer_arrays, history=1000):
+        self.buffer_arrays = buffer_arrays
+        self.lag = np.zeros(history)
+        self.frames_skipped = np.zeros(history, dtype=np.int64)
+        self.num_frames = 0 #Frames the thread took from the driver
+        self.num_recycled = 0 #...and put back unseen
+        self.num_displayed = 0 #...and latest() handed out
+        self.frame_number = -1 #Of the frame latest() last returned
+        _ThreadTarget.__init__(self)
+        self._newest = None #(buffer number, frame number, ready time)
+        self._pinned = None #Buffer number of the frame we handed out
+        self._released = [] #Buffers for the thread to requeue
+        self._first_ready = self._last_ready = None
+
+    def publish(self, buffer_number, frame_number, ready_time):
+        """
+        Called by the preview thread with each new buffer. Returns the
+        buffers it should put back in the driver queue.
+        """
+        with self._condition:
+            requeue, self._released = self._released, []
+            if self._newest is not None: #Nobody looked at it
+                requeue.append(self._newest[0])
+                self.num_recycled += 1
+            self._newest = (buffer_number, frame_number, ready_time)
+            self.num_frames = frame_number + 1
+            if self._first_ready is None:
+                self._first_ready = ready_time
+            self._last_ready = ready_time
+            self._condition.notify_all()
+        return requeue
+
+    def take_released(self):
+        with self._condition:
+            released, self._released = self._released, []
+        return released
+
+    def release_all(self):
+        """
+        Every buffer we're holding, for stop_preview() to requeue.
+        Views from latest() are invalid after this.
+        """
+        with self._condition:
+            held = self._released + [
+                b for b in (self._pinned, self._newest and self._newest[0])
+                if b is not None]
+            self._released, self._pinned, self._newest = [], None, None
+        return held
+
+    def latest(self, timeout=None):
+        """
+        A view of the newest frame, waiting up to 'timeout' seconds for
+        one newer than the last we returned. None once the preview is
+        over.
+        """
+        with self._condition:
+            if not self._condition.wait_for(
+                lambda: (self._newest is not None or
+                         self.finished or self.error is not None),
+                timeout):
+                raise TimeoutError(
+                    "No frame after %0.3f seconds."%(timeout),
+                    num_acquired=self.num_displayed)
+            if self.error is not None:
+                error, self.error = self.error, None
+                raise error
+            if self._newest is None: #Finished
+                return None
+            if self._pinned is not None:
+                self._released.append(self._pinned)
+            self._pinned, frame_number, ready_time = self._newest
+            self._newest = None
+            i = self.num_displayed % len(self.lag)
+            self.lag[i] = time.perf_counter() - ready_time
+            self.frames_skipped[i] = frame_number - self.frame_number - 1
+            self.frame_number = frame_number
+            self.num_displayed += 1
+            return self.buffer_arrays[self._pinned]
+
+    def summary(self):
+        n = min(self.num_displayed, len(self.lag))
+        summary = {'num_frames': self.num_frames,
+                   'num_displayed': self.num_displayed,
+                   'num_recycled': self.num_recycled}
+        if self.num_frames > 1:
+            summary['frame_interval'] = (
+                (self._last_ready - self._first_ready) / (self.num_frames - 1))
+        if n > 0:
+            p50, p99 = np.percentile(self.lag[:n], (50, 99))
+            summary.update({
+                'mean_lag': self.lag[:n].mean(),
+                'p50_lag': p50,
+                'p99_lag': p99,
+                'max_lag': self.lag[:n].max(),
+                'mean_frames_skipped': self.frames_skipped[:n].mean()})
+            if 'frame_interval' in summary:
+                summary['p99_lag_frames'] = p99 / summary['frame_interval']
+        return summary
+
+class FrameTransform:
+    """
+    Crops, and optionally bins, frames on their way out of a driver
+    buffer. Calling it, as transform(frame, out), writes the result
+    into 'out', which has shape self.shape and dtype self.dtype. Make
+    one with Edge.frame_transform().
+
+    'roi' is the camera's ROI (what the frames cover), and 'crop' the
+    part of it to keep, both in sensor pixels. Whatever part of the
+    crop lies outside the ROI is cut off. See
+    Edge.frame_transform() for the rest. If the crop isn't a whole
+    number of bins, we drop the leftover rows and columns at the
+    bottom and right.
+    """
+    def __init__(self, roi, crop=None, binning=1, bin_mode='mean'):
+        assert binning >= 1
+        assert bin_mode in ('mean', 'sum')
+        if crop is None:
+            crop = roi
+        crop = {'left': max(crop['left'], roi['left']),
+                'top': max(crop['top'], roi['top']),
+                'right': min(crop['right'], roi['right']),
+                'bottom': min(crop['bottom'], roi['bottom'])}
+        height = (crop['bottom'] - crop['top'] + 1) // binning
+        width = (crop['right'] - crop['left'] + 1) // binning
+        assert height > 0 and width > 0
+        top, left = crop['top'] - roi['top'], crop['left'] - roi['left']
+        self._rows = slice(top, top + height * binning)
+        self._cols = slice(left, left + width * binning)
+        self.binning = binning
+        self.bin_mode = bin_mode
+        self.shape = (height, width)
+        self.dtype = np.uint16 if bin_mode == 'mean' else np.uint32
+        if binning > 1:
+            self._row_sums = np.zeros((height, width * binning), np.uint32)
+            self._bin_sums = np.zeros((height, width), np.uint32)
+
+    def __call__(self, frame, out):
+        frame = frame[self._rows, self._cols]
+        b = self.binning
+        if b == 1:
+            np.copyto(out, frame)
+            return out
+        """
+        Sum each group of 'b' rows first, while the data is contiguous,
+        then each group of 'b' columns. This is several times faster
+        than summing a (h, b, w, b) reshaped view over axes (1, 3).
+        """
+        h, w = self.shape
+        rows = frame.reshape(h, b, w * b)
+        np.add(rows[:, 0, :], rows[:, 1, :], out=self._row_sums,
+               dtype=np.uint32)
+        for i in range(2, b):
+            np.add(self._row_sums, rows[:, i, :], out=self._row_sums)
+        cols = self._row_sums.reshape(h, w, b)
+        np.add(cols[:, :, 0], cols[:, :, 1], out=self._bin_sums)
+        for i in range(2, b):
+            np.add(self._bin_sums, cols[:, :, i], out=self._bin_sums)
+        if self.bin_mode == 'mean':
+            np.floor_divide(self._bin_sums, b * b, out=out, casting='unsafe')
+        else:
+            np.copyto(out, self._bin_sums)
+        return out
+
+class FlatFieldCorrection:
+    """
+    Dark subtraction and flat-field gain correction:
+
+        corrected = (raw - dark) * gain
+
+    where gain = mean(flat) / flat normalizes each pixel's response to
+    the average. Pixels with no response in the flat get a gain of 0.
+    Make one with Edge.flat_field_correction().
+
+    Calling it, as correction(frame, out), writes the corrected uint16
+    frame into 'out', so it works as the 'transform' of
+    record_to_memory(), start_acquisition() or record_to_file(). Or
+    correct() a stack you already have, in place.
+
+    We precompute float32 'gain' and 'offset' (dark * gain) maps, so
+    each pixel is a multiply and a subtract, and work a band of
+    'block_rows' rows at a time so the float32 scratch stays in cache.
+    Converting the uint16 frame to float32 on its own, before the
+    multiply, is much faster than letting numpy mix the types. A full
+    4.2 frame takes about 9 ms on one core.
+    """
+    def __init__(self, dark, flat=None, block_rows=32):
+        self.dark = np.asarray(dark, dtype=np.float32)
+        self.flat = flat
+        self.shape = self.dark.shape
+        self.dtype = np.uint16
+        self.block_rows = block_rows
+        if flat is None:
+            self.gain = np.ones(self.shape, dtype=np.float32)
+        else:
+            response = np.asarray(flat, dtype=np.float32)
+            good = response > 0
+            assert good.any(), "The flat has no signal"
+            self.gain = np.zeros(self.shape, dtype=np.float32)
+            np.divide(response[good].mean(dtype=np.float64), response,
+                      out=self.gain, where=good)
+        """
+        Fold the 0.5 for rounding into the offset, so the final cast
+        (which truncates) rounds to nearest.
+        """
+        self.offset = self.dark * self.gain - np.float32(0.5)
+        self._scratch = np.zeros((block_rows, self.shape[1]), np.float32)
+
+    def __call__(self, frame, out):
+        assert frame.shape == self.shape
+        height = self.shape[0]
+        for r in range(0, height, self.block_rows):
+            rows = slice(r, min(r + self.block_rows, height))
+            x = self._scratch[:rows.stop - r]
+            np.copyto(x, frame[rows], casting='unsafe')
+            np.multiply(x, self.gain[rows], out=x)
+            np.subtract(x, self.offset[rows], out=x)
+            np.clip(x, 0, 65535, out=x)
+            np.copyto(out[rows], x, casting='unsafe')
+        return out
+
+    def correct(self, frames):
+        """
+        Correct a uint16 frame, or a (n, height, width) stack of them,
+        in place. Returns 'frames'.
+        """
+        if frames.ndim == 2:
+            return self(frames, frames)
+        for frame in frames:
+            self(frame, frame)
+        return frames
+
+def subsampled_percentile(frame, q, max_samples=65536, bin_shift=4):
+    """
+    The 'q'th percentile of a uint16 frame, estimated from a histogram
+    of every n-th pixel of every n-th row, with n chosen so we look at
+    no more than 'max_samples' pixels. Bins are 2**'bin_shift' counts
+    wide, and we return the middle of the bin. For a full 4.2 frame at
+    the defaults, that's well under a millisecond, vs. tens of ms for
+    np.percentile() of the whole frame.
+    """
+    stride = max(1, int(np.ceil(np.sqrt(frame.size / max_samples))))
+    sample = frame[::stride, ::stride]
+    counts = np.bincount(np.right_shift(sample, bin_shift).ravel(),
+                         minlength=65536 >> bin_shift)
+    cumulative = np.cumsum(counts)
+    i = np.searchsorted(cumulative, 0.01 * q * cumulative[-1])
+    return (i + 0.5) * (1 << bin_shift)
+
+class FrameReducer:
+    """
+    Running reductions over a stream of uint16 frames, in memory that
+    doesn't grow with the number of frames. add() each frame as it
+    arrives, then ask for result().
+
+    Sums are exact. Each frame goes into a uint32 sum for the current
+    block of frames (it can't overflow in under 65537 frames, and it's
+    more than twice as fast to add into as uint64), and each block is
+    added into a uint64 total. For 'var' and 'std', we also keep an
+    exact sum of squares per block, and merge each block's mean and
+    variance into the running totals in float64 (Chan et al.'s pairwise
+    form of Welford's update). That's two integer adds per frame
+    instead of Welford's several float64 passes, without the
+    cancellation you'd get from one big sum of squares.
+    """
+    names = ('sum', 'mean', 'max', 'min', 'var', 'std')
+
+    def __init__(self, height, width, reductions=('mean',), block_size=1024):
+        for r in reductions:
+            assert r in self.names, "Unknown reduction: %s"%r
+        assert 1 <= block_size <= 65537
+        self.reductions = tuple(reductions)
+        self.block_size = block_size
+        self.num_frames = 0
+        self._num_in_block = 0
+        shape = (height, width)
+        wants = set(reductions)
+        self._block_sum = self._max = self._min = self._sum_sq = None
+        if wants & {'sum', 'mean', 'var', 'std'}:
+            self._block_sum = np.zeros(shape, dtype=np.uint32)
+            self._sum = np.zeros(shape, dtype=np.uint64)
+        if 'max' in wants:
+            self._max = np.zeros(shape, dtype=np.uint16)
+        if 'min' in wants:
+            self._min = np.full(shape, 0xffff, dtype=np.uint16)
+        if wants & {'var', 'std'}:
+            self._sum_sq = np.zeros(shape, dtype=np.uint64)
+            self._square = np.zeros(shape, dtype=np.uint32)
+            self._mean = np.zeros(shape)
+            self._m2 = np.zeros(shape) #Sum of squared deviations
+
+    def add(self, frame):
+        if self._block_sum is not None:
+            np.add(self._block_sum, frame, out=self._block_sum)
+        if self._max is not None:
+            np.maximum(self._max, frame, out=self._max)
+        if self._min is not None:
+            np.minimum(self._min, frame, out=self._min)
+        if self._sum_sq is not None:
+            np.multiply(frame, frame, out=self._square, dtype=np.uint32)
+            np.add(self._sum_sq, self._square, out=self._sum_sq)
+        self.num_frames += 1
+        self._num_in_block += 1
+        if self._num_in_block >= self.block_size:
+            self._end_block()
+        return None
+
+    def _end_block(self):
+        n_b = self._num_in_block
+        if n_b == 0 or self._block_sum is None:
+            return None
+        if self._sum_sq is not None:
+            mean_b = self._block_sum / n_b
+            m2_b = self._sum_sq - self._block_sum * mean_b
+            n_a, n = self.num_frames - n_b, self.num_frames
+            delta = mean_b - self._mean
+            self._mean += delta * (n_b / n)
+            self._m2 += m2_b + delta**2 * (n_a * n_b / n)
+            self._sum_sq.fill(0)
+        np.add(self._sum, self._block_sum, out=self._sum)
+        self._block_sum.fill(0)
+        self._num_in_block = 0
+        return None
+
+    def result(self):
+        """
+        A dict with one (height, width) array per reduction. 'sum' is
+        uint64, 'max' and 'min' are uint16, and the rest are float64.
+        'var' and 'std' are the population (ddof=0) versions.
+        """
+        assert self.num_frames > 0
+        self._end_block()
+        results = {}
+        for r in self.reductions:
+            if r == 'sum':
+                results[r] = self._sum.copy()
+            elif r == 'mean':
+                results[r] = self._sum / self.num_frames
+            elif r == 'max':
+                results[r] = self._max.copy()
+            elif r == 'min':
+                results[r] = self._min.copy()
+            elif r == 'var':
+                results[r] = np.maximum(self._m2, 0) / self.num_frames
+            elif r == 'std':
+                results[r] = np.sqrt(np.maximum(self._m2, 0) /
+                                     self.num_frames)
+        return results
+
+class RawFileWriter:
+    """
+    Drains a FrameRing to a raw file in a background thread. Used by
+    Edge.record_to_file(); see read_recording() for the file layout.
+    """
+    header_size = 4096 #Keeps the frames page-aligned in the file
+
+    def __init__(self, path, ring, max_write_frames=8):
+        self.path = path
+        self.ring = ring
+        self.max_write_frames = max_write_frames
+        self.frames_written = 0
+        self.bytes_written = 0
+        self.max_queue_depth = 0
+        self._queue_depth_sum = 0
+        self._num_writes = 0
+        self.error = None
+        self._thread = threading.Thread(target=self._write_all, daemon=True)
+
+    def start(self):
+        self._start_time = time.perf_counter()
+        self._thread.start()
+        return None
+
+    def join(self):
+        self._thread.join()
+        self._stop_time = time.perf_counter()
+        return None
+
+    def stats(self):
+        elapsed = getattr(self, '_stop_time', time.perf_counter()
+                          ) - self._start_time
+        return {
+            'frames_written': self.frames_written,
+            'bytes_written': self.bytes_written,
+            'seconds': elapsed,
+            'mb_per_second': self.bytes_written / max(elapsed, 1e-9) / 1e6,
+            'num_writes': self._num_writes,
+            'max_queue_depth': self.max_queue_depth,
+            'mean_queue_depth': (self._queue_depth_sum /
+                                 max(self._num_writes, 1)),
+            'num_overflows': self.ring.num_overflows}
+
+    def _write_header(self, f, index_offset=0):
+        return _write_raw_header(
+            f, self.ring.slots, self.frames_written, index_offset)
+
+    def _write_all(self):
+        frame_numbers = []
+        try:
+            with open(self.path, 'wb', buffering=0) as f:
+                self._write_header(f)
+                while True:
+                    depth = self.ring.depth()
+                    batch = self.ring.get_batch(self.max_write_frames)
+                    if batch is None:
+                        break
+                    self.max_queue_depth = max(self.max_queue_depth, depth)
+                    self._queue_depth_sum += depth
+                    first = (self.ring.num_read - len(batch)) % len(
+                        self.ring.slots)
+                    frame_numbers.extend(
+                        self.ring.frame_numbers[first:first + len(batch)])
+                    f.write(memoryview(batch).cast('B'))
+                    self.frames_written += len(batch)
+                    self.bytes_written += batch.nbytes
+                    self._num_writes += 1
+                index_offset = self.header_size + self.bytes_written
+                f.write(np.asarray(frame_numbers, dtype=np.int64).tobytes())
+                self._write_header(f, index_offset)
+        except Exception as e:
+            self.error = e
+            self.ring.stop() #Don't leave the acquisition blocked on us
+        return None
+
+def _write_raw_header(f, slots, num_frames, index_offset=0,
+                      format='pco_raw', **extra):
+    _, height, width = slots.shape
+    header = json.dumps({
+        'format': format,
+        'version': 1,
+        'dtype': slots.dtype.name,
+        'num_frames': num_frames,
+        'height': height,
+        'width': width,
+        'data_offset': RawFileWriter.header_size,
+        'index_offset': index_offset,
+        **extra}).encode('ascii')
+    assert len(header) < RawFileWriter.header_size
+    f.seek(0)
+    f.write(header.ljust(RawFileWriter.header_size, b'\0'))
+    return None
+
+class CompressedFileWriter(RawFileWriter):
+    """
+    Like RawFileWriter, but each frame is compressed on its own by a
+    pool of worker threads (zlib and lzma release the GIL, so threads
+    run in parallel without copying frames between processes).
+
+    * 'codec' is 'zlib' or 'lzma', at 'level' (default: 1 and 0, the
+      fastest, since we have to keep up with the camera).
+    * 'preprocess' makes the frames easier to compress. 'delta'
+      replaces each pixel by its difference from its left neighbour
+      (smooth images become mostly small numbers), and 'shuffle' puts
+      all the high bytes of a frame before all the low bytes (the high
+      bytes are mostly alike). 'delta+shuffle' does both; None, neither.
+
+    The file is a header, then one compressed chunk per frame, then an
+    index of (frame number, offset, size) per frame, so any frame can
+    be read without the others; see read_recording().
+    """
+    codecs = {'zlib': (zlib.compress, zlib.decompress, 1),
+              'lzma': (lambda data, level: lzma.compress(data, preset=level),
+                       lzma.decompress, 0)}
+
+    def __init__(self, path, ring, max_write_frames=8, codec='zlib',
+                 level=None, preprocess='delta+shuffle', num_workers=None):
+        RawFileWriter.__init__(self, path, ring, max_write_frames)
+        assert codec in self.codecs
+        assert preprocess in (None, 'delta', 'shuffle', 'delta+shuffle')
+        self.codec = codec
+        self.level = self.codecs[codec][2] if level is None else level
+        self.preprocess = preprocess
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self.raw_bytes_written = 0
+        self.max_worker_backlog = 0 #Frames handed to workers, not written
+        self._worker_backlog_sum = 0
+        self._compress_seconds = 0
+
+    def stats(self):
+        stats = RawFileWriter.stats(self)
+        stats.update({
+            'raw_bytes_written': self.raw_bytes_written,
+            'raw_mb_per_second': (self.raw_bytes_written /
+                                  max(stats['seconds'], 1e-9) / 1e6),
+            'compression_ratio': (self.raw_bytes_written /
+                                  max(self.bytes_written, 1)),
+            'max_worker_backlog': self.max_worker_backlog,
+            'mean_worker_backlog': (self._worker_backlog_sum /
+                                    max(self._num_writes, 1)),
+            'compress_seconds_per_frame': (self._compress_seconds /
+                                           max(self.frames_written, 1))})
+        return stats
+
+    def _write_header(self, f, index_offset=0):
+        return _write_raw_header(
+            f, self.ring.slots, self.frames_written, index_offset,
+            format='pco_compressed', codec=self.codec, level=self.level,
+            preprocess=self.preprocess)
+
+    def _compress(self, frame):
+        start = time.perf_counter()
+        data = self.codecs[self.codec][0](
+            _encode_frame(frame, self.preprocess), self.level)
+        return data, time.perf_counter() - start
+
+    def _write_all(self):
+        index = []
+        pending = deque() #(frame number, future), oldest first
+        max_pending = 4 * self.num_workers #Bounds our memory use
+        try:
+            with ThreadPoolExecutor(self.num_workers) as pool, open(
+                self.path, 'wb', buffering=0) as f:
+                self._write_header(f)
+                offset = self.header_size
+                def write_oldest():
+                    nonlocal offset
+                    frame_number, future = pending.popleft()
+                    data, seconds = future.result()
+                    f.write(data)
+                    index.append((frame_number, offset, len(data)))
+                    offset += len(data)
+                    self._compress_seconds += seconds
+                    self.frames_written += 1
+                    self.bytes_written += len(data)
+                while True:
+                    depth = self.ring.depth()
+                    batch = self.ring.get_batch(self.max_write_frames)
+                    if batch is None:
+                        break
+                    self.max_queue_depth = max(self.max_queue_depth, depth)
+                    self._queue_depth_sum += depth
+                    first = (self.ring.num_read - len(batch)) % len(
+                        self.ring.slots)
+                    """
+                    The ring only lends us its slots until the next
+                    get_batch(), so the workers get a copy; that's
+                    cheap next to compressing it.
+                    """
+                    for frame_number, frame in zip(
+                        self.ring.frame_numbers[first:first + len(batch)],
+                        batch.copy()):
+                        pending.append(
+                            (frame_number, pool.submit(self._compress, frame)))
+                    self.raw_bytes_written += batch.nbytes
+                    self.max_worker_backlog = max(
+                        self.max_worker_backlog, len(pending))
+                    self._worker_backlog_sum += len(pending)
+                    self._num_writes += 1
+                    while pending and (pending[0][1].done() or
+                                       len(pending) > max_pending):
+                        write_oldest()
+                while pending:
+                    write_oldest()
+                f.write(np.asarray(index, dtype=np.int64).tobytes())
+                self._write_header(f, offset)
+        except Exception as e:
+            self.error = e
+            self.ring.stop() #Don't leave the acquisition blocked on us
+        return None
+
+class CompressedRecording:
+    """
+    The frames of a compressed recording, as returned by
+    read_recording(). Index it like a (num_frames, height, width)
+    array; each frame is decompressed when you ask for it.
+    """
+    def __init__(self, path, header):
+        self.header = header
+        self.shape = (header['num_frames'], header['height'], header['width'])
+        self.dtype = np.dtype(header['dtype'])
+        self.index = np.fromfile(
+            path, dtype=np.int64, count=3 * header['num_frames'],
+            offset=header['index_offset']).reshape(-1, 3)
+        self._data = np.memmap(path, dtype=np.uint8, mode='r')
+        self._decompress = CompressedFileWriter.codecs[header['codec']][1]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, which):
+        if isinstance(which, slice):
+            return np.stack([self[i] for i in range(*which.indices(len(self)))]
+                            ).reshape((-1,) + self.shape[1:])
+        _, offset, size = self.index[which]
+        return _decode_frame(self._decompress(self._data[offset:offset + size]),
+                             self.shape[1:], self.dtype,
+                             self.header['preprocess'])
+
+    def __array__(self, dtype=None, copy=None):
+        frames = self[:]
+        return frames if dtype is None else frames.astype(dtype)
+
+def _encode_frame(frame, preprocess):
+    """
+    See CompressedFileWriter. Integer overflow in the delta wraps
+    around, and wraps back in _decode_frame(), so it's lossless.
+    """
+    if preprocess in ('delta', 'delta+shuffle'):
+        delta = np.empty_like(frame)
+        delta[:, 0] = frame[:, 0]
+        np.subtract(frame[:, 1:], frame[:, :-1], out=delta[:, 1:])
+        frame = delta
+    if preprocess in ('shuffle', 'delta+shuffle'):
+        frame = frame.view(np.uint8).reshape(-1, frame.itemsize).T
+    return np.ascontiguousarray(frame)
+
+def _decode_frame(data, shape, dtype, preprocess):
+    frame = np.frombuffer(data, dtype=np.uint8)
+    if preprocess in ('shuffle', 'delta+shuffle'):
+        frame = frame.reshape(dtype.itemsize, -1).T.copy()
+    frame = frame.view(dtype).reshape(shape)
+    if preprocess in ('delta', 'delta+shuffle'):
+        frame = np.cumsum(frame, axis=1, dtype=dtype)
+    return frame
+
+def read_recording(path):
+    """
+    Open a file from Edge.record_to_file(). Returns the frames as a
+    read-only (num_frames, height, width) memmap, and the frame number
+    of each one; gaps in the frame numbers are frames the pool dropped.
+    Compressed recordings come back as a CompressedRecording instead
+    of a memmap.
+    """
+    with open(path, 'rb') as f:
+        header = json.loads(
+            f.read(RawFileWriter.header_size).rstrip(b'\0').decode('ascii'))
+    if header['format'] == 'pco_compressed':
+        frames = CompressedRecording(path, header)
+        return frames, frames.index[:, 0].copy()
+    assert header['format'] == 'pco_raw'
+    shape = (header['num_frames'], header['height'], header['width'])
+    frames = np.memmap(path, dtype=header['dtype'], mode='r',
+                       offset=header['data_offset'], shape=shape)
+    frame_numbers = np.fromfile(
+        path, dtype=np.int64, count=header['num_frames'],
+        offset=header['index_offset'])
+    return frames, frame_numbers
+
+def decode_timestamps(frames):
+    """
+    Read the BCD frame counter and timestamp that the camera writes
+    into the first 14 pixels of each frame in 'binary' timestamp mode
+    (see Edge.apply_settings()). Works on one frame or a whole
+    (num_frames, height, width) stack in one pass, since it only
+    touches 14 pixels per frame; cheap enough to run on each batch as
+    it arrives, or on a finished recording (e.g. from read_recording()).
+
+    Returns a dict of arrays, one entry per frame:
+     * 'frame_number': the camera's image counter (starts at 1)
+     * 'time': when the camera stamped it, as numpy datetime64[us]
+     * 'valid': False where the pixels aren't a legal stamp (e.g.
+       timestamps were off), in which case the other entries are junk.
+    """
+    pixels = np.asarray(frames)[..., 0, :14].astype(np.int64)
+    tens, ones = pixels >> 4, pixels & 0xf
+    valid = ((pixels < 0x100) & (tens < 10) & (ones < 10)).all(axis=-1)
+    d = 10 * tens + ones #Two decimal digits per pixel
+    d = [d[..., i] for i in range(14)]
+    frame_number = ((d[0] * 100 + d[1]) * 100 + d[2]) * 100 + d[3]
+    year, month, day = d[4] * 100 + d[5], d[6], d[7]
+    hour, minute, second = d[8], d[9], d[10]
+    microseconds = (d[11] * 100 + d[12]) * 100 + d[13]
+    valid &= (frame_number > 0) & (1 <= month) & (month <= 12) & (day >= 1)
+    months = ((year - 1970) * 12 + month - 1).astype('datetime64[M]')
+    seconds = ((day - 1) * 24 + hour) * 3600 + minute * 60 + second
+    t = (months.astype('datetime64[us]') +
+         (seconds * 10**6 + microseconds).astype('timedelta64[us]'))
+    return {'frame_number': frame_number, 'time': t, 'valid': valid}
+
+def check_timestamps(timestamps, previous=None):
+    """
+    Look for dropped frames and timing jitter in the output of
+    decode_timestamps(). The camera counts every frame it exposes, so a
+    jump in the counter means we lost frames in between.
+
+    'previous' is the last frame of an earlier batch, as a
+    (frame_number, time) pair, so you can check a recording batch by
+    batch as it arrives; the result's 'last' is what to pass next time.
+
+    Returns a dict:
+     * 'num_frames', 'num_invalid': how many stamps, and how many we
+       couldn't read (those are ignored).
+     * 'num_dropped': total frames missing from the counter sequence.
+     * 'gaps': index of each frame that follows a gap, and 'gap_sizes':
+       how many frames are missing there. A size < 0 means the counter
+       went backwards (e.g. the camera was re-armed).
+     * 'intervals': seconds between consecutive stamps, per frame
+       (across a gap, divided by the number of frames spanned).
+     * 'interval_mean', 'jitter' (standard deviation) and
+       'max_deviation' of those intervals, in seconds.
+    """
+    valid = timestamps['valid']
+    index = np.flatnonzero(valid)
+    frame_number = timestamps['frame_number'][valid]
+    t = timestamps['time'][valid].astype(np.int64) #Microseconds
+    if previous is not None:
+        index = np.concatenate(([-1], index))
+        frame_number = np.concatenate(([previous[0]], frame_number))
+        t = np.concatenate(([np.int64(previous[1])], t))
+    steps = np.diff(frame_number)
+    gaps = np.flatnonzero(steps != 1)
+    forward = steps > 0
+    intervals = 1e-6 * np.diff(t)[forward] / steps[forward]
+    report = {
+        'num_frames': valid.size,
+        'num_invalid': int(valid.size - valid.sum()),
+        'num_dropped': int(np.sum(steps[steps > 1] - 1)),
+        'gaps': index[gaps + 1],
+        'gap_sizes': steps[gaps] - 1,
+        'intervals': intervals,
+        'interval_mean': intervals.mean() if intervals.size else np.nan,
+        'jitter': intervals.std() if intervals.size else np.nan,
+        'max_deviation': (np.abs(intervals - intervals.mean()).max()
+                          if intervals.size else np.nan),
+        'last': previous}
+    if frame_number.size:
+        report['last'] = (frame_number[-1], t[-1])
+    return report
+
+def aligned_zeros(shape, dtype=np.uint16, alignment=4096):
+    """
+    A zeroed numpy array whose data starts on an 'alignment'-byte
+    (default: page) boundary. Good for record_to_memory(zero_copy=True),
+    since the frame grabber DMAs straight into it.
+    """
+    dtype = np.dtype(dtype)
+    num_bytes = int(np.prod(shape)) * dtype.itemsize
+    raw = np.zeros(num_bytes + alignment, dtype=np.uint8)
+    offset = (-raw.ctypes.data) % alignment
+    return raw[offset:offset + num_bytes].view(dtype).reshape(shape)
 
 """
-A few types of exception we'll use during recording:
-"""
+A few types of exception we'll use during recording:
+"""
 class TimeoutError(Exception):
     def __init__(self, value, num_acquired=0):
         self.value = value
@@ -591,6 +3495,13 @@ class TimeoutError(Exception):
     def __str__(self):
         return repr(self.value)
 
+class AcquisitionCancelled(Exception):
+    def __init__(self, value, num_acquired=0):
+        self.value = value
+        self.num_acquired = num_acquired
+    def __str__(self):
+        return repr(self.value)
+
 class DMAError(Exception):
     def __init__(self, value):
         self.value = value
@@ -598,172 +3509,337 @@ class DMAError(Exception):
         return repr(self.value)
 
 """
-DLL management
+What EventLog records: each event's name, and how to format its two
+integer arguments. An event's code is its index here.
+"""
+"""
+What the camera's mode settings are called, by the number the camera
+uses for them.
+"""
+setting_names = {
+    'sensor_format': {0: "standard", 1: "extended"},
+    'trigger_mode': {0: "auto_trigger",
+                     1: "software_trigger",
+                     2: "external_trigger",
+                     3: "external_exposure"},
+    'storage_mode': {0: "recorder", 1: "FIFO_buffer"},
+    'recorder_submode': {0: "sequence", 1: "ring_buffer"},
+    'acquire_mode': {0: "auto", 1: "external_static", 2: "external_dynamic"},
+    'timestamp_mode': {0: "off", 1: "binary", 2: "binary+ascii", 3: "ascii"},
+    'time_base': {0: "ns", 1: "us", 2: "ms"}}
+
+def _setting_message(setting, label):
+    return lambda a, b: '%s: %s'%(label, setting_names[setting][a])
+
+"""
+Each event type: its name, its message (a format string for its two
+arguments, or a function of them), and how verbose an Edge has to be
+to print it: 1 for 'verbose', 2 for 'very_verbose'.
 """
-try:
-    dll = C.oledll.LoadLibrary("SC2_Cam")
+event_types = (
+    ('open', 'Opened camera number %i (-1: the first one found)', 1),
+    ('close', 'Camera closed', 1),
+    ('settings_reset', 'Full reset of all settings took %i us', 1),
+    ('settings_changed', 'Changed %i settings in %i us', 1),
+    ('arm', 'Armed: %i x %i pixels', 1),
+    ('disarm', 'Disarmed', 1),
+    ('record', 'Recording %i images (%i preframes)', 1),
+    ('recorded', 'Recorded %i images in %i us', 1),
+    ('cancelled', 'Cancelled after %i images', 1),
+    ('timeout', 'Timed out waiting for image %i, after %i ms', 1),
+    ('dma_error', 'DMA error (driver status 0x%08x)', 1),
+    ('driver_error', 'Driver status 0x%08x', 1),
+    ('acquisition_start', 'Background acquisition started (%i slots)', 1),
+    ('acquisition_stop',
+     'Background acquisition stopped: %i frames, %i overflows', 1),
+    ('preview_start', 'Live preview started (%i buffers)', 1),
+    ('preview_stop', 'Live preview stopped: %i frames, %i displayed', 1),
+    ('event_saved', 'Saved %i frames around frame %i', 1),
+    ('auto_exposure', 'Auto-exposure settled on %i us after %i frames', 1),
+    ('auto_exposure_failed',
+     'Auto-exposure gave up at %i us after %i frames', 1),
+    ('file_written', lambda a, b:
+     'Wrote at %0.1f MB/s (max queue depth %i)'%(a / 1000, b), 1),
+    ('compression', lambda a, b:
+     'Compression ratio %0.2f (max worker backlog %i)'%(a / 1000, b), 1),
+    ('buffer_allocated', 'Buffer %i allocated (%i bytes)', 2),
+    ('buffer_freed', 'Buffer %i freed', 2),
+    ('refresh', 'Reading every setting from the camera', 1),
+    ('camera_health', lambda a, b:
+     'Camera health: warnings 0x%x, errors 0x%x%s'%(
+         a, b, '' if a == b == 0 else ' ***BAD***'), 1),
+    ('camera_status', 'Camera status: 0x%x', 1),
+    ('temperature', lambda a, b:
+     'Temperatures: CCD %0.1f C, camera %i C'%(a / 10, b), 1),
+    ('power_supply_temperature', 'Power supply temperature: %i C', 1),
+    ('sensor_format', _setting_message('sensor_format', 'Sensor format'), 2),
+    ('trigger_mode', _setting_message('trigger_mode', 'Trigger mode'), 1),
+    ('storage_mode', _setting_message('storage_mode', 'Storage mode'), 2),
+    ('recorder_submode',
+     _setting_message('recorder_submode', 'Recorder submode'), 2),
+    ('acquire_mode', _setting_message('acquire_mode', 'Acquire mode'), 2),
+    ('timestamp_mode',
+     _setting_message('timestamp_mode', 'Timestamp mode'), 2),
+    ('pixel_rate', 'Pixel rate: %i Hz', 2),
+    ('exposure_time', lambda a, b:
+     'Exposure: %i %s'%(a, setting_names['time_base'][b]), 1),
+    ('delay_time', lambda a, b:
+     'Delay: %i %s'%(a, setting_names['time_base'][b]), 2),
+    ('roi_left_right', 'Camera ROI: pixels %i to %i (left/right)', 1),
+    ('roi_top_bottom', 'Camera ROI: pixels %i to %i (up/down)', 1),
+    ('roi_adjusted', 'Requested ROI adjusted to match the camera', 1),
+    )
+event_codes = {name: code for code, (name, _, _) in enumerate(event_types)}
+
+class EventLog:
+    """
+    A preallocated ring of the last 'capacity' camera events (arming,
+    reconfiguring, recordings starting and stopping, timeouts, driver
+    errors...; see event_types), each a code, a perf_counter()
+    timestamp and two integer arguments. Recording one is a few array
+    writes, with no formatting and no I/O, so it's always on; format(),
+    print() or dump() the log after the run.
+
+    Nothing goes in the log per frame: the per-frame loops only log
+    when something goes wrong. Per-frame timing is in FrameTelemetry.
+    Edge doesn't print as it goes, either; with 'verbose', each call
+    prints the events it logged once it's done (see _prints_events()).
+    """
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.times = np.zeros(capacity)
+        self.codes = np.zeros(capacity, dtype=np.uint16)
+        self.args = np.zeros((capacity, 2), dtype=np.int64)
+        self.num_recorded = 0
+        self.start_time = time.perf_counter()
+        self._lock = threading.Lock() #Camera threads log too
+
+    def record(self, name, a=0, b=0):
+        code = event_codes[name]
+        with self._lock:
+            j = self.num_recorded % self.capacity
+            self.times[j] = time.perf_counter()
+            self.codes[j] = code
+            self.args[j, 0], self.args[j, 1] = a, b
+            self.num_recorded += 1
+        return None
+
+    def dump(self, since=0):
+        """
+        The events recorded since event number 'since' (e.g. an earlier
+        self.num_recorded) that are still in the ring, oldest first, as
+        a dict of arrays: 'time' in seconds since the log started,
+        'code', 'name', and the two arguments 'a' and 'b'.
+        """
+        first = max(since, self.num_recorded - self.capacity)
+        order = np.arange(first, self.num_recorded) % self.capacity
+        names = np.array([name for name, _, _ in event_types])
+        return {'time': self.times[order] - self.start_time,
+                'code': self.codes[order],
+                'name': names[self.codes[order]],
+                'a': self.args[order, 0],
+                'b': self.args[order, 1]}
+
+    def format(self, since=0, verbosity=2):
+        """
+        One line per event since 'since', leaving out the ones that
+        need more than 'verbosity' (see event_types).
+        """
+        lines = []
+        events = self.dump(since)
+        for t, code, a, b in zip(events['time'], events['code'],
+                                 events['a'], events['b']):
+            _, message, level = event_types[code]
+            if level > verbosity:
+                continue
+            if callable(message):
+                message = message(a, b)
+            else:
+                message = message % (a, b)[:message.count('%')]
+            lines.append('%12.6f  %s'%(t, message))
+        return lines
+
+    def print(self, since=0, verbosity=2):
+        for line in self.format(since, verbosity):
+            print(line)
+        return None
+
+class DllProfiler:
     """
-    If you get a WindowsError, read PCO_err.h to decypher it.
+    Counts and times every call to the functions we bind onto 'dll',
+    per function and per Edge method that (directly or not) made the
+    call, e.g. which calls dominate arm() or record_to_memory().
+
+        pco.dll_profiler.enable()
+        camera.arm() #...or whatever
+        pco.dll_profiler.disable()
+        pco.dll_profiler.print_report()
+
+    ...or 'with pco.dll_profiler:'. enable() swaps each binding for a
+    timing wrapper, and disable() puts the bare ctypes functions back,
+    so when it's off it costs literally nothing.
+
+    Calls from the background acquisition thread are filed under
+    '_acquisition_thread_main', and from the preview thread under
+    '_preview_thread_main'.
+
+    For each (Edge method, function) pair, we keep the number of
+    calls, total and maximum seconds, and how many calls failed, by
+    error code: the HRESULT from an OSError, or a nonzero return value
+    (e.g. WAIT_TIMEOUT from wait_for_event).
     """
-except WindowsError:
-    print("Failed to load SC2_Cam.dll")
-    print("You need this to run pco.py")
-    raise
+    def __init__(self):
+        self.enabled = False
+        self._originals = {}
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = {} #(method, function) -> [count, total, max]
+            self.errors = {} #(method, function) -> {code: count}
+        return None
+
+    def enable(self):
+        if self.enabled:
+            return None
+        _load_dll()
+        names = [n for n in vars(dll) if not n.startswith(('_', 'PCO_'))]
+        for name in names:
+            self._originals[name] = getattr(dll, name)
+            setattr(dll, name, self._wrap(name, self._originals[name]))
+        self.enabled = True
+        return None
+
+    def disable(self):
+        for name, function in self._originals.items():
+            setattr(dll, name, function)
+        self._originals = {}
+        self.enabled = False
+        return None
+
+    def __enter__(self):
+        self.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.disable()
+        return False
+
+    def _wrap(self, name, function):
+        perf_counter = time.perf_counter
+        def profiled(*args):
+            code = None
+            start = perf_counter()
+            try:
+                result = function(*args)
+                if isinstance(result, int) and result != 0:
+                    code = result
+                return result
+            except OSError as e:
+                code = getattr(e, 'winerror', None) or e.errno or 'OSError'
+                raise
+            finally:
+                self._record(name, perf_counter() - start, code)
+        profiled.argtypes = getattr(function, 'argtypes', None)
+        profiled.restype = getattr(function, 'restype', None)
+        return profiled
+
+    @staticmethod
+    def _caller():
+        """
+        The innermost Edge method on the stack (other than the
+        profiler's own frames), or '(other)'.
+        """
+        frame = sys._getframe(3)
+        while frame is not None:
+            if (frame.f_globals is _module_globals and
+                frame.f_code.co_name in _edge_method_names):
+                return frame.f_code.co_name
+            frame = frame.f_back
+        return '(other)'
+
+    def _record(self, name, seconds, code):
+        key = (self._caller(), name)
+        with self._lock:
+            entry = self.calls.get(key)
+            if entry is None:
+                entry = self.calls[key] = [0, 0.0, 0.0]
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+            if code is not None:
+                errors = self.errors.setdefault(key, {})
+                errors[code] = errors.get(code, 0) + 1
+        return None
+
+    def report(self, by_method=True):
+        """
+        One dict per (Edge method, function), or per function if not
+        'by_method', slowest total first.
+        """
+        with self._lock:
+            calls = {k: list(v) for k, v in self.calls.items()}
+            errors = {k: dict(v) for k, v in self.errors.items()}
+        rows = {}
+        for (method, function), (count, total, longest) in calls.items():
+            key = (method if by_method else None, function)
+            row = rows.setdefault(key, {
+                'method': key[0], 'function': function, 'calls': 0,
+                'total_seconds': 0.0, 'max_seconds': 0.0, 'errors': {}})
+            row['calls'] += count
+            row['total_seconds'] += total
+            row['max_seconds'] = max(row['max_seconds'], longest)
+            for code, n in errors.get((method, function), {}).items():
+                row['errors'][code] = row['errors'].get(code, 0) + n
+        rows = sorted(rows.values(), key=lambda r: -r['total_seconds'])
+        for row in rows:
+            row['mean_seconds'] = row['total_seconds'] / row['calls']
+        return rows
+
+    def print_report(self, by_method=True):
+        print('%-20s %-26s %8s %10s %10s %10s  %s'%(
+            'method', 'function', 'calls', 'total ms', 'mean us',
+            'max us', 'errors'))
+        for r in self.report(by_method):
+            errors = ', '.join(
+                '%s: %i'%(hex(c) if isinstance(c, int) else c, n)
+                for c, n in r['errors'].items())
+            print('%-20s %-26s %8i %10.3f %10.1f %10.1f  %s'%(
+                r['method'] or '', r['function'], r['calls'],
+                1e3 * r['total_seconds'], 1e6 * r['mean_seconds'],
+                1e6 * r['max_seconds'], errors))
+        return None
+
+dll_profiler = DllProfiler()
 
 """
-This command opens the next pco camera; if you want to have multiple
-cameras, and pick which one you're opening, I'd have to implement
-PCO_OpenCameraEx, which would require me to understand PCO_OpenStruct.
+DLL management. Importing this module doesn't touch SC2_Cam.dll, so
+tools that only read recordings (or don't have the DLL at all) can
+import it; the first Edge() loads the DLL. See pco_dll.py for the
+bindings, and for PCO_BACKEND=sim.
 """
-dll.open_camera = dll.PCO_OpenCamera
-dll.open_camera.argtypes = [C.POINTER(C.c_void_p), C.c_uint16]
-
-dll.close_camera = dll.PCO_CloseCamera
-dll.close_camera.argtypes = [C.c_void_p]
-
-dll.arm_camera = dll.PCO_ArmCamera
-dll.arm_camera.argtypes = [C.c_void_p]
-
-dll.allocate_buffer = dll.PCO_AllocateBuffer
-dll.allocate_buffer.argtypes = [
-    C.c_void_p,
-    C.POINTER(C.c_int16),
-    C.c_uint32,
-    C.POINTER(C.POINTER(C.c_uint16)),
-    C.POINTER(C.c_void_p)]
-
-dll.add_buffer = dll.PCO_AddBufferEx
-dll.add_buffer.argtypes = [
-    C.c_void_p,
-    C.c_uint32,
-    C.c_uint32,
-    C.c_int16,
-    C.c_uint16,
-    C.c_uint16,
-    C.c_uint16]
-
-dll.get_buffer_status = dll.PCO_GetBufferStatus
-dll.get_buffer_status.argtypes = [
-    C.c_void_p,
-    C.c_int16,
-    C.POINTER(C.c_uint32),
-    C.POINTER(C.c_uint32)]
-
-dll.set_image_parameters = dll.PCO_CamLinkSetImageParameters
-dll.set_image_parameters.argtypes = [C.c_void_p, C.c_uint16, C.c_uint16]
-
-dll.set_recording_state = dll.PCO_SetRecordingState
-dll.set_recording_state.argtypes = [C.c_void_p, C.c_uint16]
-
-dll.get_sizes = dll.PCO_GetSizes
-dll.get_sizes.argtypes = [
-    C.c_void_p,
-    C.POINTER(C.c_uint16),
-    C.POINTER(C.c_uint16),
-    C.POINTER(C.c_uint16),
-    C.POINTER(C.c_uint16)]
-
-dll.get_sensor_format = dll.PCO_GetSensorFormat
-dll.get_sensor_format.argtypes = [C.c_void_p, C.POINTER(C.c_uint16)]
-
-dll.get_camera_health = dll.PCO_GetCameraHealthStatus
-dll.get_camera_health.argtypes = [
-    C.c_void_p,
-    C.POINTER(C.c_uint32),
-    C.POINTER(C.c_uint32),
-    C.POINTER(C.c_uint32)]
-
-dll.get_temperature = dll.PCO_GetTemperature
-dll.get_temperature.argtypes = [
-    C.c_void_p,
-    C.POINTER(C.c_int16),
-    C.POINTER(C.c_int16),
-    C.POINTER(C.c_int16)]
-
-dll.get_trigger_mode = dll.PCO_GetTriggerMode
-dll.get_trigger_mode.argtypes = [C.c_void_p, C.POINTER(C.c_uint16)]
-
-dll.get_storage_mode = dll.PCO_GetStorageMode
-dll.get_storage_mode.argtypes = [C.c_void_p, C.POINTER(C.c_uint16)]
-
-dll.get_recorder_submode = dll.PCO_GetRecorderSubmode
-dll.get_recorder_submode.argtypes = [C.c_void_p, C.POINTER(C.c_uint16)]
-
-dll.get_acquire_mode = dll.PCO_GetAcquireMode
-dll.get_acquire_mode.argtypes = [C.c_void_p, C.POINTER(C.c_uint16)]
-
-dll.get_pixel_rate = dll.PCO_GetPixelRate
-dll.get_pixel_rate.argtypes = [C.c_void_p, C.POINTER(C.c_uint32)]
-
-dll.set_pixel_rate = dll.PCO_SetPixelRate
-dll.set_pixel_rate.argtypes = [C.c_void_p, C.c_uint32]
-
-dll.get_delay_exposure_time = dll.PCO_GetDelayExposureTime
-dll.get_delay_exposure_time.argtypes = [
-    C.c_void_p,
-    C.POINTER(C.c_uint32),
-    C.POINTER(C.c_uint32),
-    C.POINTER(C.c_uint16),
-    C.POINTER(C.c_uint16)]
-
-dll.set_delay_exposure_time = dll.PCO_SetDelayExposureTime
-dll.set_delay_exposure_time.argtypes = [
-    C.c_void_p,
-    C.c_uint32,
-    C.c_uint32,
-    C.c_uint16,
-    C.c_uint16]
-
-dll.get_roi = dll.PCO_GetROI
-dll.get_roi.argtypes = [
-    C.c_void_p,
-    C.POINTER(C.c_uint16),
-    C.POINTER(C.c_uint16),
-    C.POINTER(C.c_uint16),
-    C.POINTER(C.c_uint16)]
-
-dll.set_roi = dll.PCO_SetROI
-dll.set_roi.argtypes = [
-    C.c_void_p,
-    C.c_uint16,
-    C.c_uint16,
-    C.c_uint16,
-    C.c_uint16]
-
-dll.reset_settings_to_default = dll.PCO_ResetSettingsToDefault
-dll.reset_settings_to_default.argtypes = [C.c_void_p]
-
-dll.set_recording_state = dll.PCO_SetRecordingState
-dll.set_recording_state.argtypes = [C.c_void_p, C.c_uint16]
-
-dll.remove_buffer = dll.PCO_RemoveBuffer
-dll.remove_buffer.argtypes = [C.c_void_p]
-
-dll.free_buffer = dll.PCO_FreeBuffer
-dll.free_buffer.argtypes = [C.c_void_p, C.c_int16]
-
-dll.set_sensor_format = dll.PCO_SetSensorFormat
-dll.set_sensor_format.argtypes = [C.c_void_p, C.c_uint16]
-
-dll.set_trigger_mode = dll.PCO_SetTriggerMode
-dll.set_trigger_mode.argtypes = [C.c_void_p, C.c_uint16]
-
-dll.set_recorder_submode = dll.PCO_SetRecorderSubmode
-dll.set_recorder_submode.argtypes = [C.c_void_p, C.c_uint16]
-
-dll.set_acquire_mode = dll.PCO_SetAcquireMode
-dll.set_acquire_mode.argtypes = [C.c_void_p, C.c_uint16]
-
-dll.set_storage_mode = dll.PCO_SetStorageMode
-dll.set_storage_mode.argtypes = [C.c_void_p, C.c_uint16]
+dll = None
+
+def _load_dll():
+    global dll
+    if dll is None:
+        dll = pco_dll.load()
+    return dll
+
+_module_globals = globals() #For DllProfiler._caller()
+_edge_method_names = {name for name in vars(Edge)
+                      if not name.startswith('_')} | {
+                          '__init__', '_acquisition_thread_main',
+                          '_preview_thread_main'}
 
 if __name__ == '__main__':
     camera = Edge(very_verbose=False)
     camera.apply_settings(exposure_time_microseconds=3000)
     camera.arm(num_buffers=16)
-    start = time.clock()
+    start = time.perf_counter()
     a = camera.record_to_memory(num_images=1000)
-    print("Elapsed time:", time.clock() - start)
+    print("Elapsed time:", time.perf_counter() - start)
     print(a.min(), a.max(), a.shape)
     camera.disarm()
     camera.close()
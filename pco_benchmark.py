@@ -0,0 +1,322 @@
+"""
+Benchmarks for the Python side of pco.py, run against the simulated
+camera in pco_sim.py, so they work anywhere:
+
+    python pco_benchmark.py
+
+The simulated DLL calls are nearly free, so these numbers are the
+overhead of our own code: how fast we can keep up with the camera,
+how much CPU it costs, and how long reconfiguring takes.
+"""
+import sys
+import time
+import subprocess
+import numpy as np
+import pco_sim
+sim = pco_sim.install(pco_sim.SimulatedSC2Cam(fill_frames=False))
+import pco
+
+def seconds_per_call(function, num_calls):
+    start = time.perf_counter()
+    for i in range(num_calls):
+        function(i)
+    return (time.perf_counter() - start) / num_calls
+
+def count_dll_calls():
+    return sum(sim.call_counts.values())
+
+def bench_import(num_runs=5):
+    """
+    How long 'import pco' takes in a fresh interpreter (which doesn't
+    load SC2_Cam.dll), next to a bare interpreter and numpy alone, plus
+    how long loading and binding the DLL (the simulated one, here)
+    takes at the first Edge().
+    """
+    def seconds_to_run(code):
+        times = []
+        for i in range(num_runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, '-c', code], check=True)
+            times.append(time.perf_counter() - start)
+        return np.median(times)
+    python = seconds_to_run('pass')
+    results = {'python_ms': 1e3 * python,
+               'import_numpy_ms': 1e3 * (seconds_to_run('import numpy') -
+                                         python),
+               'import_pco_ms': 1e3 * (seconds_to_run('import pco') - python)}
+    if pco.dll is None:
+        start = time.perf_counter()
+        pco._load_dll()
+        results['load_and_bind_dll_ms'] = 1e3 * (time.perf_counter() - start)
+    return results
+
+def bench_apply_settings(
+    camera, num_calls=20, exposures=(1000, 2000), **settings):
+    """
+    Time to reconfigure the camera, and how many DLL calls it takes,
+    switching between 'exposures' like a typical protocol does.
+    """
+    times = []
+    dll_calls = count_dll_calls()
+    for i in range(num_calls):
+        start = time.perf_counter()
+        camera.apply_settings(
+            exposure_time_microseconds=exposures[i % len(exposures)],
+            **settings)
+        times.append(time.perf_counter() - start)
+    return {'ms_per_call': 1e3 * np.mean(times),
+            'max_ms': 1e3 * np.max(times),
+            'dll_calls_per_call': (count_dll_calls() - dll_calls) / num_calls}
+
+def bench_arm(camera, num_calls=20, num_buffers=16):
+    """
+    Time to arm (and separately, disarm) the camera.
+    """
+    arm_times, disarm_times = [], []
+    dll_calls = count_dll_calls()
+    for i in range(num_calls):
+        start = time.perf_counter()
+        camera.arm(num_buffers=num_buffers)
+        arm_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        camera.disarm()
+        disarm_times.append(time.perf_counter() - start)
+    return {'arm_ms': 1e3 * np.mean(arm_times),
+            'max_arm_ms': 1e3 * np.max(arm_times),
+            'disarm_ms': 1e3 * np.mean(disarm_times),
+            'dll_calls_per_cycle': (count_dll_calls() - dll_calls) / num_calls}
+
+def bench_record_to_memory(
+    camera, num_images=1000, frame_interval=1e-3, num_buffers=16,
+    **record_kwargs):
+    """
+    Run the simulated camera at 1/frame_interval fps and see if
+    record_to_memory() keeps up: achieved frame rate, frames the camera
+    had nowhere to put, CPU per frame, and how late we noticed each
+    buffer (measured by the simulator, so it's the true latency).
+    """
+    sim.frame_interval_override = frame_interval
+    camera.arm(num_buffers=num_buffers)
+    start, start_cpu = time.perf_counter(), time.process_time()
+    camera.record_to_memory(num_images, **record_kwargs)
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - start_cpu
+    latencies = np.array(sim.wake_latencies)
+    results = {'target_fps': 1 / frame_interval,
+               'fps': num_images / elapsed,
+               'frames_lost': sim.num_lost,
+               'cpu_us_per_frame': 1e6 * cpu / num_images,
+               'cpu_use': cpu / elapsed,
+               'mean_latency_us': 1e6 * latencies.mean(),
+               'max_latency_us': 1e6 * latencies.max(),
+               'p99_copy_us': 1e6 * camera.telemetry.percentiles(
+                   'copy_time', 99)}
+    camera.disarm()
+    sim.frame_interval_override = None
+    return results
+
+def bench_buffer_views(camera, num_frames=100000):
+    """
+    Per-frame cost of getting a driver buffer into 'out': rebuilding
+    the numpy view every frame (what record_to_memory() used to do)
+    vs. indexing the views that arm() caches. With a small ROI the copy
+    itself is cheap, so the view overhead dominates.
+    """
+    num_buffers = len(camera.buffer_pointers)
+    out = np.zeros((1, camera.height, camera.width), dtype=np.uint16)
+    def rebuilt_view(i):
+        out[0, :, :] = np.ctypeslib.as_array(
+            camera._image_datatype.from_address(
+                pco.C.addressof(
+                    camera.buffer_pointers[i % num_buffers].contents)))
+    def cached_view(i):
+        out[0, :, :] = camera._buffer_arrays[i % num_buffers]
+    before = seconds_per_call(rebuilt_view, num_frames)
+    after = seconds_per_call(cached_view, num_frames)
+    return {'roi': (camera.width, camera.height),
+            'rebuilt_view_us_per_frame': 1e6 * before,
+            'cached_view_us_per_frame': 1e6 * after,
+            'speedup': before / after}
+
+def bench_zero_copy(
+    camera, num_images=500, frame_interval=2e-3, num_buffers=16,
+    register_costs=(0, 50e-6, 500e-6), wait_strategy='adaptive_backoff'):
+    """
+    record_to_memory() with and without 'zero_copy'. Zero-copy skips
+    the copy out of the driver buffer, but re-points that buffer at its
+    next frame with PCO_AllocateBuffer, once per frame. The simulated
+    call is free; a real grabber registers (page-locks) the memory,
+    which can cost far more than the copy it saves. 'register_costs'
+    are seconds we add to each of those calls to see where zero-copy
+    stops paying off. We wait with 'adaptive_backoff', so the CPU time
+    is the handling, not busy polling.
+    """
+    camera.arm(num_buffers=num_buffers)
+    out = pco.aligned_zeros((num_images, camera.height, camera.width))
+    allocate_buffer = sim.PCO_AllocateBuffer
+    def record(zero_copy):
+        sim.frame_interval_override = frame_interval
+        camera.arm(num_buffers=num_buffers)
+        allocations = sim.call_counts.get('PCO_AllocateBuffer', 0)
+        start, start_cpu = time.perf_counter(), time.process_time()
+        camera.record_to_memory(num_images, out=out, zero_copy=zero_copy,
+                                wait_strategy=wait_strategy)
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - start_cpu
+        allocations = sim.call_counts['PCO_AllocateBuffer'] - allocations
+        lost = sim.num_lost
+        camera.disarm()
+        sim.frame_interval_override = None
+        return {'fps': num_images / elapsed,
+                'frames_lost': lost,
+                'cpu_us_per_frame': 1e6 * cpu / num_images,
+                'allocate_buffer_calls_per_frame': allocations / num_images}
+    results = {'roi': (camera.width, camera.height),
+               'target_fps': 1 / frame_interval}
+    for k, v in record(False).items():
+        results['copy_' + k] = v
+    for cost in register_costs:
+        def slow_allocate_buffer(*args):
+            time.sleep(cost)
+            return allocate_buffer(*args)
+        if cost:
+            sim.PCO_AllocateBuffer = slow_allocate_buffer
+        try:
+            for k, v in record(True).items():
+                results['zero_copy_%ius_%s'%(1e6 * cost, k)] = v
+        finally:
+            sim.__dict__.pop('PCO_AllocateBuffer', None)
+    return results
+
+def bench_plan_roi(num_candidates=100000, target_fps=400, seed=0):
+    """
+    Time to plan ROIs for many candidate regions at once, vectorized,
+    vs. one at a time.
+    """
+    rng = np.random.default_rng(seed)
+    left = rng.integers(1, 2000, num_candidates)
+    top = rng.integers(1, 2000, num_candidates)
+    required = {'left': left,
+                'right': left + rng.integers(0, 60, num_candidates),
+                'top': top,
+                'bottom': top + rng.integers(0, 48, num_candidates)}
+    start = time.perf_counter()
+    plan = pco.plan_roi(required, target_fps=target_fps)
+    vectorized = time.perf_counter() - start
+    def one_roi(i):
+        pco.plan_roi({k: int(v[i]) for k, v in required.items()},
+                     target_fps=target_fps)
+    one_at_a_time = seconds_per_call(one_roi, 1000)
+    return {'num_candidates': num_candidates,
+            'vectorized_ms': 1e3 * vectorized,
+            'one_at_a_time_ms': 1e3 * one_at_a_time * num_candidates,
+            'fraction_meeting_target': plan['meets_target'].mean()}
+
+def bench_flat_field(height=2048, width=2060, num_frames=20, seed=0):
+    """
+    Per-frame cost of dark and flat-field correction of a full frame:
+    the obvious numpy one-liner (float64 temporaries) vs.
+    FlatFieldCorrection, in place.
+    """
+    rng = np.random.default_rng(seed)
+    dark = rng.normal(100, 2, (height, width)).astype(np.float32)
+    flat = rng.uniform(900, 1100, (height, width)).astype(np.float32)
+    frames = rng.integers(0, 4000, (num_frames, height, width),
+                          dtype=np.uint16)
+    gain = flat.mean() / flat
+    def one_liner(i):
+        frame = frames[i % num_frames]
+        frame[:] = np.clip(np.round((frame - dark) * gain), 0, 65535)
+    correction = pco.FlatFieldCorrection(dark, flat)
+    def in_place(i):
+        correction.correct(frames[i % num_frames])
+    before = seconds_per_call(one_liner, num_frames)
+    after = seconds_per_call(in_place, num_frames)
+    return {'one_liner_ms_per_frame': 1e3 * before,
+            'in_place_ms_per_frame': 1e3 * after,
+            'in_place_max_fps': 1 / after}
+
+def bench_auto_expose(camera, start_exposures=(100, 2200, 500000),
+                      seed=0):
+    """
+    Run auto_expose() on a simulated scene from a few starting
+    exposures: how many frames it takes, and what each iteration costs
+    us (besides waiting for the frame) in ms and DLL calls. The
+    simulated scene reaches the default target at about 30 ms.
+    """
+    rng = np.random.default_rng(seed)
+    sim.scene = rng.uniform(0, 1, (sim.max_height, sim.max_width))
+    results = {}
+    for exposure in start_exposures:
+        camera.apply_settings(exposure_time_microseconds=exposure,
+                              region_of_interest=small_roi)
+        dll_calls = count_dll_calls()
+        polls = sim.call_counts.get('PCO_GetBufferStatus', 0)
+        r = camera.auto_expose()
+        n = r['num_iterations']
+        polls = sim.call_counts.get('PCO_GetBufferStatus', 0) - polls
+        results['from_%ius'%exposure] = '%s at %i us in %i frames'%(
+            'converged' if r['converged'] else 'gave up',
+            r['exposure_time_microseconds'], n)
+        results['from_%ius_histogram_ms'%exposure] = np.mean(
+            [i['histogram_ms'] for i in r['iterations']])
+        results['from_%ius_apply_ms'%exposure] = np.mean(
+            [i['apply_ms'] for i in r['iterations'][:-1]] or [0])
+        results['from_%ius_dll_calls_per_iteration'%exposure] = (
+            count_dll_calls() - dll_calls - polls) / n
+    sim.scene = None
+    return results
+
+def print_results(name, results):
+    print(name + ':')
+    for k, v in results.items():
+        if isinstance(v, float):
+            v = '%0.3f'%v
+        print('  %s: %s'%(k, v))
+    return None
+
+small_roi = {'left': 1, 'right': 40, 'top': 1021, 'bottom': 1028}
+full_roi = {'left': 1, 'right': 2060, 'top': 1, 'bottom': 2048}
+
+if __name__ == '__main__':
+    print_results('import', bench_import())
+    print_results('plan_roi', bench_plan_roi())
+    print_results('flat_field', bench_flat_field())
+    camera = pco.Edge(verbose=False)
+    for full_reset in (True, False):
+        print_results('apply_settings, full_reset=%s'%full_reset,
+                      bench_apply_settings(camera,
+                                           region_of_interest=small_roi,
+                                           full_reset=full_reset))
+    print_results('arm/disarm', bench_arm(camera))
+    for wait_strategy in pco.wait_strategies:
+        for roi, frame_interval in ((small_roi, 2e-4), (full_roi, 1e-2)):
+            camera.apply_settings(exposure_time_microseconds=100,
+                                  region_of_interest=roi)
+            print_results(
+                'record_to_memory, %s, %ix%i at %i fps'%(
+                    wait_strategy, camera.roi['right'] - camera.roi['left'] + 1,
+                    camera.roi['bottom'] - camera.roi['top'] + 1,
+                    1 / frame_interval),
+                bench_record_to_memory(
+                    camera,
+                    num_images=2000 if roi is small_roi else 100,
+                    frame_interval=frame_interval,
+                    wait_strategy=wait_strategy))
+    for roi in (small_roi, full_roi):
+        camera.apply_settings(exposure_time_microseconds=100,
+                              region_of_interest=roi)
+        print_results('zero_copy vs. copy (cost per re-point)',
+                      bench_zero_copy(
+                          camera, num_images=2000 if roi is small_roi else 100,
+                          frame_interval=2e-4 if roi is small_roi else 1e-2))
+    print_results('auto_expose (DLL calls not counting buffer polls)',
+                  bench_auto_expose(camera))
+    for roi in (small_roi, full_roi):
+        camera.apply_settings(exposure_time_microseconds=1000,
+                              region_of_interest=roi)
+        camera.arm(num_buffers=16)
+        print_results('Buffer views', bench_buffer_views(
+            camera, num_frames=100000 if roi is small_roi else 200))
+        camera.disarm()
+    camera.close()
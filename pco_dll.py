@@ -0,0 +1,124 @@
+"""
+SC2_Cam.dll, the pco SDK, bound with ctypes. pco.py and test01.py
+both get their 'dll' from load(), which loads the DLL and binds
+everything in BINDINGS the first time it's called. Importing this
+module is cheap and works anywhere; only load() needs the DLL.
+
+Set the environment variable PCO_BACKEND=sim to run against the
+simulated camera in pco_sim.py instead of SC2_Cam.dll (e.g. on Linux).
+"""
+import os
+import ctypes as C
+
+"""
+From sc2_SDKStructures.h. We only fill in wSize, wInterfaceType and
+wCameraNumber; the rest are flags for exotic interfaces.
+"""
+class PCO_OpenStruct(C.Structure):
+    _fields_ = [
+        ('wSize', C.c_uint16),
+        ('wInterfaceType', C.c_uint16),
+        ('wCameraNumber', C.c_uint16),
+        ('wCameraNumAtInterface', C.c_uint16),
+        ('wOpenFlags', C.c_uint16 * 10),
+        ('dwOpenFlags', C.c_uint32 * 5),
+        ('wOpenPtr', C.c_void_p * 6),
+        ('zzwDummy', C.c_uint16 * 8)]
+
+"""
+What we call each SC2_Cam function, and its argument types. Every
+function returns an error code, which oledll turns into an OSError;
+read PCO_err.h to decypher it.
+"""
+handle = C.c_void_p
+p_uint16, p_int16, p_uint32 = (
+    C.POINTER(C.c_uint16), C.POINTER(C.c_int16), C.POINTER(C.c_uint32))
+BINDINGS = [
+    #Opens the next pco camera...
+    ('open_camera', 'PCO_OpenCamera', [C.POINTER(handle), C.c_uint16]),
+    #...or the one we ask for; see PCO_OpenStruct.
+    ('open_camera_ex', 'PCO_OpenCameraEx',
+     [C.POINTER(handle), C.POINTER(PCO_OpenStruct)]),
+    ('close_camera', 'PCO_CloseCamera', [handle]),
+    ('arm_camera', 'PCO_ArmCamera', [handle]),
+    ('allocate_buffer', 'PCO_AllocateBuffer',
+     [handle, p_int16, C.c_uint32, C.POINTER(p_uint16), C.POINTER(handle)]),
+    ('add_buffer', 'PCO_AddBufferEx',
+     [handle, C.c_uint32, C.c_uint32, C.c_int16,
+      C.c_uint16, C.c_uint16, C.c_uint16]),
+    ('get_buffer_status', 'PCO_GetBufferStatus',
+     [handle, C.c_int16, p_uint32, p_uint32]),
+    ('set_image_parameters', 'PCO_CamLinkSetImageParameters',
+     [handle, C.c_uint16, C.c_uint16]),
+    ('set_recording_state', 'PCO_SetRecordingState', [handle, C.c_uint16]),
+    ('get_sizes', 'PCO_GetSizes',
+     [handle, p_uint16, p_uint16, p_uint16, p_uint16]),
+    ('get_sensor_format', 'PCO_GetSensorFormat', [handle, p_uint16]),
+    ('set_sensor_format', 'PCO_SetSensorFormat', [handle, C.c_uint16]),
+    ('get_camera_health', 'PCO_GetCameraHealthStatus',
+     [handle, p_uint32, p_uint32, p_uint32]),
+    ('get_temperature', 'PCO_GetTemperature',
+     [handle, p_int16, p_int16, p_int16]),
+    ('get_trigger_mode', 'PCO_GetTriggerMode', [handle, p_uint16]),
+    ('set_trigger_mode', 'PCO_SetTriggerMode', [handle, C.c_uint16]),
+    ('get_storage_mode', 'PCO_GetStorageMode', [handle, p_uint16]),
+    ('set_storage_mode', 'PCO_SetStorageMode', [handle, C.c_uint16]),
+    ('get_recorder_submode', 'PCO_GetRecorderSubmode', [handle, p_uint16]),
+    ('set_recorder_submode', 'PCO_SetRecorderSubmode',
+     [handle, C.c_uint16]),
+    ('get_acquire_mode', 'PCO_GetAcquireMode', [handle, p_uint16]),
+    ('set_acquire_mode', 'PCO_SetAcquireMode', [handle, C.c_uint16]),
+    ('get_pixel_rate', 'PCO_GetPixelRate', [handle, p_uint32]),
+    ('set_pixel_rate', 'PCO_SetPixelRate', [handle, C.c_uint32]),
+    ('get_delay_exposure_time', 'PCO_GetDelayExposureTime',
+     [handle, p_uint32, p_uint32, p_uint16, p_uint16]),
+    ('set_delay_exposure_time', 'PCO_SetDelayExposureTime',
+     [handle, C.c_uint32, C.c_uint32, C.c_uint16, C.c_uint16]),
+    ('get_roi', 'PCO_GetROI',
+     [handle, p_uint16, p_uint16, p_uint16, p_uint16]),
+    ('set_roi', 'PCO_SetROI',
+     [handle, C.c_uint16, C.c_uint16, C.c_uint16, C.c_uint16]),
+    ('get_timestamp_mode', 'PCO_GetTimestampMode', [handle, p_uint16]),
+    ('set_timestamp_mode', 'PCO_SetTimestampMode', [handle, C.c_uint16]),
+    ('reset_settings_to_default', 'PCO_ResetSettingsToDefault', [handle]),
+    ('remove_buffer', 'PCO_RemoveBuffer', [handle]),
+    ('free_buffer', 'PCO_FreeBuffer', [handle, C.c_int16]),
+    ]
+
+"""
+The buffer events from PCO_AllocateBuffer are ordinary Windows events,
+so we wait on them with kernel32's WaitForSingleObject, bound as
+'wait_for_event'.
+"""
+WAIT_OBJECT_0, WAIT_TIMEOUT = 0x0, 0x102
+
+_dll = None
+
+def load():
+    """
+    SC2_Cam.dll, with everything in BINDINGS bound onto it. Loads it
+    the first time; after that, returns the same object.
+    """
+    global _dll
+    if _dll is not None:
+        return _dll
+    if os.environ.get('PCO_BACKEND', 'sc2_cam') == 'sim':
+        import pco_sim
+        if not pco_sim.installed():
+            pco_sim.install()
+    try:
+        dll = C.oledll.LoadLibrary("SC2_Cam")
+    except (OSError, AttributeError): #No ctypes.oledll off Windows
+        print("Failed to load SC2_Cam.dll")
+        print("You need this to talk to a pco camera",
+              "(or set PCO_BACKEND=sim)")
+        raise
+    for name, function_name, argtypes in BINDINGS:
+        function = getattr(dll, function_name)
+        function.argtypes = argtypes
+        setattr(dll, name, function)
+    dll.wait_for_event = C.windll.kernel32.WaitForSingleObject
+    dll.wait_for_event.argtypes = [C.c_void_p, C.c_uint32]
+    dll.wait_for_event.restype = C.c_uint32
+    _dll = dll
+    return _dll
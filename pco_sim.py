@@ -0,0 +1,563 @@
+"""
+A simulated pco.edge, standing in for SC2_Cam.dll so pco.py can run
+without a camera (or without Windows).
+
+It exports the same PCO_* functions that pco.py binds, plus a fake
+kernel32.WaitForSingleObject for the buffer events. Frames "arrive"
+on a clock: once recording starts, a new frame finishes every frame
+interval and fills the buffer at the front of the driver queue. You
+can make the clock faster or slower than the real camera, and inject
+DMA errors and dropped triggers.
+
+Usage:
+
+    import pco_sim
+    sim = pco_sim.install(pco_sim.SimulatedSC2Cam(frame_interval=1e-3))
+    import pco
+    camera = pco.Edge() #Must come after install()
+
+For several cameras, install a list of SimulatedSC2Cams, and open
+them with pco.Edge(camera_number=...) or pco.CameraGroup.
+
+...or set the environment variable PCO_BACKEND=sim before the first
+pco.Edge(), to get a default SimulatedSC2Cam.
+"""
+import time
+import random
+import threading
+import ctypes as C
+import numpy as np
+
+class SimulatedSC2Cam:
+    """
+    * 'frame_interval': seconds between frames. None (the default)
+      means max(exposure, readout time), like the real camera.
+    * 'readout_time': seconds to read out a frame. None means we work
+      it out from the ROI height, like the real rolling shutter.
+    * 'dma_error_frames': frame numbers that come back with a DMA error
+      driver status. 'dma_error_rate' does the same at random.
+    * 'dropped_trigger_rate': fraction of frame intervals where no
+      frame happens at all (a missed external trigger).
+    * 'fill_frames': fill each frame with its frame number. Turn it off
+      to keep the simulator's own CPU use out of benchmarks.
+    * 'scene': instead, an image for the camera to look at. It's the
+      size of the whole sensor, in counts per microsecond of exposure;
+      each frame is 'dark_level' plus the scene (in our ROI) times the
+      exposure time, clipped to 16 bits. Can be set any time.
+
+    With the timestamp mode set to binary, like the real camera we
+    write a BCD image counter and timestamp into the first 14 pixels of
+    each frame. The counter counts every exposure, so frames lost for
+    want of a buffer show up as gaps; dropped triggers don't.
+    """
+    line_time = {'4.2': 9.76e-6, #Seconds per row pair; 100 fps full frame
+                 '5.5': 9.26e-6}
+
+    def __init__(
+        self,
+        pco_edge_type='4.2',
+        frame_interval=None,
+        readout_time=None,
+        dma_error_frames=(),
+        dma_error_rate=0,
+        dropped_trigger_rate=0,
+        fill_frames=True,
+        scene=None,
+        dark_level=100,
+        seed=0,
+        ):
+        assert pco_edge_type in ('4.2', '5.5')
+        self.pco_edge_type = pco_edge_type
+        self.max_width, self.max_height = {'4.2': (2060, 2048),
+                                           '5.5': (2560, 2160)
+                                           }[pco_edge_type]
+        self.pixel_rate = {'4.2': 272250000,
+                           '5.5': 286000000}[pco_edge_type]
+        self.frame_interval_override = frame_interval
+        self.readout_time_override = readout_time
+        self.dma_error_frames = set(dma_error_frames)
+        self.dma_error_rate = dma_error_rate
+        self.dropped_trigger_rate = dropped_trigger_rate
+        self.fill_frames = fill_frames
+        self.scene = scene
+        self.dark_level = dark_level
+        self._scene_frame_key = None
+        self._random = random.Random(seed)
+        self._reset_settings()
+        self.open = False
+        self.recording = False
+        self.buffers = {} #buffer number -> (ctypes array, event handle)
+        self.events = {} #event handle -> (threading.Event, buffer number)
+        self.status = {} #buffer number -> (dll status, driver status)
+        self.queue = [] #Buffer numbers in the driver queue, in order
+        self.done_times = {} #buffer number -> when it filled, if unseen
+        self.width, self.height = self.max_width, self.max_height
+        self.camera_number = 0 #SimulatedCameras renumbers us
+        self.call_counts = {}
+        self._reset_counters()
+
+    def _reset_settings(self):
+        self.settings = {
+            'sensor_format': 0,
+            'trigger_mode': 0,
+            'storage_mode': 0,
+            'recorder_submode': 1,
+            'acquire_mode': 0,
+            'pixel_rate': self.pixel_rate,
+            'delay': 0,
+            'exposure': 10000, #microseconds
+            'roi': (1, 1, self.max_width, self.max_height),
+            'timestamp_mode': 0}
+        return None
+
+    def _reset_counters(self):
+        self.num_intervals = 0 #Frame intervals since recording started
+        self.num_frames = 0 #Frames actually exposed
+        self.num_lost = 0 #...that found no buffer in the queue
+        self.num_dma_errors = 0
+        self.num_dropped_triggers = 0
+        self.wake_latencies = [] #How long each filled buffer went unseen
+        return None
+
+    def readout_time(self):
+        """
+        The edge reads out rolling-shutter style from the centre out,
+        two rows at a time, so readout time scales with the ROI height.
+        """
+        if self.readout_time_override is not None:
+            return self.readout_time_override
+        return self.line_time[self.pco_edge_type] * ((self.height + 1) // 2)
+
+    def frame_interval(self):
+        if self.frame_interval_override is not None:
+            return self.frame_interval_override
+        return max(1e-6 * self.settings['exposure'], self.readout_time())
+
+    """
+    Fake frame clock. Interval k ends at t0 + (k + 1) * interval, and
+    (unless its trigger got dropped) delivers a frame. We catch up
+    lazily whenever the caller talks to us.
+    """
+    def _interval_end(self, k):
+        return self._t0 + (k + 1) * self._interval
+
+    def _advance(self):
+        if not self.recording:
+            return None
+        now = time.perf_counter()
+        while self._interval_end(self.num_intervals) <= now:
+            done_time = self._interval_end(self.num_intervals)
+            self.num_intervals += 1
+            if (self.dropped_trigger_rate and
+                self._random.random() < self.dropped_trigger_rate):
+                self.num_dropped_triggers += 1
+                continue
+            self._deliver_frame(done_time)
+        return None
+
+    def _deliver_frame(self, done_time):
+        frame_number = self.num_frames
+        self.num_frames += 1
+        if not self.queue:
+            self.num_lost += 1 #Nowhere to put it
+            return None
+        buffer_number = self.queue.pop(0)
+        data, event_handle = self.buffers[buffer_number]
+        if self.scene is not None:
+            frame = np.ctypeslib.as_array(data)[:self.width * self.height]
+            frame[:] = self._scene_frame().ravel()
+        elif self.fill_frames:
+            frame = np.ctypeslib.as_array(data)[:self.width * self.height]
+            frame.fill(frame_number & 0xffff)
+        if self.settings['timestamp_mode'] in (1, 2): #Binary, +/- ASCII
+            np.ctypeslib.as_array(data)[:14] = bcd_timestamp(
+                frame_number + 1, self._wall_clock_offset + done_time)
+        driver_status = 0x0
+        if (frame_number in self.dma_error_frames or (
+            self.dma_error_rate and
+            self._random.random() < self.dma_error_rate)):
+            driver_status = 0x80332028
+            self.num_dma_errors += 1
+        self.status[buffer_number] = (0xc0008000, driver_status)
+        self.done_times[buffer_number] = done_time
+        self.events[event_handle][0].set()
+        return None
+
+    def _scene_frame(self):
+        """
+        What the camera sees of self.scene at the current ROI and
+        exposure. Rendering it costs a few ms, so we only do it when
+        one of those (or the scene) changes.
+        """
+        key = (id(self.scene), self.settings['roi'], self.settings['exposure'])
+        if key != self._scene_frame_key:
+            x0, y0, x1, y1 = self.settings['roi']
+            signal = (self.dark_level + self.settings['exposure'] *
+                      np.asarray(self.scene, dtype=np.float64)[
+                          y0 - 1:y1, x0 - 1:x1])
+            self._scene_frame_cache = np.clip(
+                np.round(signal), 0, 65535).astype(np.uint16)
+            self._scene_frame_key = key
+        return self._scene_frame_cache
+
+    def _count(self, name):
+        self.call_counts[name] = self.call_counts.get(name, 0) + 1
+        return None
+
+    """
+    The SC2_Cam functions that pco.py binds:
+    """
+    def PCO_OpenCamera(self, handle, camera_number):
+        self._count('PCO_OpenCamera')
+        handle.value = 0x5c2 + self.camera_number
+        self.open = True
+        return 0
+
+    def PCO_OpenCameraEx(self, handle, open_struct):
+        self._count('PCO_OpenCameraEx')
+        assert open_struct.wCameraNumber == self.camera_number
+        return self.PCO_OpenCamera(handle, 0)
+
+    def PCO_CloseCamera(self, handle):
+        self._count('PCO_CloseCamera')
+        self.open = False
+        return 0
+
+    def PCO_ArmCamera(self, handle):
+        self._count('PCO_ArmCamera')
+        left, top, right, bottom = self.settings['roi']
+        self.width, self.height = right - left + 1, bottom - top + 1
+        return 0
+
+    def PCO_GetSizes(self, handle, x_res, y_res, x_res_max, y_res_max):
+        self._count('PCO_GetSizes')
+        x_res.value, y_res.value = self.width, self.height
+        x_res_max.value, y_res_max.value = self.max_width, self.max_height
+        return 0
+
+    def PCO_AllocateBuffer(
+        self, handle, buffer_number, size, pointer, event_handle):
+        self._count('PCO_AllocateBuffer')
+        if buffer_number.value == -1:
+            buffer_number.value = min(set(range(16)) - set(self.buffers))
+        assert buffer_number.value not in self.queue
+        if pointer: #The caller brought its own memory
+            data = (C.c_uint16 * (size // 2)).from_address(
+                C.addressof(pointer.contents))
+        else:
+            data = (C.c_uint16 * (size // 2))()
+            pointer.contents = C.cast(data, C.POINTER(C.c_uint16)).contents
+        event_handle.value = (
+            0xe000 + 0x100 * self.camera_number + buffer_number.value)
+        self.buffers[buffer_number.value] = (data, event_handle.value)
+        self.events[event_handle.value] = (
+            threading.Event(), buffer_number.value)
+        self.status[buffer_number.value] = (0x0, 0x0)
+        return 0
+
+    def PCO_FreeBuffer(self, handle, buffer_number):
+        self._count('PCO_FreeBuffer')
+        _, event_handle = self.buffers.pop(buffer_number)
+        del self.events[event_handle]
+        del self.status[buffer_number]
+        return 0
+
+    def PCO_AddBufferEx(
+        self, handle, first_image, last_image, buffer_number,
+        width, height, bit_depth):
+        self._count('PCO_AddBufferEx')
+        self._advance()
+        assert (width, height) == (self.width, self.height)
+        self.queue.append(buffer_number)
+        self.status[buffer_number] = (0x0, 0x0)
+        self.done_times.pop(buffer_number, None)
+        self.events[self.buffers[buffer_number][1]][0].clear()
+        return 0
+
+    def PCO_RemoveBuffer(self, handle):
+        self._count('PCO_RemoveBuffer')
+        self.queue = []
+        return 0
+
+    def PCO_GetBufferStatus(
+        self, handle, buffer_number, dll_status, driver_status):
+        self._count('PCO_GetBufferStatus')
+        self._advance()
+        dll_status.value, driver_status.value = self.status[buffer_number]
+        if buffer_number in self.done_times: #First time anyone noticed
+            self.wake_latencies.append(
+                time.perf_counter() - self.done_times.pop(buffer_number))
+        return 0
+
+    def PCO_CamLinkSetImageParameters(self, handle, width, height):
+        self._count('PCO_CamLinkSetImageParameters')
+        return 0
+
+    def PCO_SetRecordingState(self, handle, state):
+        self._count('PCO_SetRecordingState')
+        self._advance()
+        if state and not self.recording:
+            self._t0 = time.perf_counter()
+            self._wall_clock_offset = time.time() - self._t0
+            self._interval = self.frame_interval()
+            self._reset_counters()
+        self.recording = bool(state)
+        return 0
+
+    def PCO_ResetSettingsToDefault(self, handle):
+        self._count('PCO_ResetSettingsToDefault')
+        self._reset_settings()
+        return 0
+
+    def PCO_GetCameraHealthStatus(self, handle, warnings, errors, status):
+        self._count('PCO_GetCameraHealthStatus')
+        warnings.value, errors.value, status.value = 0, 0, 0
+        return 0
+
+    def PCO_GetTemperature(self, handle, ccd_temp, camera_temp, power_temp):
+        self._count('PCO_GetTemperature')
+        ccd_temp.value, camera_temp.value, power_temp.value = 75, 32, 35
+        return 0
+
+    def PCO_GetSensorFormat(self, handle, value):
+        self._count('PCO_GetSensorFormat')
+        value.value = self.settings['sensor_format']
+        return 0
+
+    def PCO_SetSensorFormat(self, handle, value):
+        self._count('PCO_SetSensorFormat')
+        self.settings['sensor_format'] = value
+        return 0
+
+    def PCO_GetTriggerMode(self, handle, value):
+        self._count('PCO_GetTriggerMode')
+        value.value = self.settings['trigger_mode']
+        return 0
+
+    def PCO_SetTriggerMode(self, handle, value):
+        self._count('PCO_SetTriggerMode')
+        self.settings['trigger_mode'] = value
+        return 0
+
+    def PCO_GetStorageMode(self, handle, value):
+        self._count('PCO_GetStorageMode')
+        value.value = self.settings['storage_mode']
+        return 0
+
+    def PCO_SetStorageMode(self, handle, value):
+        self._count('PCO_SetStorageMode')
+        self.settings['storage_mode'] = value
+        return 0
+
+    def PCO_GetRecorderSubmode(self, handle, value):
+        self._count('PCO_GetRecorderSubmode')
+        value.value = self.settings['recorder_submode']
+        return 0
+
+    def PCO_SetRecorderSubmode(self, handle, value):
+        self._count('PCO_SetRecorderSubmode')
+        self.settings['recorder_submode'] = value
+        return 0
+
+    def PCO_GetAcquireMode(self, handle, value):
+        self._count('PCO_GetAcquireMode')
+        value.value = self.settings['acquire_mode']
+        return 0
+
+    def PCO_SetAcquireMode(self, handle, value):
+        self._count('PCO_SetAcquireMode')
+        self.settings['acquire_mode'] = value
+        return 0
+
+    def PCO_GetPixelRate(self, handle, value):
+        self._count('PCO_GetPixelRate')
+        value.value = self.settings['pixel_rate']
+        return 0
+
+    def PCO_SetPixelRate(self, handle, value):
+        self._count('PCO_SetPixelRate')
+        self.settings['pixel_rate'] = value
+        return 0
+
+    def PCO_GetDelayExposureTime(
+        self, handle, delay, exposure, time_base_delay, time_base_exposure):
+        self._count('PCO_GetDelayExposureTime')
+        delay.value = self.settings['delay']
+        exposure.value = self.settings['exposure']
+        time_base_delay.value, time_base_exposure.value = 1, 1
+        return 0
+
+    def PCO_SetDelayExposureTime(
+        self, handle, delay, exposure, time_base_delay, time_base_exposure):
+        self._count('PCO_SetDelayExposureTime')
+        assert (time_base_delay, time_base_exposure) == (1, 1)
+        self.settings['delay'] = delay
+        self.settings['exposure'] = exposure
+        return 0
+
+    def PCO_GetTimestampMode(self, handle, value):
+        self._count('PCO_GetTimestampMode')
+        value.value = self.settings['timestamp_mode']
+        return 0
+
+    def PCO_SetTimestampMode(self, handle, value):
+        self._count('PCO_SetTimestampMode')
+        self.settings['timestamp_mode'] = value
+        return 0
+
+    def PCO_GetROI(self, handle, x0, y0, x1, y1):
+        self._count('PCO_GetROI')
+        x0.value, y0.value, x1.value, y1.value = self.settings['roi']
+        return 0
+
+    def PCO_SetROI(self, handle, x0, y0, x1, y1):
+        self._count('PCO_SetROI')
+        self.settings['roi'] = (x0, y0, x1, y1)
+        return 0
+
+    """
+    Stand-in for kernel32.WaitForSingleObject on a buffer event. We know
+    when the buffer is due to fill, so sleep until then, and keep going
+    (dropped triggers can push it back) until it fills or we time out.
+    """
+    def WaitForSingleObject(self, event_handle, timeout_ms):
+        self._count('WaitForSingleObject')
+        event_handle = getattr(event_handle, 'value', event_handle)
+        event, buffer_number = self.events[event_handle]
+        deadline = time.perf_counter() + 1e-3 * timeout_ms
+        while True:
+            self._advance()
+            if event.is_set():
+                return 0x0
+            now = time.perf_counter()
+            if now >= deadline:
+                return 0x102 #WAIT_TIMEOUT
+            wake_time = deadline
+            if self.recording and buffer_number in self.queue:
+                wake_time = min(wake_time, self._interval_end(
+                    self.num_intervals + self.queue.index(buffer_number)))
+            time.sleep(max(0, wake_time - now))
+
+def bcd_timestamp(image_number, seconds_since_epoch):
+    """
+    The 14 pixels a pco camera writes in binary timestamp mode: image
+    counter (8 digits), year (4), month, day, hour, minute, second, and
+    microseconds (6), two BCD digits per pixel.
+    """
+    t = time.gmtime(seconds_since_epoch)
+    microseconds = int(1e6 * (seconds_since_epoch % 1))
+    digits = '%08d%04d%02d%02d%02d%02d%02d%06d'%(
+        image_number % 10**8, t.tm_year, t.tm_mon, t.tm_mday,
+        t.tm_hour, t.tm_min, t.tm_sec, microseconds)
+    return [int(digits[i:i+2], 16) for i in range(0, 28, 2)]
+
+class SimulatedCameras:
+    """
+    Several simulated cameras behind one fake SC2_Cam.dll. Each call
+    goes to whichever camera owns the handle (or event) it's about.
+    """
+    def __init__(self, cameras):
+        self.cameras = list(cameras)
+        for i, camera in enumerate(self.cameras):
+            camera.camera_number = i
+
+    def _camera(self, handle):
+        handle = getattr(handle, 'value', handle)
+        return self.cameras[handle - 0x5c2]
+
+    def PCO_OpenCamera(self, handle, camera_number):
+        for camera in self.cameras: #The next one that isn't open yet
+            if not camera.open:
+                return camera.PCO_OpenCamera(handle, camera_number)
+        return 0x80002001 #No camera left to open
+
+    def PCO_OpenCameraEx(self, handle, open_struct):
+        if open_struct.wCameraNumber >= len(self.cameras):
+            return 0x80002001
+        camera = self.cameras[open_struct.wCameraNumber]
+        if camera.open:
+            return 0x80002001
+        return camera.PCO_OpenCameraEx(handle, open_struct)
+
+    def WaitForSingleObject(self, event_handle, timeout_ms):
+        event_handle = getattr(event_handle, 'value', event_handle)
+        camera = self.cameras[(event_handle - 0xe000) // 0x100]
+        return camera.WaitForSingleObject(event_handle, timeout_ms)
+
+    def __getattr__(self, name):
+        if not name.startswith('PCO_'):
+            raise AttributeError(name)
+        def call(handle, *args):
+            return getattr(self._camera(handle), name)(handle, *args)
+        return call
+
+"""
+ctypes lets pco.py hang 'argtypes' and its own names off the loaded
+library and its functions. Bound methods don't allow that, so we hand
+out thin wrappers instead.
+"""
+class _Function:
+    def __init__(self, method, raise_errors=True):
+        self.method = method
+        self.raise_errors = raise_errors
+        self.argtypes, self.restype = None, C.c_int
+
+    def __call__(self, *args):
+        if self.argtypes: #Like ctypes, pass scalars by value
+            args = [a.value if (isinstance(a, C._SimpleCData) and
+                                issubclass(t, C._SimpleCData)) else a
+                    for a, t in zip(args, self.argtypes)]
+        result = self.method(*args)
+        if self.raise_errors and result: #Like oledll, which checks HRESULTs
+            raise OSError(result, 'PCO error 0x%08x'%result)
+        return result
+
+class _Library:
+    def __init__(self, library):
+        self._library = library
+
+    def __getattr__(self, name):
+        function = _Function(getattr(self._library, name))
+        setattr(self, name, function)
+        return function
+
+class _Loader:
+    def __init__(self, library):
+        self.library = library
+
+    def LoadLibrary(self, name):
+        assert name == "SC2_Cam"
+        return _Library(self.library)
+
+class _Kernel32:
+    def __init__(self, library):
+        self.WaitForSingleObject = _Function(
+            library.WaitForSingleObject, raise_errors=False)
+
+class _WinDLL:
+    def __init__(self, library):
+        self.kernel32 = _Kernel32(library)
+
+def installed():
+    """
+    Is a simulated camera standing in for SC2_Cam.dll right now?
+    """
+    return isinstance(getattr(C, 'oledll', None), _Loader)
+
+def install(library=None):
+    """
+    Make ctypes hand out 'library' in place of SC2_Cam.dll and
+    kernel32. Call this before pco loads the DLL (at the first
+    pco.Edge()). 'library' can be a
+    SimulatedSC2Cam (a new one by default), or a list of them for a
+    multi-camera rig. Returns 'library', so you can poke at it.
+    """
+    if library is None:
+        library = SimulatedSC2Cam()
+    cameras = library
+    if isinstance(library, SimulatedSC2Cam):
+        cameras = [library]
+    cameras = SimulatedCameras(cameras)
+    C.oledll = _Loader(cameras)
+    C.windll = _WinDLL(cameras)
+    return library
@@ -10,7 +10,7 @@ class Edge:
             assert self.camera_handle.value is None
             dll.open_camera(self.camera_handle, 0)
             assert self.camera_handle.value is not None
-        except (WindowsError, AssertionError):
+        except (OSError, AssertionError):
             print("Failed to open pco.edge camera.")
             print(" *Is the camera on, and plugged into the computer?")
             print(" *Is CamWare running?")
@@ -536,103 +536,11 @@ class Edge:
         pass
 
 """
-DLL management
+DLL management; the bindings are shared with pco.py. See pco_dll.py,
+including for PCO_BACKEND=sim.
 """
-try:
-    dll = C.oledll.LoadLibrary("SC2_Cam")
-    """
-    If you get a WindowsError, read PCO_err.h to decypher it.
-    """
-except WindowsError:
-    print("Failed to load SC2_Cam.dll")
-    print("You need this to run pco.py")
-    raise
-
-"""
-This command opens the next pco camera; if you want to have multiple
-cameras, and pick which one you're opening, I'd have to implement
-PCO_OpenCameraEx, which would require me to understand PCO_OpenStruct.
-"""
-dll.open_camera = dll.PCO_OpenCamera
-dll.open_camera.argtypes = [C.POINTER(C.c_void_p), C.c_uint16]
-
-dll.close_camera = dll.PCO_CloseCamera
-dll.close_camera.argtypes = [C.c_void_p]
-
-dll.get_sensor_format = dll.PCO_GetSensorFormat
-dll.get_sensor_format.argtypes = [C.c_void_p, C.POINTER(C.c_uint16)]
-
-dll.get_camera_health = dll.PCO_GetCameraHealthStatus
-dll.get_camera_health.argtypes = [
-    C.c_void_p,
-    C.POINTER(C.c_uint32),
-    C.POINTER(C.c_uint32),
-    C.POINTER(C.c_uint32)]
-
-dll.get_temperature = dll.PCO_GetTemperature
-dll.get_temperature.argtypes = [
-    C.c_void_p,
-    C.POINTER(C.c_int16),
-    C.POINTER(C.c_int16),
-    C.POINTER(C.c_int16)]
-
-dll.get_trigger_mode = dll.PCO_GetTriggerMode
-dll.get_trigger_mode.argtypes = [C.c_void_p, C.POINTER(C.c_uint16)]
-
-dll.get_storage_mode = dll.PCO_GetStorageMode
-dll.get_storage_mode.argtypes = [C.c_void_p, C.POINTER(C.c_uint16)]
-
-dll.get_recorder_submode = dll.PCO_GetRecorderSubmode
-dll.get_recorder_submode.argtypes = [C.c_void_p, C.POINTER(C.c_uint16)]
-
-dll.get_acquire_mode = dll.PCO_GetAcquireMode
-dll.get_acquire_mode.argtypes = [C.c_void_p, C.POINTER(C.c_uint16)]
-
-dll.get_pixel_rate = dll.PCO_GetPixelRate
-dll.get_pixel_rate.argtypes = [C.c_void_p, C.POINTER(C.c_uint32)]
-
-dll.get_delay_exposure_time = dll.PCO_GetDelayExposureTime
-dll.get_delay_exposure_time.argtypes = [
-    C.c_void_p,
-    C.POINTER(C.c_uint32),
-    C.POINTER(C.c_uint32),
-    C.POINTER(C.c_uint16),
-    C.POINTER(C.c_uint16)]
-
-dll.get_roi = dll.PCO_GetROI
-dll.get_roi.argtypes = [
-    C.c_void_p,
-    C.POINTER(C.c_uint16),
-    C.POINTER(C.c_uint16),
-    C.POINTER(C.c_uint16),
-    C.POINTER(C.c_uint16)]
-
-dll.reset_settings_to_default = dll.PCO_ResetSettingsToDefault
-dll.reset_settings_to_default.argtypes = [C.c_void_p]
-
-dll.set_recording_state = dll.PCO_SetRecordingState
-dll.set_recording_state.argtypes = [C.c_void_p, C.c_uint16]
-
-dll.remove_buffer = dll.PCO_RemoveBuffer
-dll.remove_buffer.argtypes = [C.c_void_p]
-
-dll.free_buffer = dll.PCO_FreeBuffer
-dll.free_buffer.argtypes = [C.c_void_p, C.c_int16]
-
-dll.set_sensor_format = dll.PCO_SetSensorFormat
-dll.set_sensor_format.argtypes = [C.c_void_p, C.c_uint16]
-
-dll.set_trigger_mode = dll.PCO_SetTriggerMode
-dll.set_trigger_mode.argtypes = [C.c_void_p, C.c_uint16]
-
-dll.set_recorder_submode = dll.PCO_SetRecorderSubmode
-dll.set_recorder_submode.argtypes = [C.c_void_p, C.c_uint16]
-
-dll.set_acquire_mode = dll.PCO_SetAcquireMode
-dll.set_acquire_mode.argtypes = [C.c_void_p, C.c_uint16]
-
-dll.set_storage_mode = dll.PCO_SetStorageMode
-dll.set_storage_mode.argtypes = [C.c_void_p, C.c_uint16]
+import pco_dll
+dll = pco_dll.load()
 
 if __name__ == '__main__':
     camera = Edge()
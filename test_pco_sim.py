@@ -0,0 +1,983 @@
+"""
+Tests for pco.py, run against the simulated camera in pco_sim.py, so
+they work anywhere:
+
+    python test_pco_sim.py
+
+Plain asserts, one function per feature; pytest finds them too. The
+simulated camera fills each frame with its frame number, which is
+enough to tell where every frame ended up.
+"""
+import os
+import io
+import sys
+import time
+import tempfile
+import threading
+import contextlib
+import subprocess
+import numpy as np
+import pco_sim
+sim = pco_sim.install(pco_sim.SimulatedSC2Cam(frame_interval=2e-3))
+import pco
+
+small_roi = {'left': 901, 'right': 1160, 'top': 975, 'bottom': 1074}
+
+def run_python(code):
+    """
+    Run 'code' in a fresh interpreter, for tests that need their own
+    simulated cameras, or a pco that isn't loaded yet. Returns stdout.
+    """
+    return subprocess.run(
+        [sys.executable, '-c', code], check=True, capture_output=True,
+        text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+
+def open_camera(**settings):
+    camera = pco.Edge(verbose=False)
+    camera.apply_settings(exposure_time_microseconds=1000,
+                          region_of_interest=small_roi, **settings)
+    return camera
+
+def test_zero_copy():
+    """
+    The driver writes frame 'i' straight into out[first_frame + i], and
+    leaves the rest of 'out' alone.
+    """
+    camera = open_camera()
+    camera.arm(num_buffers=4)
+    out = pco.aligned_zeros((12, camera.height, camera.width))
+    result = camera.record_to_memory(
+        10, out=out, first_frame=2, zero_copy=True)
+    assert result is out
+    assert not out[:2].any()
+    values = out[2:, :, 0].copy()
+    assert (out[2:] == values[:, :, None]).all() #Each frame is one value
+    assert (np.diff(values[:, 0].astype(int)) >= 1).all() #...in order
+    """
+    If the recording fails, the driver must never touch 'out' again.
+    """
+    sim.dma_error_frames = {5}
+    try:
+        camera.record_to_memory(10, out=out, zero_copy=True)
+    except pco.DMAError:
+        pass
+    else:
+        assert False, "no DMAError"
+    finally:
+        sim.dma_error_frames = set()
+    assert not camera.armed and camera.buffer_pointers == []
+    snapshot = out.copy()
+    time.sleep(0.02)
+    assert (out == snapshot).all()
+    assert camera.record_to_memory(3).shape[0] == 3 #Fresh buffers
+    camera.close()
+
+def test_wait_strategies():
+    """
+    Every strategy gets every frame, in order, and hands each buffer
+    back exactly once. When no frame comes (a missed trigger), each one
+    gives up with TimeoutError instead of waiting forever.
+    """
+    camera = open_camera()
+    camera.arm(num_buffers=4)
+    polls_per_frame = {}
+    for wait_strategy in pco.wait_strategies:
+        frames = camera.record_to_memory(20, wait_strategy=wait_strategy)
+        assert (np.diff(frames[:, 0, 0].astype(int)) >= 1).all()
+        assert sorted(camera.added_buffers) == [0, 1, 2, 3]
+        summary = camera.telemetry.summary()
+        assert summary['strategy'] == wait_strategy
+        polls_per_frame[wait_strategy] = summary['polls_per_frame']
+    assert polls_per_frame['adaptive_backoff'] < polls_per_frame['busy_poll']
+    sim.dropped_trigger_rate = 1
+    try:
+        camera.arm(num_buffers=4) #Drop any frames that came in already
+        for wait_strategy in (pco.BusyPoll(poll_timeout=1000),
+                              pco.AdaptiveBackoff(timeout=0.05),
+                              pco.EventWait(timeout=0.05)):
+            since = camera.events.num_recorded
+            try:
+                camera.record_to_memory(3, wait_strategy=wait_strategy)
+            except pco.TimeoutError as e:
+                assert e.num_acquired == 0
+            else:
+                assert False, wait_strategy.name + " didn't time out"
+            assert 'timeout' in camera.events.dump(since)['name']
+            assert sorted(camera.added_buffers) == [0, 1, 2, 3]
+    finally:
+        sim.dropped_trigger_rate = 0
+        camera.close()
+
+def test_frame_reducer():
+    """
+    Exact sums, and var/std matching numpy even across block merges.
+    """
+    frames = np.random.default_rng(0).integers(
+        0, 2**16, size=(50, 8, 6), dtype=np.uint16)
+    for block_size in (1, 7, 1024):
+        reducer = pco.FrameReducer(
+            8, 6, pco.FrameReducer.names, block_size=block_size)
+        for frame in frames:
+            reducer.add(frame)
+        r = reducer.result()
+        assert (r['sum'] == frames.sum(axis=0, dtype=np.uint64)).all()
+        assert (r['max'] == frames.max(axis=0)).all()
+        assert (r['min'] == frames.min(axis=0)).all()
+        assert np.allclose(r['mean'], frames.mean(axis=0))
+        assert np.allclose(r['var'], frames.var(axis=0, dtype=np.float64))
+        assert np.allclose(r['std'], frames.std(axis=0, dtype=np.float64))
+
+def test_record_reduced():
+    """
+    Reduces straight out of the driver buffers, skipping preframes. Each
+    simulated frame is its frame number, so every pixel agrees.
+    """
+    camera = open_camera()
+    r = camera.record_reduced(20, ('sum', 'mean', 'max', 'min', 'std'),
+                              preframes=3)
+    assert set(r) == {'sum', 'mean', 'max', 'min', 'std'}
+    for name, result in r.items():
+        assert result.shape == (camera.height, camera.width)
+        assert (result == result[0, 0]).all(), name
+    low, high = int(r['min'][0, 0]), int(r['max'][0, 0])
+    assert low >= 3 and high - low >= 16 #17 frames, maybe more apart
+    assert low < r['mean'][0, 0] < high
+    assert np.isclose(r['sum'][0, 0], 17 * r['mean'][0, 0])
+    assert sorted(camera.added_buffers) == list(range(camera.num_buffers))
+    camera.close()
+
+def test_binning():
+    roi = {'left': 1, 'top': 1, 'right': 64, 'bottom': 32}
+    frame = np.random.default_rng(1).integers(
+        0, 2**16, size=(32, 64), dtype=np.uint16)
+    crop = {'left': 3, 'top': 2, 'right': 61, 'bottom': 30} #Not whole bins
+    for binning in (2, 3):
+        expected = frame[1:1 + (29 // binning) * binning,
+                         2:2 + (59 // binning) * binning]
+        h, w = expected.shape[0] // binning, expected.shape[1] // binning
+        sums = expected.reshape(h, binning, w, binning).sum(
+            axis=(1, 3), dtype=np.uint64)
+        for bin_mode, answer in (('sum', sums),
+                                 ('mean', sums // binning**2)):
+            transform = pco.FrameTransform(roi, crop, binning, bin_mode)
+            assert transform.shape == (h, w)
+            out = np.zeros(transform.shape, transform.dtype)
+            transform(frame, out)
+            assert (out == answer).all()
+    camera = open_camera()
+    transform = camera.frame_transform(binning=4)
+    frames = camera.record_to_memory(5, transform=transform)
+    assert frames.shape == (5, camera.height // 4, camera.width // 4)
+    camera.close()
+
+def test_crop_to_requested_roi():
+    """
+    Before any apply_settings(), 'requested' keeps the whole ROI; after,
+    just the region we asked for.
+    """
+    camera = pco.Edge(verbose=False)
+    camera.arm(num_buffers=4)
+    assert camera.requested_roi is None
+    transform = camera.frame_transform('requested')
+    assert transform.shape == (camera.height, camera.width)
+    requested = {'left': 905, 'right': 1100, 'top': 980, 'bottom': 1069}
+    camera.apply_settings(exposure_time_microseconds=1000,
+                          region_of_interest=requested)
+    assert camera.roi['left'] == 901 #The camera can't do it exactly...
+    frames = camera.record_to_memory(
+        3, transform=camera.frame_transform('requested'))
+    assert frames.shape == (3, 90, 196) #...so we crop to it
+    camera.close()
+
+def test_compressed_round_trip():
+    """
+    A compressed recording reads back exactly like a raw one of the
+    same (static) scene.
+    """
+    rng = np.random.default_rng(2)
+    sim.scene = rng.random((sim.max_height, sim.max_width)) * 20
+    camera = open_camera()
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            raw_path = os.path.join(directory, 'raw.bin')
+            camera.record_to_file(raw_path, 5)
+            raw, _ = pco.read_recording(raw_path)
+            expected = np.array(raw[0])
+            assert expected.min() < expected.max() #Something to compress
+            del raw #Let go of the memmap, so we can delete the file
+            for compression in ('zlib', 'lzma'):
+                for preprocess in (None, 'delta+shuffle'):
+                    path = os.path.join(directory, 'compressed.bin')
+                    stats = camera.record_to_file(
+                        path, 8, compression=compression,
+                        preprocess=preprocess)
+                    frames, frame_numbers = pco.read_recording(path)
+                    assert len(frames) == stats['frames_written'] == 8
+                    assert (np.diff(frame_numbers) > 0).all()
+                    for frame in frames[:]:
+                        assert np.array_equal(frame, expected)
+                    del frames
+    finally:
+        sim.scene = None
+        camera.close()
+
+def test_compression_options():
+    """
+    Every preprocess mode and worker count writes frames that read back
+    in order and intact, any frame on its own; a binned (uint32)
+    transform too.
+    """
+    camera = open_camera()
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'compressed.bin')
+            for preprocess, num_workers in ((None, 1), ('delta', 4),
+                                            ('shuffle', 2),
+                                            ('delta+shuffle', 1)):
+                stats = camera.record_to_file(
+                    path, 12, compression='zlib', preprocess=preprocess,
+                    num_workers=num_workers)
+                assert stats['compression_ratio'] > 10 #Flat frames
+                frames, frame_numbers = pco.read_recording(path)
+                assert frames.shape == (12, camera.height, camera.width)
+                values = [int(frames[i][0, 0]) for i in range(12)]
+                assert (np.diff(values) >= 1).all()
+                assert (frames[5] == values[5]).all() #Random access
+                assert (frames[2:4][:, 0, 0] == values[2:4]).all()
+                del frames
+            transform = camera.frame_transform(binning=2, bin_mode='sum')
+            camera.record_to_file(path, 4, transform=transform,
+                                  compression='lzma')
+            frames, _ = pco.read_recording(path)
+            assert frames.dtype == np.uint32
+            assert frames.shape == (4,) + transform.shape
+            first = np.array(frames[0])
+            assert (first == first[0, 0]).all() and first[0, 0] % 4 == 0
+            del frames
+    finally:
+        camera.close()
+
+def test_history_ring_windows():
+    ring = pco.HistoryRing(8, 2, 3)
+    def write(frame_numbers):
+        for n in frame_numbers:
+            slot = ring.claim()
+            if slot is not None:
+                slot.fill(n)
+                ring.commit(n)
+    write(range(20))
+    ring.trigger(frames_before=3, frames_after=2) #Event is the next frame
+    assert not ring.frozen
+    write(range(20, 30))
+    assert ring.frozen and ring.num_frozen_out == 8
+    frames, frame_numbers = ring.window()
+    assert list(frame_numbers) == [17, 18, 19, 20, 21]
+    assert (frames[:, 0, 0] == frame_numbers).all()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'event.bin')
+        stats = ring.save(path)
+        assert stats['frames_before'] == 3 and stats['frames_after'] == 2
+        assert stats['event_frame_number'] == 20
+        saved, saved_numbers = pco.read_recording(path)
+        assert (saved_numbers == frame_numbers).all()
+        assert (saved == frames).all()
+        del saved
+    """
+    Ask for more history than the ring still holds, around a frame we
+    already have; with a wrapped ring, we get what's left.
+    """
+    ring.resume()
+    write(range(30, 37))
+    ring.trigger(frames_before=6, frames_after=1, frame_number=33)
+    assert ring.frozen
+    frames, frame_numbers = ring.window()
+    assert list(frame_numbers) == [30, 31, 32, 33]
+    assert (frames[:, 0, 0] == frame_numbers).all()
+
+def test_decode_timestamps():
+    seconds = 1700000000.25
+    frame = np.zeros((4, 20), np.uint16)
+    frame[0, :14] = pco_sim.bcd_timestamp(1234, seconds)
+    stamps = pco.decode_timestamps(np.stack([frame, frame * 0]))
+    assert list(stamps['valid']) == [True, False]
+    assert stamps['frame_number'][0] == 1234
+    assert stamps['time'][0] == (np.datetime64('2023-11-14T22:13:20') +
+                                 np.timedelta64(250000, 'us'))
+    camera = open_camera(timestamp_mode='binary')
+    frames = camera.record_to_memory(10)
+    stamps = pco.decode_timestamps(frames)
+    assert stamps['valid'].all()
+    assert (np.diff(stamps['frame_number']) >= 1).all()
+    assert (np.diff(stamps['time']) > np.timedelta64(0, 'us')).all()
+    camera.close()
+
+def test_check_timestamps():
+    """
+    Finds the frames the camera exposed but we never got, in one go or
+    batch by batch.
+    """
+    numbers = np.array([1, 2, 3, 6, 7, 8, 9, 12])
+    stamps = {'frame_number': numbers,
+              'time': np.datetime64('2026-01-01') +
+                      (2000 * numbers).astype('timedelta64[us]'),
+              'valid': np.ones(len(numbers), bool)}
+    report = pco.check_timestamps(stamps)
+    assert report['num_dropped'] == 4
+    assert list(report['gaps']) == [3, 7]
+    assert list(report['gap_sizes']) == [2, 2]
+    assert np.allclose(report['intervals'], 2e-3) #Even across the gaps
+    assert report['jitter'] < 1e-9
+    first = {k: v[:5] for k, v in stamps.items()}
+    rest = {k: v[5:] for k, v in stamps.items()}
+    report = pco.check_timestamps(rest, pco.check_timestamps(first)['last'])
+    assert report['num_dropped'] == 2 and list(report['gaps']) == [2]
+    """
+    With the camera: two buffers fill while we're not looking, and
+    the frames after them have nowhere to go.
+    """
+    camera = open_camera(timestamp_mode='binary')
+    camera.arm(num_buffers=2)
+    time.sleep(0.02) #About 10 frames
+    frames = camera.record_to_memory(10)
+    report = pco.check_timestamps(pco.decode_timestamps(frames))
+    assert report['gaps'][0] == 2 and report['gap_sizes'][0] >= 5
+    assert report['num_dropped'] <= sim.num_lost #Unless lost at the end
+    camera.close()
+
+def test_frame_telemetry():
+    """
+    One entry per frame, in frame order even after wrapping around.
+    """
+    camera = open_camera()
+    camera.record_to_memory(12, wait_strategy='adaptive_backoff')
+    telemetry = camera.telemetry
+    assert isinstance(telemetry, pco.FrameTelemetry)
+    summary = telemetry.summary()
+    assert summary['strategy'] == 'adaptive_backoff'
+    assert summary['num_frames'] == 12
+    assert summary['num_bad_driver_status'] == 0
+    assert (telemetry.wait_time[:12] > 0).all()
+    assert (telemetry.copy_time[:12] > 0).all()
+    counts, edges = telemetry.histogram('wait_time')
+    assert counts.sum() == 12 and len(edges) == len(counts) + 1
+    camera.close()
+    telemetry = pco.FrameTelemetry(4, 'test')
+    for which_im in range(10):
+        pco._record_wait(telemetry, which_im, 0, 0, 0, 1, 0)
+        telemetry.record_handling(which_im, 0)
+    timeline = telemetry.timeline()
+    assert telemetry.num_frames == 4
+    assert list(timeline['frame_index']) == [6, 7, 8, 9]
+    assert timeline['ready_time'][0] == 0
+    assert (np.diff(timeline['ready_time']) >= 0).all()
+
+def test_ring_threads():
+    """
+    start_acquisition() and start_history() share their setup: each
+    stops the last thread, closes a shared ring it leaves behind, and
+    finishes its ring when it's done, so get() returns None.
+    """
+    camera = open_camera()
+    ring = camera.start_acquisition(num_images=5)
+    frames = [frame[0, 0] for frame in camera.stream(timeout=5)]
+    assert len(frames) == 5 and ring.finished and ring.error is None
+    shared = camera.start_acquisition(publish_as='test_pco_sim_ring')
+    reader = pco.SharedFrameReader('test_pco_sim_ring')
+    assert reader.get(timeout=5) is not None
+    reader.close()
+    history = camera.start_history(seconds=0.02)
+    assert isinstance(history, pco.HistoryRing) and len(history.slots) >= 2
+    assert shared.shm is None and shared.finished #Closed and finished
+    camera.stop_acquisition()
+    assert history.stopping and history.finished
+    camera.close()
+    ring, preview = pco.FrameRing(2, 4, 4), pco.LivePreview([None])
+    for target, wait in ((ring, ring.get), (preview, preview.latest)):
+        waiter = threading.Thread(target=wait) #Until we finish()
+        waiter.start()
+        target.stop()
+        target.finish()
+        waiter.join(timeout=5)
+        assert not waiter.is_alive() and target.stopping
+
+def test_reconfiguring_stops_background_threads():
+    """
+    Disarming (e.g. to change a setting) or recording stops whatever
+    thread is using the driver queue first, so no buffer gets queued
+    twice, or queued on a disarmed camera.
+    """
+    camera = open_camera()
+    for start in (lambda: camera.start_acquisition(),
+                  lambda: camera.start_history(num_slots=8),
+                  lambda: camera.start_preview()):
+        start()
+        camera.apply_settings(exposure_time_microseconds=1500,
+                              region_of_interest=small_roi)
+        assert camera._acquisition_thread is None
+        assert getattr(camera, '_preview_thread', None) is None
+        assert not camera.armed and sim.queue == []
+        camera.stop_acquisition()
+        camera.stop_preview()
+        assert camera.added_buffers == [] and sim.queue == []
+        camera.arm(8)
+        assert sorted(sim.queue) == list(range(8))
+        camera.apply_settings(exposure_time_microseconds=1000,
+                              region_of_interest=small_roi)
+    camera.start_acquisition()
+    frames = camera.record_to_memory(5)
+    assert frames.shape[0] == 5 and camera._acquisition_thread is None
+    assert sorted(camera.added_buffers) == list(range(camera.num_buffers))
+    assert set(sim.queue) <= set(camera.added_buffers) #Some may have filled
+    camera.close()
+
+def test_auto_expose():
+    """
+    Converges on the target level, and leaves the ROI we asked for
+    alone (frame_transform('requested') depends on it).
+    """
+    sim.scene = np.random.default_rng(3).uniform(
+        0, 1, (sim.max_height, sim.max_width))
+    requested = {'left': 903, 'right': 1138, 'top': 975, 'bottom': 1064}
+    camera = pco.Edge(verbose=False)
+    try:
+        for exposure in (100, 2200, 500000):
+            camera.apply_settings(exposure_time_microseconds=exposure,
+                                  region_of_interest=requested)
+            shape = camera.frame_transform('requested').shape
+            result = camera.auto_expose(target_level=30000, tolerance=0.05)
+            assert result['converged'] and result['num_iterations'] <= 6
+            assert abs(result['level'] - 30000) <= 0.05 * (30000 - 100)
+            assert camera.requested_roi == requested
+            assert camera.frame_transform('requested').shape == shape
+            assert camera.exposure_time_microseconds == (
+                result['exposure_time_microseconds'])
+    finally:
+        sim.scene = None
+        camera.close()
+
+def test_event_log():
+    log = pco.EventLog(capacity=8)
+    for i in range(20):
+        log.record('record', i, 0)
+    events = log.dump()
+    assert log.num_recorded == 20 and list(events['a']) == list(range(12, 20))
+    assert list(log.dump(since=18)['a']) == [18, 19]
+    log.record('buffer_freed', 3) #Only printed when very verbose
+    assert len(log.format(since=20)) == 1 and len(log.format(20, 1)) == 0
+    assert log.format(since=20)[0].endswith('Buffer 3 freed')
+    log = pco.EventLog(capacity=1 << 16) #Several threads at once
+    def record_some():
+        for i in range(5000):
+            log.record('timeout', i)
+    threads = [threading.Thread(target=record_some) for i in range(4)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert log.num_recorded == 20000
+    assert (np.bincount(log.dump()['a']) == 4).all()
+
+def test_verbose_prints_the_event_log():
+    """
+    Verbose calls print what they logged once they're done, each event
+    once, even when one call makes another; quiet ones print nothing.
+    """
+    for verbose in (False, True):
+        printed = io.StringIO()
+        with contextlib.redirect_stdout(printed):
+            camera = pco.Edge(verbose=verbose)
+            since = camera.events.num_recorded
+            camera.apply_settings(
+                exposure_time_microseconds=1000,
+                region_of_interest={'left': 903, 'right': 1138,
+                                    'top': 975, 'bottom': 1064})
+            camera.arm(4)
+            camera.record_to_memory(3)
+            camera.close()
+        lines = printed.getvalue().splitlines()
+        if not verbose:
+            assert lines == []
+            continue
+        logged = camera.events.format(verbosity=1)
+        assert [l.split(None, 1)[1] for l in lines] == [
+            l.split(None, 1)[1] for l in logged]
+        messages = '\n'.join(lines)
+        for message in ('Opened camera', 'Trigger mode: auto_trigger',
+                        'Exposure: 1000 us', 'Requested ROI adjusted',
+                        'Armed: 220 x 100 pixels', 'Recorded 3 images',
+                        'Camera closed'):
+            assert message in messages, message
+        assert 'Buffer 0 allocated' not in messages #That's very_verbose
+
+def test_apply_settings_only_sends_changes():
+    """
+    The first call resets everything; after that we only set (and
+    verify) what changed, and unchanged settings don't even disarm.
+    """
+    camera = pco.Edge(verbose=False)
+    camera.apply_settings(exposure_time_microseconds=1000,
+                          region_of_interest=small_roi)
+    assert camera.last_reconfiguration['full_reset']
+    assert set(camera.last_reconfiguration['changed']) == {
+        'sensor_format', 'acquire_mode', 'pixel_rate', 'storage_mode',
+        'recorder_submode', 'trigger_mode', 'exposure_time', 'roi',
+        'timestamp_mode'}
+    camera.arm(num_buffers=4)
+    calls = dict(sim.call_counts)
+    camera.apply_settings(exposure_time_microseconds=1000,
+                          region_of_interest=small_roi)
+    assert camera.last_reconfiguration['changed'] == []
+    assert camera.armed and sim.call_counts == calls #Not one DLL call
+    camera.apply_settings(exposure_time_microseconds=1500,
+                          region_of_interest=small_roi)
+    assert not camera.last_reconfiguration['full_reset']
+    assert camera.last_reconfiguration['changed'] == ['exposure_time']
+    assert not camera.armed
+    new_calls = {k: v - calls.get(k, 0) for k, v in sim.call_counts.items()
+                 if v != calls.get(k, 0)}
+    assert new_calls['PCO_SetDelayExposureTime'] == 1
+    assert new_calls['PCO_GetDelayExposureTime'] == 1 #Verified once
+    assert 'PCO_SetROI' not in new_calls
+    assert 'PCO_ResetSettingsToDefault' not in new_calls
+    assert camera.exposure_time_microseconds == 1500
+    camera.apply_settings(exposure_time_microseconds=1500,
+                          region_of_interest=small_roi, full_reset=True)
+    assert camera.last_reconfiguration['full_reset']
+    assert len(camera.last_reconfiguration['changed']) == 9
+    camera.close()
+
+def test_settings_are_read_lazily():
+    """
+    Opening the camera reads nothing; each setting is read the first
+    time we ask, then comes from memory, except the ones that drift
+    (like the temperature), which we re-read once they're stale.
+    """
+    def count(name):
+        return sim.call_counts.get(name, 0)
+    temperature_reads = count('PCO_GetTemperature')
+    roi_reads = count('PCO_GetROI')
+    camera = pco.Edge(verbose=False)
+    assert count('PCO_GetTemperature') == temperature_reads
+    assert count('PCO_GetROI') == roi_reads
+    for i in range(3):
+        camera.temperature, camera.roi
+    assert count('PCO_GetTemperature') == temperature_reads + 1
+    assert count('PCO_GetROI') == roi_reads + 1
+    value, read_at = camera._setting_cache['temperature']
+    camera._setting_cache['temperature'] = (value, read_at - 60) #Stale
+    camera._setting_cache['roi'] = (camera.roi, read_at - 60) #Never stale
+    camera.temperature, camera.roi
+    assert count('PCO_GetTemperature') == temperature_reads + 2
+    assert count('PCO_GetROI') == roi_reads + 1
+    camera.refresh() #Forget everything, and read it all again
+    assert count('PCO_GetTemperature') == temperature_reads + 3
+    assert count('PCO_GetROI') == roi_reads + 2
+    camera.close()
+
+def test_buffer_pool():
+    """
+    Driver buffers outlive disarm(), and get reused by the next arm()
+    if they're big enough. With a memory budget, we shrink the pool
+    back under it.
+    """
+    def allocations():
+        return sim.call_counts.get('PCO_AllocateBuffer', 0)
+    big_roi = {'left': 1, 'right': 400, 'top': 900, 'bottom': 1149}
+    little_roi = {'left': 1, 'right': 200, 'top': 1000, 'bottom': 1049}
+    camera = pco.Edge(verbose=False)
+    camera.apply_settings(exposure_time_microseconds=1000,
+                          region_of_interest=big_roi)
+    camera.arm(4)
+    start = allocations()
+    camera.arm(4) #Re-arming reuses the pool...
+    camera.arm(2)
+    assert allocations() == start and len(camera.buffer_pointers) == 4
+    camera.arm(6) #...and only allocates what it lacks
+    assert allocations() == start + 2
+    camera.apply_settings(region_of_interest=little_roi)
+    camera.arm(6) #Smaller frames fit in the buffers we have
+    assert allocations() == start + 2
+    assert camera._buffer_capacities == [200000] * 6
+    camera.record_to_memory(3, out=pco.aligned_zeros(
+        (3, camera.height, camera.width)), zero_copy=True)
+    start = allocations()
+    camera.arm(6) #Zero-copy left the buffers on our memory
+    assert allocations() == start + 6
+    assert None not in camera._driver_buffer_addresses
+    camera.close()
+    camera = pco.Edge(verbose=False, buffer_memory_budget=60000)
+    camera.apply_settings(exposure_time_microseconds=1000,
+                          region_of_interest=big_roi)
+    camera.arm(2)
+    assert sum(camera._buffer_capacities) == 400000 #Over budget, but needed
+    camera.disarm()
+    camera.apply_settings(region_of_interest=little_roi)
+    camera.arm(2)
+    assert camera._buffer_capacities == [20000] * 2 #Shrunk to fit
+    assert camera.record_to_memory(3).shape == (3, 50, 200)
+    camera.close()
+
+def test_aligned_frames():
+    """
+    Each frame matches at most one frame per camera, on the image
+    counter when we have one, then the camera timestamp, then arrival
+    time. Camera 1's counter starts 5 ahead, it missed frames 3 and
+    10, and four of its frames arrived in one burst.
+    """
+    n = 20
+    numbers0 = np.arange(1, n + 1)
+    kept = np.array([i for i in range(n + 2) if i not in (3, 10)])[:n]
+    numbers1 = 6 + kept
+    group = pco.CameraGroup([])
+    group.ready_times = np.stack([0.01 * np.arange(n) + 0.001,
+                                  0.01 * kept + 0.003])
+    group.ready_times[1, 12:16] = group.ready_times[1, 15] #Burst
+    def stamps(numbers, counter=None):
+        return {'frame_number': numbers if counter is None else counter,
+                'time': np.datetime64('2026-01-01') +
+                        (10000 * numbers).astype('timedelta64[us]'),
+                'valid': np.ones(len(numbers), bool)}
+    reset_counter = numbers1.copy()
+    reset_counter[10:] -= 15 #E.g. re-armed mid-recording
+    for timestamps, aligned_by in (
+        ([stamps(numbers0), stamps(numbers1)], 'frame_number'),
+        ([stamps(numbers0), stamps(numbers1, reset_counter)], 'timestamp')):
+        group.timestamps = timestamps
+        matches, skew = group.aligned_frames()
+        assert group.aligned_by == aligned_by
+        assert matches.shape == (2, 18)
+        assert (numbers0[matches[0]] == numbers1[matches[1]] - 5).all()
+    group.timestamps = None
+    matches, skew = group.aligned_frames()
+    assert group.aligned_by == 'arrival'
+    for m in matches: #One-to-one, even through the burst
+        assert len(set(m)) == matches.shape[1]
+    assert (skew >= 0).all()
+    """
+    The real thing: two simulated cameras, each dropping a tenth of
+    its triggers, and started a little apart.
+    """
+    output = run_python("""if True:
+        import numpy as np, pco_sim
+        pco_sim.install([pco_sim.SimulatedSC2Cam(
+            frame_interval=2e-3, dropped_trigger_rate=0.1, seed=seed)
+            for seed in (1, 2)])
+        import pco
+        group = pco.CameraGroup([0, 1], verbose=False)
+        group.apply_settings(
+            exposure_time_microseconds=1000, timestamp_mode='binary',
+            region_of_interest={'left': 1, 'right': 200,
+                                'top': 925, 'bottom': 1124})
+        group.arm(4)
+        frames = group.record_to_memory(20)
+        matches, skew = group.aligned_frames()
+        numbers = [pco.decode_timestamps(f)['frame_number'] for f in frames]
+        offsets = numbers[1][matches[1]] - numbers[0][matches[0]]
+        assert (offsets == offsets[0]).all() #Same frames, every match
+        group.close()
+        print(group.aligned_by, matches.shape[1])
+        """)
+    aligned_by, num_matches = output.split()
+    assert aligned_by == 'frame_number' and 0 < int(num_matches) <= 20
+
+def test_shared_frame_ring():
+    """
+    Readers in this process or another see every frame in order, or
+    find out what they missed; closing either end leaves the other
+    working.
+    """
+    name = 'test_pco_sim_%i'%os.getpid()
+    camera = open_camera()
+    camera.start_acquisition(20, num_slots=8, publish_as=name)
+    reader = pco.SharedFrameReader(name)
+    values = []
+    while True:
+        frame = reader.get(timeout=5)
+        if frame is None:
+            break
+        values.append(int(frame[0, 0]))
+    assert reader.still_valid() #Nothing overwrites it once we're done
+    assert len(values) + reader.num_missed == 20
+    assert (np.diff(values) >= 1).all()
+    reader.close()
+    late_reader = pco.SharedFrameReader(name) #Finished; only 7 are left
+    assert late_reader.get() is not None and late_reader.frame_number == 13
+    late_reader.close()
+    camera.start_acquisition(num_slots=4, publish_as=name)
+    output = run_python("""if True:
+        import pco
+        reader = pco.SharedFrameReader(%r)
+        for i in range(10):
+            reader.get(timeout=5)
+        reader.close()
+        print(reader.num_read)
+        """%name)
+    assert output.split() == ['10']
+    reader = pco.SharedFrameReader(name) #The other process didn't unlink it
+    time.sleep(0.05) #Fall a ring behind
+    reader.get(timeout=5)
+    assert reader.num_missed > 0
+    reader.close()
+    camera.close() #Unlinks it
+    try:
+        pco.SharedFrameReader(name)
+    except FileNotFoundError:
+        pass
+    else:
+        assert False, "ring still in shared memory"
+
+def test_asyncio():
+    """
+    arecord() and aframes() leave the event loop free, and cancelling
+    either stops the camera quickly, with every buffer back in the
+    driver queue; even when no frames are coming at all.
+    """
+    import asyncio
+    camera = open_camera()
+    camera.arm(num_buffers=4)
+    async def heartbeat(gaps):
+        last = time.perf_counter()
+        while True:
+            await asyncio.sleep(0.01)
+            now = time.perf_counter()
+            gaps.append(now - last)
+            last = now
+    async def cancel_after(seconds, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        await asyncio.sleep(seconds)
+        task.cancel()
+        start = time.perf_counter()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        else:
+            assert False, "wasn't cancelled"
+        return time.perf_counter() - start
+    async def consume(num_images=None):
+        num_frames = 0
+        async with contextlib.aclosing(camera.aframes(num_images)) as frames:
+            async for frame in frames:
+                num_frames += 1
+        return num_frames
+    async def main():
+        gaps = []
+        beat = asyncio.ensure_future(heartbeat(gaps))
+        frames = await camera.arecord(10)
+        assert frames.shape == (10, camera.height, camera.width)
+        assert await consume(10) == 10
+        stop_time = await cancel_after(
+            0.1, camera.arecord(10000, wait_strategy='adaptive_backoff'))
+        assert stop_time < 1
+        sim.dropped_trigger_rate = 1 #No frames, ever
+        try:
+            stop_time = await cancel_after(0.1, consume())
+        finally:
+            sim.dropped_trigger_rate = 0
+        assert stop_time < 1
+        beat.cancel()
+        assert max(gaps) < 0.2, max(gaps) #The loop never stalled
+    asyncio.run(main())
+    assert camera._acquisition_thread is None
+    assert sorted(camera.added_buffers) == [0, 1, 2, 3]
+    camera.close()
+
+def test_dll_profiler():
+    """
+    Every DLL call gets counted under the innermost Edge method that
+    made it (background threads included), failures by error code,
+    and disabling puts the bare bindings back.
+    """
+    camera = open_camera()
+    original = pco.dll.arm_camera
+    pco.dll_profiler.reset()
+    try:
+        with pco.dll_profiler:
+            assert pco.dll.arm_camera is not original
+            camera.record_to_memory(5) #Arms first
+            camera.start_acquisition(5)
+            assert len(list(camera.stream(timeout=5))) == 5
+            sim.dropped_trigger_rate = 1
+            try:
+                camera.arm(4) #Drop any frames that came in already
+                camera.record_to_memory(
+                    1, wait_strategy=pco.EventWait(timeout=0.01))
+            except pco.TimeoutError:
+                pass
+            finally:
+                sim.dropped_trigger_rate = 0
+        assert pco.dll.arm_camera is original
+        rows = {(r['method'], r['function']): r
+                for r in pco.dll_profiler.report()}
+        assert rows['arm', 'arm_camera']['calls'] == 2
+        assert rows['record_to_memory', 'get_buffer_status']['calls'] >= 6
+        assert rows['_acquisition_thread_main', 'add_buffer']['calls'] >= 5
+        timeouts = rows['record_to_memory', 'wait_for_event']['errors']
+        assert list(timeouts.values()) == [1] and 0 not in timeouts
+        totals = {r['function']: r for r in pco.dll_profiler.report(False)}
+        assert totals['add_buffer']['calls'] == sum(
+            r['calls'] for (method, function), r in rows.items()
+            if function == 'add_buffer')
+        calls = sum(r['calls'] for r in rows.values())
+        camera.arm(4) #Not profiled any more
+        assert sum(r['calls'] for r in pco.dll_profiler.report()) == calls
+    finally:
+        camera.close()
+
+def test_lazy_import():
+    """
+    Importing pco doesn't need SC2_Cam.dll (there isn't one here), or
+    the modules only some features use; the first Edge() loads it.
+    """
+    output = run_python("""if True:
+        import os, sys
+        import pco
+        assert pco.dll is None
+        for module in ('pco_sim', 'asyncio', 'multiprocessing.shared_memory'):
+            assert module not in sys.modules, module
+        assert pco.legalize_roi({'left': 5, 'right': 100, 'top': 7,
+                                 'bottom': 1000})['left'] == 1
+        os.environ['PCO_BACKEND'] = 'sim'
+        camera = pco.Edge(verbose=False)
+        assert pco.dll is not None and pco.dll is pco.pco_dll.load()
+        camera.close()
+        print('ok')
+        """)
+    assert output.split() == ['ok']
+
+def test_frame_rate_model():
+    """
+    The model agrees with the (simulated) camera, and plan_roi() gives
+    the smallest legal ROI covering what we need, the same whether we
+    ask one at a time or all at once.
+    """
+    full = {'left': 1, 'right': 2060, 'top': 1, 'bottom': 2048}
+    assert 95 < pco.estimate_frame_rate(full, 100) < 105
+    assert pco.estimate_frame_rate(full, 50000) == 20 #Exposure-limited
+    rates = pco.estimate_frame_rate(
+        {'left': 1, 'right': 2060, 'top': np.array([1, 1000]),
+         'bottom': np.array([2048, 1049])}, np.array([[100], [20000]]))
+    assert rates.shape == (2, 2) and rates[0, 1] > rates[0, 0]
+    camera = open_camera()
+    camera.apply_settings(exposure_time_microseconds=100,
+                          region_of_interest=small_roi)
+    camera.arm(num_buffers=4)
+    assert np.isclose(camera.estimate_frame_rate(), 1 / sim.readout_time())
+    camera.close()
+    rng = np.random.default_rng(4)
+    left = rng.integers(1, 2000, 200)
+    top = rng.integers(1, 2000, 200)
+    required = {'left': left, 'right': left + rng.integers(0, 60, 200),
+                'top': top, 'bottom': top + rng.integers(0, 48, 200)}
+    plan = pco.plan_roi(required, target_fps=400)
+    roi = plan['roi']
+    assert (roi['left'] <= required['left']).all()
+    assert (roi['top'] <= np.minimum(required['top'], 2048)).all()
+    assert (roi['right'] >= np.minimum(required['right'], 2060)).all()
+    assert (roi['bottom'] >= np.minimum(required['bottom'], 2048)).all()
+    for k, v in pco.legalize_roi(roi).items(): #Already legal
+        assert (v == roi[k]).all()
+    assert (plan['meets_target'] == (plan['frame_rate'] >= 400)).all()
+    for i in range(0, 200, 37):
+        one = pco.plan_roi({k: int(v[i]) for k, v in required.items()},
+                           target_fps=400)
+        assert one['roi'] == {k: int(v[i]) for k, v in roi.items()}
+        assert one['frame_rate'] == plan['frame_rate'][i]
+        exposure = one['max_exposure_microseconds']
+        if exposure > 0: #Longest exposure that keeps up
+            assert pco.estimate_frame_rate(one['roi'], exposure) >= 400
+            assert pco.estimate_frame_rate(one['roi'], exposure + 1) < 400
+
+def test_live_preview():
+    """
+    latest() always gives the newest frame, however slow we are, and
+    starting or stopping a preview around other acquisitions never
+    queues a buffer twice.
+    """
+    camera = open_camera()
+    camera.start_preview()
+    first = int(camera.latest(timeout=5)[0, 0])
+    time.sleep(0.05) #Miss a few frames
+    out = np.zeros((camera.height, camera.width), np.uint16)
+    assert camera.latest(timeout=5, out=out) is out
+    assert int(out[0, 0]) > first + 1
+    summary = camera.preview.summary()
+    assert summary['num_displayed'] == 2 and summary['num_recycled'] > 0
+    assert summary['mean_frames_skipped'] > 0
+    camera.stop_preview()
+    assert camera.latest() is None #It's over
+    def check_queue():
+        assert sorted(camera.added_buffers) == list(range(camera.num_buffers))
+        assert set(sim.queue) <= set(camera.added_buffers)
+    check_queue()
+    camera.start_acquisition()
+    camera.start_preview(num_buffers=8) #Stops it, then re-arms
+    camera.latest(timeout=5)
+    camera.start_preview(num_buffers=8) #Restarts, without re-arming
+    camera.latest(timeout=5)
+    camera.stop_preview()
+    check_queue()
+    camera.start_preview()
+    camera.latest(timeout=5)
+    camera.arm(8) #Stops the preview before it re-queues everything
+    assert camera._preview_thread is None
+    check_queue()
+    camera.close()
+
+def test_flat_field_correction():
+    """
+    Matches the obvious numpy version to within rounding, and with the
+    camera, flattens out an uneven scene.
+    """
+    rng = np.random.default_rng(5)
+    shape = (45, 30) #Not a whole number of blocks
+    dark = rng.normal(100, 2, shape)
+    flat = rng.uniform(900, 1100, shape)
+    flat[3, 4] = 0 #A dead pixel
+    frames = rng.integers(0, 4000, (3,) + shape, dtype=np.uint16)
+    gain = np.where(flat > 0, flat[flat > 0].mean() / np.maximum(flat, 1), 0)
+    expected = np.clip(np.round((frames - dark) * gain), 0, 65535)
+    correction = pco.FlatFieldCorrection(dark, flat, block_rows=8)
+    out = np.zeros(shape, np.uint16)
+    assert correction(frames[0], out) is out
+    assert np.abs(out - expected[0]).max() <= 1
+    assert correction.correct(frames) is frames #In place
+    assert np.abs(frames - expected).max() <= 1 and not frames[:, 3, 4].any()
+    dark_only = pco.FlatFieldCorrection(dark).correct(np.full(shape, 50,
+                                                              np.uint16))
+    assert not dark_only.any() #Clipped at zero, not wrapped around
+    """
+    With the camera: even light on pixels whose response varies by 2x.
+    """
+    response = rng.uniform(10, 20, (sim.max_height, sim.max_width))
+    camera = open_camera()
+    def light(scene):
+        sim.scene = scene
+        camera.arm(4) #Drop frames of the old scene
+    try:
+        light(np.zeros((sim.max_height, sim.max_width)))
+        dark = camera.record_dark(num_images=5)
+        assert np.allclose(dark, sim.dark_level)
+        light(response)
+        assert camera.record_to_memory(1).std() > 1000 #Uncorrected
+        camera.record_flat(num_images=5)
+        correction = camera.flat_field_correction()
+        assert camera.flat_field_correction() is correction #Cached
+        frames = camera.record_to_memory(3, transform=correction)
+        assert frames.std() < 1 and 14000 < frames.mean() < 16000
+        camera.apply_settings(exposure_time_microseconds=500,
+                              region_of_interest=small_roi)
+        light(np.zeros((sim.max_height, sim.max_width)))
+        camera.record_dark(num_images=5)
+        light(response)
+        correction = camera.flat_field_correction(
+            flat_exposure_time_microseconds=1000) #Gain's the same
+        frames = camera.record_to_memory(3, transform=correction)
+        assert frames.std() < 1 and 7000 < frames.mean() < 8000
+    finally:
+        sim.scene = None
+        camera.close()
+
+if __name__ == '__main__':
+    for name, test in list(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print(name, 'passed')